@@ -0,0 +1,480 @@
+import sys
+from os.path import abspath, dirname
+from random import Random
+from time import time
+
+import hdlmiracle
+
+from hdlcapture import (NANOSECONDS, CaptureStore, Content, IPv4,
+                        OperationCode, PacketQueue, Telegram, encode_packet,
+                        format_row, format_time, monotonic_ns)
+from hdldecode import CACHE, decoded
+from hdlfilter import MatchCache, compile_filter, parse_conditions
+from hdlsearch import ContentIndex, Search
+from hdlsource import parse_source
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+SIZES = (10000, 100000, 1000000)
+SEED = 1
+BUDGET = 2000
+VISIBLE_ROWS = 24
+
+# (weight, value): a bus is dominated by a few status opcodes
+OPERATION_CODES = ((40, 0x0031), (20, 0x0032), (15, 0xe3e7), (10, 0x1948),
+                   (5, 0x0033), (5, 0x0034), (5, 0xdc0c))
+CONTENT_SIZES = ((30, 0), (20, 1), (15, 2), (15, 4), (10, 8), (5, 16),
+                 (4, 32), (1, 64))
+IPADDRESSES = ('192.168.1.10', '192.168.1.11', '192.168.1.250')
+
+FILTERS = (
+    'operation_code=0031,subnet_id=1',
+    'subnet_id=1,device_id=7',
+    'target_subnet_id=2,target_device_id=9',
+)
+
+SEARCHES = (
+    '01 02',
+    '10 ?? 30 40',
+    '"ab"',
+    '[0]=00-0f',
+)
+
+PERCENTILES = (50, 95, 99)
+
+STARTUP_RUNS = 5
+STARTUP_SOURCE = '127.0.0.1:16099'
+STARTUP_SEND = 0.001
+STARTUP_STAGES = ('interpreter', 'import', 'build', 'first packet',
+                  'startup')
+
+# Run in a fresh interpreter for every start, so that imports are cold.
+# Prints the time the interpreter was up, hdlmonitor imported, the window
+# built and the first packet shown.
+STARTUP_CHILD = '''
+import sys
+from time import time
+started = time()
+import hdlmonitor
+imported = time()
+
+
+class StartupGui(hdlmonitor.MonitorGui):
+    def mainloop(self, n=0):
+        built = time()
+        self.update()
+        while not self.table.end:
+            self.update()
+        sys.stdout.write('%r %r %r %r\\n' % (started, imported, built,
+                                              time()))
+        self.master.destroy()
+
+
+StartupGui(sources=sys.argv[1:])
+'''
+
+
+def weighted(choices):
+    values = []
+    for weight, value in choices:
+        values.extend([value] * weight)
+    return values
+
+
+def synthetic(count, seed=SEED):
+    # Telegrams with the fields of an hdlmiracle packet, with the
+    # head, opcode and content length mix set above.
+    random = Random(seed)
+    heads = list(hdlmiracle.HEADS) or ['HDLMIRACLE']
+    operation_codes = weighted(OPERATION_CODES)
+    content_sizes = weighted(CONTENT_SIZES)
+    ipaddresses = [IPv4.parse(ip) for ip in IPADDRESSES]
+    for _ in range(count):
+        size = random.choice(content_sizes)
+        yield Telegram(
+            random.choice(ipaddresses),
+            random.choice(heads),
+            random.randint(0, 3),
+            random.randint(0, 31),
+            random.choice((0x0095, 0x0150, 0x026d)),
+            OperationCode(random.choice(operation_codes)),
+            random.choice((0xff, 1, 2)),
+            random.choice((0xff, 7, 9)),
+            Content(bytearray(random.getrandbits(8) for _ in range(size))),
+        )
+
+
+def blocks(iterable, size):
+    block = []
+    for item in iterable:
+        block.append(item)
+        if len(block) == size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def peak_rss():
+    # peak resident set size in bytes, None where it cannot be read
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Result(object):
+    # Latency samples of one stage; count items went through in elapsed ns.
+    def __init__(self, stage, size):
+        self.stage = stage
+        self.size = size
+        self.count = 0
+        self.elapsed = 0
+        self.samples = []
+        self.rss = None
+
+    def add(self, elapsed, count=1):
+        self.samples.append(elapsed)
+        self.elapsed += elapsed
+        self.count += count
+
+    def percentile(self, p):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0
+        return samples[min(len(samples) - 1, len(samples) * p // 100)]
+
+    def rate(self):
+        if not self.elapsed:
+            return 0.0
+        return float(self.count) * NANOSECONDS / self.elapsed
+
+    def as_dict(self):
+        return {
+            'stage': self.stage,
+            'size': self.size,
+            'count': self.count,
+            'seconds': float(self.elapsed) / NANOSECONDS,
+            'rate': self.rate(),
+            'latency_us': dict(
+                [('p{0}'.format(p), self.percentile(p) / 1000.0)
+                 for p in PERCENTILES] +
+                [('max', max(self.samples or [0]) / 1000.0)]
+            ),
+            'peak_rss': self.rss,
+        }
+
+    def format(self):
+        latency = ''.join('{0:>10.1f}'.format(self.percentile(p) / 1000.0)
+                          for p in PERCENTILES)
+        rss = '{0:>8.1f}'.format(self.rss / 1048576.0) \
+            if self.rss is not None else '{0:>8s}'.format('-')
+        return '{0:<14s}{1:>9d}{2:>14.0f}{3}{4:>10.1f}{5}'.format(
+            self.stage, self.size, self.rate(), latency,
+            max(self.samples or [0]) / 1000.0, rss
+        )
+
+
+HEADER = '{0:<14s}{1:>9s}{2:>14s}{3}{4:>10s}{5:>8s}'.format(
+    'stage', 'packets', 'items/s',
+    ''.join('{0:>10s}'.format('p{0} us'.format(p)) for p in PERCENTILES),
+    'max us', 'RSS MB'
+)
+
+
+def timed(result, function, *args):
+    start = monotonic_ns()
+    value = function(*args)
+    result.add(monotonic_ns() - start)
+    return value
+
+
+def bench_core(size, report):
+    # The Tk-free half of the pipeline, as drain() and refilter() run it:
+    # queue, store, match cache, and formatting of the visible rows.
+    queue = PacketQueue()
+    store = CaptureStore(max_packets=size)
+    matches = MatchCache()
+    matches.configure([])
+    receive = Result('receive', size)
+    drain = Result('drain', size)
+    for block in blocks(synthetic(size), BUDGET):
+        for packet in block:
+            start = monotonic_ns()
+            queue.put((monotonic_ns(), packet))
+            receive.add(monotonic_ns() - start)
+        start = monotonic_ns()
+        batch = queue.drain(BUDGET)
+        first = store.end
+        for timestamp, packet in batch:
+            store.append(timestamp, packet)
+        matches.update(zip(range(first, store.end),
+                           (packet for _, packet in batch)), store.end)
+        shown = matches.matches(first, store.end)
+        for seq in shown[-VISIBLE_ROWS:]:
+            timestamp, packet = store[seq]
+            format_row(format_time(timestamp), packet)
+        drain.add(monotonic_ns() - start, len(batch))
+    report(receive)
+    report(drain)
+
+    rows = [parse_conditions(expression) for expression in FILTERS]
+    match = compile_filter(rows)
+    result = Result('filter', size)
+    for _, _, packet in store.iter_from(store.first):
+        timed(result, match, packet)
+    report(result)
+
+    for stage in ('refilter-cold', 'refilter-warm'):
+        result = Result(stage, size)
+        if stage == 'refilter-cold':
+            matches.clear(store.first)
+        matches.configure(rows)
+        start = monotonic_ns()
+        for cursor in range(store.first, store.end, BUDGET):
+            stop = min(cursor + BUDGET, store.end)
+            chunk = monotonic_ns()
+            if matches.behind(stop):
+                matches.update(((seq, packet) for seq, _, packet
+                                in store.iter_from(cursor, stop)), stop)
+            matches.matches(cursor, stop)
+            result.samples.append(monotonic_ns() - chunk)
+        result.elapsed = monotonic_ns() - start
+        result.count = size
+        report(result)
+
+    index = ContentIndex()
+    index.clear(store.first)
+    result = Result('index', size)
+    for cursor in range(store.first, store.end, BUDGET):
+        stop = min(cursor + BUDGET, store.end)
+        start = monotonic_ns()
+        index.update(store.iter_contents(cursor, stop), stop)
+        result.add(monotonic_ns() - start, stop - cursor)
+    report(result)
+
+    result = Result('search', size)
+    for expression in SEARCHES:
+        timed(result, index.search, store, Search(expression), store.first,
+              store.end)
+    report(result)
+
+    result = Result('format_row', size)
+    for seq, timestamp, packet in store.iter_from(store.first):
+        timed(result, format_row, format_time(timestamp), packet)
+    report(result)
+
+    # the synthetic content is random, so the cold pass misses the cache
+    # far more often than on a real bus
+    CACHE.clear()
+    for stage in ('decode-cold', 'decode-warm'):
+        result = Result(stage, size)
+        for seq, timestamp, packet in store.iter_from(store.first):
+            timed(result, decoded, packet)
+        report(result)
+
+
+class NullBus(object):
+    # keeps the benchmarked GUI off the network
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def attach(self, monitor):
+        pass
+
+    def detach(self, monitor):
+        pass
+
+    def start(self):
+        pass
+
+
+def bench_gui(sizes, report):
+    import hdlmonitor
+    from hdlmonitor import Filter, MonitorGui
+
+    hdlmiracle.IPBus = NullBus
+
+    class BenchGui(MonitorGui):
+        # drain() is called by the benchmark instead of the Tk timer, and
+        # mainloop() runs the benchmark instead of waiting for events.
+        def after(self, ms, func=None, *args):
+            if func == self.drain:
+                return None
+            return MonitorGui.after(self, ms, func, *args)
+
+        def refilter(self):
+            start = monotonic_ns()
+            MonitorGui.refilter(self)
+            self.chunks.append(monotonic_ns() - start)
+
+        def mainloop(self, n=0):
+            for size in sizes:
+                self.bench(size)
+            self.master.destroy()
+
+        # time of each refilter() chunk, the longest the UI is blocked
+        chunks = []
+
+        def bench(self, size):
+            self.clear()
+            receive = Result('receive', size)
+            drain = Result('drain', size)
+            for block in blocks(synthetic(size), self.budget):
+                for packet in block:
+                    timed(receive, self.receive, packet)
+                start = monotonic_ns()
+                self.drain()
+                self.update_idletasks()
+                drain.add(monotonic_ns() - start, len(block))
+            report(receive)
+            report(drain)
+
+            live = self.live
+            lines = live.lines
+            result = Result('Table.append', size)
+            self.table.clear()
+            for seq in range(live.first, live.end):
+                timed(result, self.table.append, seq, lines(seq))
+            report(result)
+
+            result = Result('append_n', size)
+            self.table.clear()
+            for cursor in range(live.first, live.end, self.budget):
+                rows = [(seq, lines(seq)) for seq
+                        in range(cursor, min(cursor + self.budget, live.end))]
+                start = monotonic_ns()
+                self.append_n(rows)
+                self.update_idletasks()
+                result.add(monotonic_ns() - start, len(rows))
+            report(result)
+
+            for expression in FILTERS:
+                self.add_filter()
+                row = Filter.list[-1]
+                values = dict(parse_conditions(expression))
+                for key, (entry, _, _, fmt) in row.conditions:
+                    if values[key] is not None:
+                        entry.delete(0, hdlmonitor.tk.END)
+                        entry.insert(0, format(values[key], fmt))
+            Filter.validate()
+            result = Result('Filter.filter', size)
+            for _, _, packet in live.iter_from(live.first):
+                timed(result, Filter.filter, packet)
+            report(result)
+
+            for stage in ('apply-cold', 'apply-warm'):
+                result = Result(stage, size)
+                self.chunks = result.samples
+                start = monotonic_ns()
+                self.apply_filters()
+                while self.refilter_cursor is not None:
+                    self.update()
+                self.update_idletasks()
+                result.elapsed = monotonic_ns() - start
+                result.count = size
+                report(result)
+
+            for row in list(Filter.list):
+                row.delete()
+            Filter.validate()
+            self.apply_filters()
+
+    try:
+        BenchGui(budget=BUDGET, store=CaptureStore(max_packets=max(sizes)))
+    except hdlmonitor.tk.TclError as e:
+        sys.exit('{0}: run under xvfb-run or with --headless'.format(e))
+
+
+def bench_startup(runs, report):
+    # Starts the GUI runs times on a UDP source fed a packet every
+    # STARTUP_SEND s from the moment the interpreter is spawned, and times
+    # each step to the first packet shown.
+    import socket
+    import subprocess
+    import threading
+
+    host, port, _ = parse_source(STARTUP_SOURCE)
+    payload = encode_packet(next(synthetic(1)))
+    results = [Result(stage, runs) for stage in STARTUP_STAGES]
+    for _ in range(runs):
+        done = threading.Event()
+
+        def send():
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            while not done.is_set():
+                sender.sendto(payload, (host, port))
+                done.wait(STARTUP_SEND)
+            sender.close()
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        spawned = time()
+        try:
+            child = subprocess.Popen(
+                [sys.executable, '-c', STARTUP_CHILD, STARTUP_SOURCE],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=dirname(abspath(__file__))
+            )
+            out, err = child.communicate()
+        finally:
+            done.set()
+            thread.join()
+        if child.returncode:
+            sys.exit(err.decode('utf-8', 'replace').strip())
+        marks = [spawned] + [float(mark) for mark in out.split()]
+        for result, start, end in zip(results, marks, marks[1:]):
+            result.add(int((end - start) * NANOSECONDS))
+        results[-1].add(int((marks[-1] - spawned) * NANOSECONDS))
+    for result in results:
+        report(result)
+
+
+def main(argv=None):
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the receive, filter and render paths.'
+    )
+    parser.add_argument('-n', '--size', type=int, action='append',
+                        metavar='N',
+                        help='number of packets, repeatable (default: '
+                             '{0})'.format(', '.join(map(str, SIZES))))
+    parser.add_argument('--headless', action='store_true',
+                        help='benchmark the Tk-free pipeline only, for '
+                             'machines without a display (or use xvfb-run)')
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per result')
+    parser.add_argument('--startup', action='store_true',
+                        help='time {0} starts of the GUI, from spawning '
+                             'the interpreter to the first packet shown, '
+                             'instead'.format(STARTUP_RUNS))
+    args = parser.parse_args(argv)
+    sizes = sorted(args.size or SIZES)
+
+    def report(result):
+        result.rss = peak_rss()
+        if args.json:
+            print(json.dumps(result.as_dict(), sort_keys=True))
+        else:
+            print(result.format())
+        sys.stdout.flush()
+
+    if not args.json:
+        print(HEADER)
+    if args.startup:
+        bench_startup(STARTUP_RUNS, report)
+    elif args.headless:
+        for size in sizes:
+            bench_core(size, report)
+    else:
+        bench_gui(sizes, report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,862 @@
+import sys
+import threading
+from array import array
+from collections import OrderedDict, deque
+from datetime import datetime
+from operator import itemgetter
+from socket import inet_aton, inet_ntoa
+from struct import pack, unpack
+from time import sleep, time
+
+
+QUEUE_MAXLEN = 100000
+# how long, in ns, an ordered PacketQueue holds packets back for the ones
+# another receiver stamped earlier, see PacketQueue.reorder
+REORDER_WINDOW = 20000000
+DRAIN_INTERVAL = 0.05
+
+STORE_CAPACITY = 4096
+STORE_MAX_PACKETS = 1000000
+# distinct heads or sources a store keeps track of, see InternTable
+STORE_INTERN = 65535
+INTERN_FALLBACK = '?'
+
+ROW_CACHE_SIZE = 4096
+CELL_CACHE_SIZE = 65536
+
+CONTENT_LINE = 8
+
+# UDP payload without content: source IP, head, leading code, length byte,
+# source address, device type, operation code, target address and CRC
+HEADER_SIZE = 27
+HEAD_SIZE = 10
+# content starts after the frame header and ends before the CRC
+CONTENT_OFFSET = 25
+CRC_SIZE = 2
+LEADING_CODE = b'\xaa\xaa'
+FRAME = '>BBBHHBB'
+
+NANOSECONDS = 1000000000
+
+HDL_PORT = 6000
+
+FIELDS = (
+    'ipaddress',
+    'head',
+    'subnet_id',
+    'device_id',
+    'device_type',
+    'operation_code',
+    'target_subnet_id',
+    'target_device_id',
+    'source',
+)
+
+try:
+    array('Q')
+    INDEX_TYPECODE = 'Q'
+    TIMESTAMP_TYPECODE = 'q'
+except ValueError:
+    INDEX_TYPECODE = 'L'
+    TIMESTAMP_TYPECODE = 'd'
+
+IP_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+
+try:
+    integer_type = long
+    string_types = (str, unicode)
+except NameError:
+    integer_type = int
+    string_types = (str,)
+
+
+def native_str(data):
+    return data if str is bytes else data.decode('latin-1')
+
+
+def content_bytes(content):
+    return bytearray.fromhex(' '.join(str(line) for line in content.step()))
+
+
+def crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+        table.append(crc & 0xffff)
+    return table
+
+
+CRC_TABLE = crc_table()
+
+
+def crc16(data):
+    crc = 0
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xffff) ^ CRC_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+try:
+    from time import monotonic_ns
+except ImportError:
+    try:
+        from time import monotonic
+    except ImportError:
+        monotonic = time
+
+    def monotonic_ns():
+        return int(monotonic() * NANOSECONDS)
+
+
+class Clock(object):
+    # Packets are stamped with the bare monotonic_ns() on the receive path;
+    # adding self.offset, taken once, turns that into wall-clock nanoseconds.
+    def __init__(self):
+        self.offset = int(time() * NANOSECONDS) - monotonic_ns()
+
+    def __call__(self):
+        return monotonic_ns() + self.offset
+
+
+def format_time(timestamp):
+    seconds, nanoseconds = divmod(int(timestamp), NANOSECONDS)
+    now = datetime.fromtimestamp(seconds)
+    return '{0:%H:%M:%S}.{1:06d}'.format(now, nanoseconds // 1000)
+
+
+def format_delta(delta):
+    seconds, nanoseconds = divmod(abs(int(delta)), NANOSECONDS)
+    return '{0}{1}.{2:06d}'.format('-' if delta < 0 else '+', seconds,
+                                   nanoseconds // 1000)
+
+
+class CellCache(dict):
+    def __init__(self, fmt):
+        dict.__init__(self)
+        self.fmt = fmt
+
+    def __missing__(self, value):
+        if len(self) >= CELL_CACHE_SIZE:
+            self.clear()
+        cell = self[value] = self.fmt.format(value)
+        return cell
+
+
+IP_CELLS = CellCache(' {0!s:15}')
+HEAD_CELLS = CellCache(' {0:10s}')
+SOURCE_CELLS = CellCache(' {0:15.15s}')
+BYTE_CELLS = tuple('{0:>4d}'.format(i) for i in range(256))
+DEVICE_TYPE_CELLS = CellCache('{0:>6d}')
+OPERATION_CODE_CELLS = CellCache('{0!s:>5}')
+
+PADDING = (
+    ' ' * 16,
+    ' ' * 16,
+    ' ' * 11,
+    ' ' * 4,
+    ' ' * 4,
+    ' ' * 6,
+    ' ' * 5,
+    ' ' * 4,
+    ' ' * 4,
+)
+
+SOURCE_PADDING = PADDING + (' ' * 16,)
+
+EMPTY_CONTENT = ('', '')
+
+
+def format_row(now, packet, source=False, decode=None):
+    # With source, the source cell follows the timestamp; with decode, a
+    # function returning the decoded content of a packet as text, the
+    # decoded cell ends the first line.
+    head = (' {0:15s}'.format(now),)
+    padding = PADDING
+    if source:
+        head += (SOURCE_CELLS[packet.source],)
+        padding = SOURCE_PADDING
+    head += (
+        IP_CELLS[packet.ipaddress],
+        HEAD_CELLS[packet.head],
+        BYTE_CELLS[packet.subnet_id],
+        BYTE_CELLS[packet.device_id],
+        DEVICE_TYPE_CELLS[packet.device_type],
+        OPERATION_CODE_CELLS[packet.operation_code],
+        BYTE_CELLS[packet.target_subnet_id],
+        BYTE_CELLS[packet.target_device_id],
+    )
+    row = [padding + (' {0:23s}'.format(str(line)),
+                      ' {0:8s}'.format(line.ascii()))
+           for line in packet.content.step()]
+    if row:
+        row[0] = head + row[0][len(padding):]
+    else:
+        row.append(head + EMPTY_CONTENT)
+    if decode is not None:
+        row[0] += (' ' + decode(packet),)
+        for i in range(1, len(row)):
+            row[i] += ('',)
+    return row
+
+
+def row_lines(row):
+    return [' '.join(subrow)[1:].rstrip() for subrow in row]
+
+
+class RowCache(object):
+    def __init__(self, maxsize=ROW_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.rows = OrderedDict()
+
+    def __setitem__(self, key, row):
+        if len(self.rows) >= self.maxsize:
+            self.rows.popitem(last=False)
+        self.rows[key] = row
+
+    def clear(self):
+        self.rows.clear()
+
+    def get(self, key):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.rows[key] = row
+        return row
+
+
+class PacketQueue(object):
+    # put() is called from the receiver threads and drain() from the
+    # consumer, without a lock: deque.append and deque.popleft are atomic,
+    # and maxlen is only a soft bound, which receivers racing each other may
+    # each pass by a packet. Each receiver thread counts the packets it
+    # filtered or dropped on its own, and drain() sums the counts into
+    # filtered and dropped. With ordered, drained packets come out sorted by
+    # timestamp, as packets stamped by several receivers may be appended
+    # slightly out of order (see reorder()). accept, when set, is the
+    # capture filter: the packets it rejects are only counted, on the
+    # receiver thread, and never reach the consumer.
+    def __init__(self, maxlen=QUEUE_MAXLEN, ordered=False, accept=None):
+        self.maxlen = maxlen
+        self.ordered = ordered
+        self.accept = accept
+        self.items = deque()
+        self.held = []
+        self.local = threading.local()
+        self.counters = []
+        self.received = 0
+        self.filtered = 0
+        self.dropped = 0
+        self.delayed = 0
+        self.peak = 0
+        self.backlog = 0
+
+    def __len__(self):
+        return len(self.items) + len(self.held)
+
+    def counted(self):
+        # [filtered, dropped] of the calling receiver thread
+        try:
+            return self.local.counters
+        except AttributeError:
+            counters = self.local.counters = [0, 0]
+            self.counters.append(counters)
+            return counters
+
+    def put(self, item):
+        accept = self.accept
+        if accept is not None and not accept(item[1]):
+            self.counted()[0] += 1
+            return False
+        items = self.items
+        if len(items) >= self.maxlen:
+            self.counted()[1] += 1
+            return False
+        items.append(item)
+        return True
+
+    def drain(self, budget=None):
+        items = self.items
+        count = len(items)
+        if count > self.peak:
+            self.peak = count
+        if budget is not None:
+            # Packets left over from the previous drain are at the front,
+            # so only the newly left over ones are counted as delayed.
+            backlog = max(0, count - budget)
+            self.delayed += backlog - max(0, self.backlog - budget)
+            self.backlog = backlog
+            count = min(count, budget)
+        popleft = items.popleft
+        batch = [popleft() for _ in range(count)]
+        self.received += count
+        counters = list(self.counters)
+        self.filtered = sum(counted[0] for counted in counters)
+        self.dropped = sum(counted[1] for counted in counters)
+        if self.ordered:
+            batch = self.reorder(batch)
+        return batch
+
+    def reorder(self, batch):
+        # Sorts batch together with the packets held back by the previous
+        # drain and holds back those stamped within the last REORDER_WINDOW
+        # ns, as another receiver may still be about to queue an older
+        # packet. So packets come out in order across batches too, unless
+        # a receiver queues a packet more than REORDER_WINDOW after
+        # stamping it.
+        batch = self.held + batch
+        batch.sort(key=itemgetter(0))
+        cutoff = monotonic_ns() - REORDER_WINDOW
+        i = len(batch)
+        while i and batch[i - 1][0] > cutoff:
+            i -= 1
+        self.held = batch[i:]
+        return batch[:i]
+
+    def clear(self):
+        self.items.clear()
+        self.held = []
+        self.backlog = 0
+
+
+class IPv4(integer_type):
+    def __eq__(self, other):
+        if isinstance(other, string_types):
+            return str(self) == other
+        return integer_type(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = integer_type.__hash__
+
+    def __str__(self):
+        return inet_ntoa(pack('!I', self))
+
+    @classmethod
+    def parse(cls, text):
+        return cls(unpack('!I', inet_aton(text))[0])
+
+
+class OperationCode(int):
+    def __str__(self):
+        return format(int(self), '04x')
+
+
+class ContentLine(bytearray):
+    def __str__(self):
+        return ' '.join(format(byte, '02x') for byte in self)
+
+    def ascii(self):
+        return ''.join(chr(byte) if 32 <= byte < 127 else '.'
+                       for byte in self)
+
+
+class Content(bytearray):
+    def step(self, size=8):
+        for i in range(0, len(self), size):
+            yield ContentLine(self[i:i + size])
+
+
+class Telegram(object):
+    __slots__ = FIELDS + ('content',)
+
+    def __init__(self, ipaddress, head, subnet_id, device_id, device_type,
+                 operation_code, target_subnet_id, target_device_id,
+                 content, source=''):
+        self.ipaddress = ipaddress
+        self.head = head
+        self.subnet_id = subnet_id
+        self.device_id = device_id
+        self.device_type = device_type
+        self.operation_code = operation_code
+        self.target_subnet_id = target_subnet_id
+        self.target_device_id = target_device_id
+        self.content = content
+        self.source = source
+
+
+class InternTable(object):
+    # Ids for the heads or sources of stored packets. Any 10 bytes make a
+    # head, so stray traffic may bring any number of them: each id counts
+    # the stored packets using it and is reused once they are all evicted.
+    # While STORE_INTERN ids are in use, new values share the id of
+    # INTERN_FALLBACK, which is never released.
+    def __init__(self):
+        self.values = [INTERN_FALLBACK]
+        self.index = {INTERN_FALLBACK: 0}
+        self.refs = [0]
+        self.free = []
+
+    def __len__(self):
+        return len(self.index)
+
+    def intern(self, value):
+        try:
+            value_id = self.index[value]
+        except KeyError:
+            if self.free:
+                value_id = self.free.pop()
+                self.values[value_id] = value
+                self.index[value] = value_id
+            elif len(self.values) < STORE_INTERN:
+                value_id = self.index[value] = len(self.values)
+                self.values.append(value)
+                self.refs.append(0)
+            else:
+                value_id = 0
+        self.refs[value_id] += 1
+        return value_id
+
+    def release(self, value_id):
+        refs = self.refs
+        refs[value_id] -= 1
+        if not refs[value_id] and value_id:
+            del self.index[self.values[value_id]]
+            self.values[value_id] = None
+            self.free.append(value_id)
+
+
+def encode_packet(packet):
+    # Rebuilds the UDP payload of a packet: source IP, head, leading code
+    # and the frame from the length byte to the CRC.
+    content = packet.content
+    if not isinstance(content, bytearray):
+        content = content_bytes(content)
+    frame = bytearray(pack(
+        FRAME, HEADER_SIZE - 16 + len(content), packet.subnet_id,
+        packet.device_id, packet.device_type, packet.operation_code,
+        packet.target_subnet_id, packet.target_device_id
+    ))
+    frame.extend(content)
+    # latin-1, as decode_packet() reads it
+    head = packet.head
+    if not isinstance(head, bytes):
+        head = head.encode('latin-1', 'replace')
+    head = head[:HEAD_SIZE].ljust(HEAD_SIZE)
+    return (inet_aton(str(packet.ipaddress)) + head + LEADING_CODE +
+            bytes(frame) + pack('>H', crc16(frame)))
+
+
+def decode_packet(payload, strict=False, source=''):
+    payload = bytes(payload)
+    if len(payload) < HEADER_SIZE or payload[14:16] != LEADING_CODE:
+        raise ValueError('not an HDL Buspro datagram')
+    (length, subnet_id, device_id, device_type, operation_code,
+     target_subnet_id, target_device_id) = unpack(FRAME, payload[16:25])
+    if 16 + length != len(payload):
+        raise ValueError('bad telegram length')
+    if strict and crc16(payload[16:-2]) != unpack('>H', payload[-2:])[0]:
+        raise ValueError('bad telegram CRC')
+    return Telegram(
+        IPv4(unpack('!I', payload[:4])[0]),
+        native_str(payload[4:14]).rstrip(),
+        subnet_id,
+        device_id,
+        device_type,
+        OperationCode(operation_code),
+        target_subnet_id,
+        target_device_id,
+        Content(payload[CONTENT_OFFSET:-CRC_SIZE]),
+        source,
+    )
+
+
+class CaptureStore(object):
+    # Ring buffer addressed by a sequence number that keeps growing across
+    # evictions, so readers can hold on to positions. Header fields live in
+    # typed array columns, content bytes in one shared bytearray; packets
+    # are rebuilt as Telegram objects only when read. Limits are optional:
+    # max_packets caps the count, max_bytes the summed telegram size (plus
+    # the overhead charged per content byte, see charge) and max_age (in
+    # seconds) the span of the capture.
+    def __init__(self, max_packets=STORE_MAX_PACKETS, max_bytes=None,
+                 max_age=None):
+        self.max_packets = max_packets
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.overhead = 0
+        self.end = 0
+        self.clear()
+
+    def __getitem__(self, seq):
+        index = seq - self.first
+        if not 0 <= index < self.size:
+            raise IndexError('packet {0} is not stored'.format(seq))
+        return self.read((self.head + index) % self.capacity)
+
+    def __iter__(self):
+        return self.iter_from(self.first)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp, packet):
+        content = packet.content
+        if not isinstance(content, bytearray):
+            content = content_bytes(content)
+        ipaddress = packet.ipaddress
+        if not isinstance(ipaddress, IPv4):
+            ipaddress = IPv4.parse(str(ipaddress))
+
+        if self.max_packets is not None and self.size >= self.max_packets:
+            self.evict()
+        if self.size == self.capacity:
+            self.grow()
+        slot = (self.head + self.size) % self.capacity
+        self.timestamps[slot] = timestamp
+        self.ipaddresses[slot] = ipaddress
+        self.head_ids[slot] = self.heads.intern(packet.head)
+        self.subnet_ids[slot] = packet.subnet_id
+        self.device_ids[slot] = packet.device_id
+        self.device_types[slot] = packet.device_type
+        self.operation_codes[slot] = packet.operation_code
+        self.target_subnet_ids[slot] = packet.target_subnet_id
+        self.target_device_ids[slot] = packet.target_device_id
+        self.source_ids[slot] = self.sources.intern(
+            getattr(packet, 'source', ''))
+        self.offsets[slot] = self.content_base + len(self.content)
+        self.lengths[slot] = len(content)
+        self.content.extend(content)
+
+        self.size += 1
+        self.bytes += HEADER_SIZE + len(content) * (1 + self.overhead)
+        seq = self.end
+        self.end += 1
+        if self.max_bytes is not None:
+            while self.bytes > self.max_bytes and self.size > 1:
+                self.evict()
+        if self.max_age is not None:
+            max_age = self.max_age * NANOSECONDS
+            while timestamp - self.timestamps[self.head] > max_age:
+                self.evict()
+        return seq
+
+    def close(self):
+        self.clear()
+
+    def charge(self, overhead):
+        # Counts overhead more bytes per content byte against max_bytes,
+        # for what is kept alongside the content, such as a ContentIndex.
+        # The limit is enforced again from the next append on.
+        if self.size:
+            dead = self.offsets[self.head] - self.content_base
+        else:
+            dead = len(self.content)
+        self.bytes += (overhead - self.overhead) * (len(self.content) - dead)
+        self.overhead = overhead
+
+    def clear(self):
+        self.capacity = STORE_CAPACITY
+        if self.max_packets is not None:
+            self.capacity = min(self.capacity, self.max_packets)
+        self.timestamps = array(TIMESTAMP_TYPECODE, [0]) * self.capacity
+        self.ipaddresses = array(IP_TYPECODE, [0]) * self.capacity
+        self.head_ids = array('H', [0]) * self.capacity
+        self.subnet_ids = array('B', [0]) * self.capacity
+        self.device_ids = array('B', [0]) * self.capacity
+        self.device_types = array('H', [0]) * self.capacity
+        self.operation_codes = array('H', [0]) * self.capacity
+        self.target_subnet_ids = array('B', [0]) * self.capacity
+        self.target_device_ids = array('B', [0]) * self.capacity
+        self.source_ids = array('H', [0]) * self.capacity
+        self.offsets = array(INDEX_TYPECODE, [0]) * self.capacity
+        self.lengths = array('H', [0]) * self.capacity
+        self.content = bytearray()
+        self.content_base = 0
+        self.head = 0
+        self.size = 0
+        self.first = self.end
+        self.bytes = 0
+        self.evicted = 0
+        self.heads = InternTable()
+        self.sources = InternTable()
+
+    def columns(self):
+        return (self.timestamps, self.ipaddresses, self.head_ids,
+                self.subnet_ids, self.device_ids, self.device_types,
+                self.operation_codes, self.target_subnet_ids,
+                self.target_device_ids, self.source_ids, self.offsets,
+                self.lengths)
+
+    def evict(self):
+        slot = self.head
+        self.head = (slot + 1) % self.capacity
+        self.size -= 1
+        self.bytes -= HEADER_SIZE + self.lengths[slot] * (1 + self.overhead)
+        self.heads.release(self.head_ids[slot])
+        self.sources.release(self.source_ids[slot])
+        self.first += 1
+        self.evicted += 1
+        # Drop the dead prefix of the content buffer once it outweighs the
+        # live part, which keeps eviction amortized O(1).
+        if self.size:
+            dead = self.offsets[self.head] - self.content_base
+        else:
+            dead = len(self.content)
+        if dead > len(self.content) - dead:
+            del self.content[:dead]
+            self.content_base += dead
+
+    def grow(self):
+        capacity = self.capacity * 2
+        if self.max_packets is not None:
+            capacity = min(capacity, self.max_packets)
+        extra = capacity - self.capacity
+        head = self.head
+        (self.timestamps, self.ipaddresses, self.head_ids, self.subnet_ids,
+         self.device_ids, self.device_types, self.operation_codes,
+         self.target_subnet_ids, self.target_device_ids, self.source_ids,
+         self.offsets, self.lengths) = [
+            column[head:] + column[:head] + array(column.typecode, [0]) * extra
+            for column in self.columns()
+        ]
+        self.head = 0
+        self.capacity = capacity
+
+    def content_of(self, seq):
+        slot = (self.head + seq - self.first) % self.capacity
+        offset = self.offsets[slot] - self.content_base
+        return bytes(self.content[offset:offset + self.lengths[slot]])
+
+    def iter_contents(self, seq, stop=None):
+        # (seq, content bytes) without rebuilding the packets
+        stop = self.end if stop is None else min(stop, self.end)
+        for seq in range(max(seq, self.first), stop):
+            yield seq, self.content_of(seq)
+
+    def iter_from(self, seq, stop=None):
+        while True:
+            seq = max(seq, self.first)
+            end = self.end if stop is None else min(stop, self.end)
+            if seq >= end:
+                return
+            timestamp, packet = self.read(
+                (self.head + seq - self.first) % self.capacity
+            )
+            yield seq, timestamp, packet
+            seq += 1
+
+    def lines(self, seq):
+        length = self.lengths[(self.head + seq - self.first) % self.capacity]
+        return max(1, (length + CONTENT_LINE - 1) // CONTENT_LINE)
+
+    def memory(self):
+        return (sum(column.itemsize * len(column)
+                    for column in self.columns()) + len(self.content))
+
+    def read(self, slot):
+        offset = self.offsets[slot] - self.content_base
+        packet = Telegram(
+            IPv4(self.ipaddresses[slot]),
+            self.heads.values[self.head_ids[slot]],
+            self.subnet_ids[slot],
+            self.device_ids[slot],
+            self.device_types[slot],
+            OperationCode(self.operation_codes[slot]),
+            self.target_subnet_ids[slot],
+            self.target_device_ids[slot],
+            Content(self.content[offset:offset + self.lengths[slot]]),
+            self.sources.values[self.source_ids[slot]],
+        )
+        return self.timestamps[slot], packet
+
+
+def main(argv=None):
+    import argparse
+
+    import hdlmiracle
+
+    from hdldecode import decoded_text
+    from hdlfile import CaptureFile, CaptureWriter, Replayer
+    from hdlfilter import compile_filter, match_all, parse_filter
+    from hdlpcap import PcapngWriter
+    from hdlsource import open_sources
+    from hdlstream import CLIENT_QUEUE, POLICIES, StreamServer
+
+    parser = argparse.ArgumentParser(
+        description='Capture HDL Buspro telegrams without the GUI.'
+    )
+    parser.add_argument('-f', '--filter', action='append', default=[],
+                        type=parse_filter, metavar='EXPR',
+                        help='show packets matching EXPR, e.g. '
+                             'subnet_id=1,operation_code=0031; a value '
+                             'can also be a range (1-5), a list (1,2,7), '
+                             'a mask (0030/fff0), a CIDR block '
+                             '(10.0.0.0/8) or negated (!0031); decoded '
+                             'content fields are keys too, e.g. '
+                             'operation_code=0031,level=50-100; separate '
+                             'alternatives with ";" or repeat -f to match '
+                             'any of several filters')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write to FILE instead of stdout')
+    parser.add_argument('-w', '--write', metavar='FILE',
+                        help='also record matching packets to the binary '
+                             'capture FILE')
+    parser.add_argument('-p', '--pcapng', metavar='FILE',
+                        help='also record matching packets to the pcapng '
+                             'FILE')
+    parser.add_argument('-c', '--count', type=int, metavar='N',
+                        help='exit after N matching packets')
+    parser.add_argument('-t', '--time', default='absolute',
+                        choices=('absolute', 'relative', 'delta'),
+                        help='timestamp column mode')
+    parser.add_argument('-r', '--replay', metavar='FILE',
+                        help='read packets from the binary capture FILE '
+                             'instead of the bus and report the throughput')
+    parser.add_argument('-s', '--speed', type=float, default=0, metavar='N',
+                        help='replay at N times the recorded speed '
+                             '(default: as fast as possible)')
+    parser.add_argument('-i', '--interface', action='append', metavar='SPEC',
+                        help='capture from ADDRESS[:PORT][%%DEVICE], '
+                             'from a capture server at tcp:HOST:PORT or '
+                             'unix:PATH, optionally followed by #EXPR for '
+                             'the server to filter on, or from "bus", '
+                             'instead of the bus alone; repeat to capture '
+                             'from several at once')
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='stream the packets captured to the clients '
+                             'connecting to tcp:HOST:PORT or unix:PATH')
+    parser.add_argument('--client-queue', type=int, default=CLIENT_QUEUE,
+                        metavar='N',
+                        help='packets queued per client before the drop '
+                             'policy applies (default: %(default)s)')
+    parser.add_argument('--policy', default=POLICIES[0], choices=POLICIES,
+                        help='what to do for a client whose queue is full, '
+                             'unless it asks otherwise: drop its oldest '
+                             'or newest packets, or disconnect it '
+                             '(default: %(default)s)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print the packets')
+    args = parser.parse_args(argv)
+
+    match = compile_filter([row for rows in args.filter for row in rows])
+    # only matching packets are queued at all
+    queue = PacketQueue(ordered=len(args.interface or ()) > 1,
+                        accept=None if match is match_all else match)
+    clock = Clock()
+
+    out = sys.stdout
+    writer = pcapng = server = sources = None
+    try:
+        if args.output:
+            out = open(args.output, 'a')
+        if args.write:
+            writer = CaptureWriter(args.write)
+        if args.pcapng:
+            pcapng = PcapngWriter(args.pcapng)
+        if args.serve:
+            server = StreamServer(args.serve, args.client_queue, args.policy)
+        if args.replay:
+            monitor = hdlmiracle.Monitor()
+            monitor.receive = lambda packet: queue.put((monotonic_ns(),
+                                                        packet))
+            replayer = Replayer(CaptureFile(args.replay), monitor,
+                                args.speed or None, pending=queue.__len__)
+        else:
+            sources = open_sources(args.interface, queue.put)
+    except (IOError, OSError, ValueError) as e:
+        # socket.error included: a file that cannot be opened or read, a
+        # bad source spec or an address already in use
+        for opened in (writer, pcapng, server):
+            if opened is not None:
+                opened.close()
+        if out is not sys.stdout:
+            out.close()
+        parser.exit(2, 'hdlcapture: {0}\n'.format(e))
+    if sources is None:
+        replayer.start()
+    else:
+        for source in sources:
+            source.attach()
+
+    matched = 0
+    origin = previous = None
+    try:
+        while args.count is None or matched < args.count:
+            if sources is None and replayer.finished is not None and not queue:
+                break
+            sleep(DRAIN_INTERVAL)
+            lines = []
+            exported = []
+            for timestamp, packet in queue.drain():
+                timestamp += clock.offset
+                if writer is not None:
+                    writer.put(timestamp, packet)
+                if pcapng is not None or server is not None:
+                    exported.append((timestamp, packet))
+                matched += 1
+                if not args.quiet:
+                    if args.time == 'absolute':
+                        now = format_time(timestamp)
+                    elif args.time == 'relative':
+                        if origin is None:
+                            origin = timestamp
+                        now = format_delta(timestamp - origin)
+                    else:
+                        now = (format_delta(timestamp - previous)
+                               if previous is not None else '')
+                        previous = timestamp
+                    lines.extend(row_lines(
+                        format_row(now, packet, bool(args.interface),
+                                   decoded_text)
+                    ))
+                if matched == args.count:
+                    break
+            if writer is not None and writer.error is not None:
+                sys.stderr.write('recording to {0} failed: {1}\n'.format(
+                    args.write, writer.error
+                ))
+                writer.close()
+                writer = None
+            if exported:
+                if pcapng is not None:
+                    pcapng.write(exported)
+                if server is not None:
+                    server.publish(exported)
+            if lines:
+                out.write('\n'.join(lines) + '\n')
+                out.flush()
+            if sources is not None:
+                # a source that stopped is reported and dropped; there is
+                # no point going on without any
+                for source in [s for s in sources if s.error is not None]:
+                    sys.stderr.write('{0}: {1}\n'.format(
+                        source.name, source.error
+                    ))
+                    source.close()
+                    sources.remove(source)
+                if not sources:
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if sources is not None:
+            for source in sources:
+                source.close()
+        else:
+            replayer.stop()
+            replayer.source.close()
+            sys.stderr.write(
+                'replayed {0} packets, {1:.0f} packets/s\n'.format(
+                    replayer.sent, replayer.rate(monotonic_ns())
+                )
+            )
+        if writer is not None:
+            writer.close()
+        if pcapng is not None:
+            pcapng.close()
+        if server is not None:
+            server.close()
+        if out is not sys.stdout:
+            out.close()
+        sys.stderr.write(
+            'received {0}, matched {1}, filtered {2}, dropped {3}\n'.format(
+                queue.received + queue.filtered, matched, queue.filtered,
+                queue.dropped
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
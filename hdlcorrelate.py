@@ -0,0 +1,156 @@
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from operator import attrgetter
+
+from hdlcapture import NANOSECONDS
+
+
+REPLY_TIMEOUT = 2 * NANOSECONDS
+MAX_PENDING = 65536
+RECENT_UNANSWERED = 100
+BROADCAST = 0xff
+
+# upper bounds of the latency histogram buckets in ns; the last one is open
+LATENCY_BOUNDS = tuple(ms * NANOSECONDS // 1000 for ms in (
+    1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000
+))
+
+ENDPOINTS = attrgetter('subnet_id', 'device_id', 'target_subnet_id',
+                       'target_device_id', 'operation_code')
+
+
+class LatencyHistogram(object):
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, latency):
+        self.counts[bisect_left(self.bounds, latency)] += 1
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def mean(self):
+        return self.total // self.count if self.count else 0
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile, or the
+        # maximum when that is lower or the bucket is the open one
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.bounds[i], self.max) \
+                    if i < len(self.bounds) else self.max
+        return 0
+
+
+class DeviceLatency(object):
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.retries = 0
+        self.unanswered = 0
+
+
+class Correlator(object):
+    # Pairs requests with replies as packets arrive. A reply comes from the
+    # target of the request, goes to its source and carries the request
+    # operation code plus one. Requests wait in an insertion ordered map
+    # keyed by (source, target, operation code), so both pairing and
+    # expiry are O(1) per packet and at most max_pending wait at a time.
+    # Any packet to a single device may be a request, but only those with
+    # an operation code that has been answered before are reported as
+    # unanswered when they time out; the others are status messages or
+    # replies to requests sent before the capture started.
+    def __init__(self, timeout=REPLY_TIMEOUT, max_pending=MAX_PENDING,
+                 recent=RECENT_UNANSWERED):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.answered = set()
+        self.devices = {}
+        self.unanswered = deque(maxlen=recent)
+        self.requests = 0
+        self.replies = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.overflows = 0
+
+    def add(self, timestamp, packet):
+        (subnet_id, device_id, target_subnet_id, target_device_id,
+         operation_code) = ENDPOINTS(packet)
+        operation_code = int(operation_code)
+        pending = self.pending
+        request = (target_subnet_id, target_device_id, subnet_id, device_id,
+                   operation_code - 1)
+        sent = pending.pop(request, None)
+        if sent is not None:
+            self.replies += 1
+            self.answered.add(operation_code - 1)
+            self.device((subnet_id, device_id)).histogram.add(
+                timestamp - sent
+            )
+            return
+        if BROADCAST in (target_subnet_id, target_device_id) or \
+                operation_code - 1 in self.answered:
+            return
+        key = (subnet_id, device_id, target_subnet_id, target_device_id,
+               operation_code)
+        if pending.pop(key, None) is not None:
+            self.retries += 1
+            self.device((target_subnet_id, target_device_id)).retries += 1
+        else:
+            self.requests += 1
+            if len(pending) >= self.max_pending:
+                self.overflows += 1
+                self.expired(*pending.popitem(last=False))
+        pending[key] = timestamp
+
+    def clear(self):
+        self.pending.clear()
+        self.answered.clear()
+        self.devices.clear()
+        self.unanswered.clear()
+        self.requests = self.replies = self.retries = 0
+        self.timeouts = self.overflows = 0
+
+    def device(self, address):
+        device = self.devices.get(address)
+        if device is None:
+            device = self.devices[address] = DeviceLatency()
+        return device
+
+    def expire(self, now):
+        pending = self.pending
+        deadline = now - self.timeout
+        while pending:
+            key = next(iter(pending))
+            if pending[key] > deadline:
+                break
+            self.expired(key, pending.pop(key))
+
+    def expired(self, key, sent):
+        operation_code = key[4]
+        if operation_code not in self.answered:
+            return
+        self.timeouts += 1
+        self.device(key[2:4]).unanswered += 1
+        self.unanswered.append((sent, key))
+
+    def report(self):
+        # [(address, DeviceLatency)], the slowest devices first
+        return sorted(self.devices.items(),
+                      key=lambda item: (item[1].histogram.percentile(95),
+                                        item[1].unanswered),
+                      reverse=True)
+
+    def update(self, batch):
+        for timestamp, packet in batch:
+            self.add(timestamp, packet)
+        if batch:
+            self.expire(batch[-1][0])
@@ -0,0 +1,147 @@
+from struct import Struct, error as StructError
+
+from hdlcapture import content_bytes
+
+
+DECODE_CACHE_SIZE = 65536
+
+RESULT_SUCCESS = 0xf8
+
+BYTE = Struct('>B')
+BYTES_2 = Struct('>BB')
+CHANNEL_CONTROL = Struct('>BBH')
+CHANNEL_RESPONSE = Struct('>BBB')
+
+# (operation code, device type or None) -> (name, decode function)
+DECODERS = {}
+# field name -> format string or function, for every field a decoder may
+# return; filters take these names as keys
+FIELD_FORMATS = {}
+
+
+def decoder(operation_codes, name, fields, device_type=None):
+    # Registers the decorated function as the decoder of the content of
+    # packets with any of operation_codes, of any device type or only of
+    # device_type, which then takes precedence. The function returns
+    # [(field name, value)] in display order: fields gives the format of
+    # every integer field it may return, which makes the field filterable.
+    # Other values (tuples) are only shown.
+    def register(decode):
+        for operation_code in operation_codes:
+            DECODERS[operation_code, device_type] = (name, decode)
+        FIELD_FORMATS.update(fields)
+        CACHE.clear()
+        return decode
+    return register
+
+
+def format_field(name, value):
+    if isinstance(value, tuple):
+        return '{0}={1}'.format(name, ','.join(map(str, value)))
+    fmt = FIELD_FORMATS.get(name, '{0}')
+    if callable(fmt):
+        return '{0}={1}'.format(name, fmt(value))
+    return '{0}={1}'.format(name, fmt.format(value))
+
+
+def payload(content):
+    if not isinstance(content, bytearray):
+        content = content_bytes(content)
+    return bytes(content)
+
+
+class DecodeCache(dict):
+    # (operation code, device type, content bytes) -> (fields dict, text),
+    # decoded on first use. A bus repeats the same few telegrams over and
+    # over, so most packets cost a dict lookup.
+    def __missing__(self, key):
+        if len(self) >= DECODE_CACHE_SIZE:
+            self.clear()
+        operation_code, device_type, data = key
+        entry = DECODERS.get((operation_code, device_type)) or \
+            DECODERS.get((operation_code, None))
+        if entry is None:
+            value = self[key] = ({}, '')
+            return value
+        name, decode = entry
+        try:
+            fields = decode(data)
+        except (IndexError, StructError, ValueError):
+            value = self[key] = ({}, '{0}: malformed'.format(name))
+            return value
+        text = ' '.join(format_field(*field) for field in fields)
+        value = self[key] = (
+            dict(field for field in fields
+                 if not isinstance(field[1], tuple)),
+            '{0}: {1}'.format(name, text) if text else name
+        )
+        return value
+
+
+CACHE = DecodeCache()
+
+
+def decoded(packet):
+    return CACHE[packet.operation_code, packet.device_type,
+                 payload(packet.content)]
+
+
+def decoded_fields(packet):
+    # {field name: value} of the content of packet, empty when there is no
+    # decoder for it
+    return decoded(packet)[0]
+
+
+def decoded_text(packet):
+    return decoded(packet)[1]
+
+
+def on_off(value):
+    return 'on' if value else 'off'
+
+
+def result(value):
+    return 'ok' if value == RESULT_SUCCESS else 'failed'
+
+
+@decoder((0x0002, 0x0003), 'Scene', (('area', '{0}'), ('scene', '{0}')))
+def scene(data):
+    area, number = BYTES_2.unpack_from(data)
+    return [('area', area), ('scene', number)]
+
+
+@decoder((0x001a, 0x001b), 'Sequence',
+         (('area', '{0}'), ('sequence', '{0}')))
+def sequence(data):
+    area, number = BYTES_2.unpack_from(data)
+    return [('area', area), ('sequence', number)]
+
+
+@decoder((0x0031,), 'Channel control',
+         (('channel', '{0}'), ('level', '{0}%'), ('time', '{0}s')))
+def channel_control(data):
+    channel, level, time = CHANNEL_CONTROL.unpack_from(data)
+    return [('channel', channel), ('level', level), ('time', time)]
+
+
+@decoder((0x0032,), 'Channel control reply',
+         (('channel', '{0}'), ('result', result), ('level', '{0}%')))
+def channel_reply(data):
+    channel, status, level = CHANNEL_RESPONSE.unpack_from(data)
+    return [('channel', channel), ('result', status), ('level', level)]
+
+
+@decoder((0x0034,), 'Channel status', (('channels', '{0}'),))
+def channel_status(data):
+    count = BYTE.unpack_from(data)[0]
+    levels = tuple(bytearray(data[1:1 + count]))
+    if len(levels) < count:
+        raise ValueError('short channel status')
+    return [('channels', count), ('levels', levels)]
+
+
+@decoder((0xe01c, 0xe01d), 'Universal switch',
+         (('switch', '{0}'), ('status', on_off)))
+def universal_switch(data):
+    switch, status = BYTES_2.unpack_from(data)
+    return [('switch', switch), ('status', status)]
@@ -0,0 +1,123 @@
+import json
+from collections import OrderedDict
+
+from hdlcapture import NANOSECONDS, monotonic_ns
+from hdlcorrelate import LATENCY_BOUNDS, LatencyHistogram
+
+
+# upper bounds of the stage time histogram buckets in ns; the last is open
+STAGE_BOUNDS = tuple(us * NANOSECONDS // 1000000 for us in (
+    10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000,
+    100000
+))
+DEPTH_BOUNDS = (0, 10, 100, 1000, 10000, 100000)
+PERCENTILES = (50, 95, 99)
+
+# The stages timed on the hot path, in the order a packet goes through them.
+# Packets from the hdlmiracle bus are decoded by hdlmiracle before the
+# monitor sees them, so decode only counts UDP sources.
+STAGES = (
+    ('decode', 'UDP decoding, per packet'),
+    ('timer', 'Tk event loop, delay of the drain timer'),
+    ('queue', 'Receive queue drain'),
+    ('stats', 'Statistics and latency'),
+    ('store', 'Store and recording'),
+    ('filter', 'Display filters'),
+    ('index', 'Content index'),
+    ('rows', 'Matched rows'),
+    ('format', 'Row formatting'),
+    ('widgets', 'Listbox updates'),
+    ('refilter', 'Re-filtering, per chunk'),
+)
+
+PROFILE_SORT = 'cumulative'
+PROFILE_TOP = 50
+
+
+def summary(histogram, scale=1):
+    # a histogram as a dict for reports, the values divided by scale
+    report = {
+        'count': histogram.count,
+        'mean': histogram.mean() / scale,
+        'max': histogram.max / scale,
+        'buckets': histogram.counts,
+    }
+    for p in PERCENTILES:
+        report['p{0}'.format(p)] = histogram.percentile(p) / scale
+    return report
+
+
+class Stage(object):
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.histogram = LatencyHistogram(STAGE_BOUNDS)
+        self.items = 0
+
+
+class Diagnostics(object):
+    # Time spent in each stage of the hot path, the receive to display lag
+    # and the depth of the receive queue. Stages are timed once per batch
+    # (per packet for decode), so add() costs a clock read and a histogram
+    # update per stage and drain, whatever the traffic.
+    def __init__(self):
+        self.clear()
+
+    def add(self, name, start, items=1):
+        # Counts the time since start for stage name and returns the time
+        # now, which starts the next stage.
+        now = monotonic_ns()
+        stage = self.stages[name]
+        stage.histogram.add(max(now - start, 0))
+        stage.items += items
+        return now
+
+    def clear(self):
+        self.stages = OrderedDict((name, Stage(name, text))
+                                  for name, text in STAGES)
+        self.lag = LatencyHistogram(LATENCY_BOUNDS)
+        self.depth = LatencyHistogram(DEPTH_BOUNDS)
+        self.started = monotonic_ns()
+
+    def dump(self, path, now, timestamp):
+        # appends the report as a JSON line; the file is reopened every
+        # time so that nothing is lost if the monitor is killed
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.report(now, timestamp),
+                               sort_keys=True) + '\n')
+
+    def report(self, now, timestamp):
+        # times in microseconds, the lag in milliseconds
+        us = NANOSECONDS // 1000000
+        stages = OrderedDict()
+        for name, stage in self.stages.items():
+            stages[name] = summary(stage.histogram, float(us))
+            stages[name]['items'] = stage.items
+        return {
+            'timestamp': timestamp,
+            'elapsed': float(now - self.started) / NANOSECONDS,
+            'stages': stages,
+            'lag': summary(self.lag, float(NANOSECONDS // 1000)),
+            'depth': summary(self.depth),
+        }
+
+
+class Profiler(object):
+    # cProfile of the GUI thread until stop(), which writes the statistics
+    # to path: as text, the PROFILE_TOP most expensive functions, if path
+    # ends with .txt, otherwise in the binary format of pstats.
+    def __init__(self, path):
+        import cProfile
+        self.path = path
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        if not self.path.lower().endswith('.txt'):
+            self.profile.dump_stats(self.path)
+            return
+        import pstats
+        with open(self.path, 'w') as f:
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats(PROFILE_SORT).print_stats(PROFILE_TOP)
@@ -0,0 +1,173 @@
+import json
+import threading
+from binascii import hexlify
+from collections import deque
+from datetime import datetime
+from os.path import splitext
+
+from hdlcapture import (NANOSECONDS, format_row, format_time, native_str,
+                        row_lines)
+from hdlpcap import PcapngWriter
+
+
+EXPORT_BUFFER = 1 << 20
+EXPORT_INTERVAL = 0.05
+
+EXPORT_FORMATS = {
+    '.csv': 'csv',
+    '.json': 'jsonl',
+    '.jsonl': 'jsonl',
+    '.pcapng': 'pcapng',
+}
+
+COLUMNS = ('ipaddress', 'head', 'subnet_id', 'device_id', 'device_type',
+           'operation_code', 'target_subnet_id', 'target_device_id')
+
+
+def export_format(path):
+    # by extension; anything unknown is exported as text
+    return EXPORT_FORMATS.get(splitext(path)[1].lower(), 'text')
+
+
+def format_datetime(timestamp):
+    seconds, nanoseconds = divmod(int(timestamp), NANOSECONDS)
+    now = datetime.fromtimestamp(seconds)
+    return '{0:%Y-%m-%d %H:%M:%S}.{1:06d}'.format(now, nanoseconds // 1000)
+
+
+def csv_field(value):
+    value = str(value)
+    if any(c in value for c in ',"\r\n'):
+        return '"{0}"'.format(value.replace('"', '""'))
+    return value
+
+
+def fields(packet):
+    return [str(packet.ipaddress), packet.head, packet.subnet_id,
+            packet.device_id, packet.device_type,
+            format(packet.operation_code, '04x'), packet.target_subnet_id,
+            packet.target_device_id]
+
+
+def hex_content(packet):
+    return native_str(hexlify(bytes(packet.content)))
+
+
+# Formatters turn a batch of (timestamp, packet) into lines, one at a time;
+# decode, if given, returns the decoded content of a packet as text.
+
+def text_lines(items, source, decode=None):
+    # the rows as the table shows them and copy puts them on the clipboard
+    for timestamp, packet in items:
+        for line in row_lines(format_row(format_time(timestamp), packet,
+                                         source, decode)):
+            yield line + '\n'
+
+
+def csv_lines(items, source, decode=None):
+    for timestamp, packet in items:
+        row = [format_datetime(timestamp)] + fields(packet)
+        if source:
+            row.append(packet.source)
+        if decode is not None:
+            row.append(decode(packet))
+        row.append(hex_content(packet))
+        yield ','.join(csv_field(value) for value in row) + '\n'
+
+
+def csv_header(source, decode=None):
+    return ','.join(('time',) + COLUMNS + (('source',) if source else ()) +
+                    (('decoded',) if decode is not None else ()) +
+                    ('content',)) + '\n'
+
+
+def jsonl_lines(items, source, decode=None):
+    for timestamp, packet in items:
+        record = dict(zip(COLUMNS, fields(packet)))
+        record['timestamp'] = int(timestamp)
+        record['time'] = format_datetime(timestamp)
+        record['content'] = hex_content(packet)
+        if source:
+            record['source'] = packet.source
+        if decode is not None:
+            record['decoded'] = decode(packet)
+        yield json.dumps(record, sort_keys=True) + '\n'
+
+
+FORMATTERS = {
+    'csv': csv_lines,
+    'jsonl': jsonl_lines,
+    'text': text_lines,
+}
+
+
+class Exporter(object):
+    # put() queues batches of (timestamp, packet) read by the GUI thread; a
+    # background thread formats them and writes them through a buffered
+    # file, so neither formatting nor disk I/O holds up the GUI. close()
+    # returns at once; done is set once everything queued is written.
+    def __init__(self, path, total, source=False, decode=None):
+        self.path = path
+        self.total = total
+        self.source = source
+        self.decode = decode
+        self.kind = export_format(path)
+        if self.kind == 'pcapng':
+            self.file = PcapngWriter(path)
+        else:
+            self.file = open(path, 'w', EXPORT_BUFFER)
+            if self.kind == 'csv':
+                self.file.write(csv_header(source, decode))
+        self.items = deque()
+        self.written = 0
+        # rows the caller found evicted before it read them
+        self.evicted = 0
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.done = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        # batches not written yet
+        return len(self.items)
+
+    def close(self):
+        self.closing = True
+        self.wakeup.set()
+
+    def put(self, batch):
+        self.items.append(batch)
+        self.wakeup.set()
+
+    def run(self):
+        try:
+            items = self.items
+            while True:
+                self.wakeup.wait(EXPORT_INTERVAL)
+                self.wakeup.clear()
+                closing = self.closing
+                while items:
+                    batch = items.popleft()
+                    if self.kind == 'pcapng':
+                        self.file.write(batch)
+                    else:
+                        self.file.writelines(FORMATTERS[self.kind](
+                            batch, self.source, self.decode
+                        ))
+                    self.written += len(batch)
+                if closing:
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                # flushes what is left, which can fail as well
+                self.file.close()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.done = True
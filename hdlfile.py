@@ -0,0 +1,334 @@
+import mmap
+import threading
+from array import array
+from bisect import bisect_right
+from collections import deque
+from struct import Struct
+from time import sleep
+
+from hdlcapture import (CONTENT_LINE, CONTENT_OFFSET, CRC_SIZE,
+                        HEADER_SIZE, INDEX_TYPECODE, NANOSECONDS,
+                        decode_packet, encode_packet, monotonic_ns,
+                        native_str)
+
+
+# File layout: MAGIC, then a stream of blocks. A record block is
+# RECORD (kind, timestamp in ns, payload length) followed by the UDP
+# payload of one telegram; in a SOURCE_KIND record the payload starts with
+# the length and the name of the source the telegram came from. Every
+# INDEX_INTERVAL records, and on close, an index block follows:
+# INDEX_MARKER, INDEX (own offset, offset of the previous index block or
+# 0, number of the first record covered, count) and count record offsets.
+# A reader finds the last index block from the end of the file and walks
+# the chain backwards, so opening a capture never parses the records
+# themselves.
+MAGIC = b'HDLCAP\x00\x01'
+RECORD = Struct('<BqH')
+RECORD_KIND = 1
+SOURCE_KIND = 3
+RECORD_KINDS = (RECORD_KIND, SOURCE_KIND)
+INDEX_MARKER = b'\x02HDLIDX\xff'
+INDEX = Struct('<QQQL')
+OFFSET = Struct('<Q')
+SOURCE = Struct('<B')
+
+INDEX_INTERVAL = 4096
+WRITE_BUFFER = 1 << 20
+WRITE_INTERVAL = 0.2
+
+REPLAY_BACKLOG = 10000
+REPLAY_POLL = 0.001
+
+
+class CaptureWriter(object):
+    # put() only queues the packet; a background thread encodes the queued
+    # packets and writes them with one write() per batch.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb', WRITE_BUFFER)
+        self.file.write(MAGIC)
+        self.position = len(MAGIC)
+        self.offsets = []
+        self.records = 0
+        self.previous = 0
+        self.items = deque()
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return self.records + len(self.items)
+
+    def close(self):
+        self.closing = True
+        self.wakeup.set()
+        self.thread.join()
+        self.file.close()
+
+    def index_block(self):
+        block = (INDEX_MARKER +
+                 INDEX.pack(self.position, self.previous,
+                            self.records - len(self.offsets),
+                            len(self.offsets)) +
+                 b''.join(OFFSET.pack(offset) for offset in self.offsets))
+        self.previous = self.position
+        self.position += len(block)
+        self.offsets = []
+        return block
+
+    def put(self, timestamp, packet):
+        self.items.append((timestamp, packet))
+
+    def run(self):
+        try:
+            while True:
+                self.wakeup.wait(WRITE_INTERVAL)
+                self.wakeup.clear()
+                closing = self.closing
+                self.write()
+                if closing:
+                    if self.offsets:
+                        self.file.write(self.index_block())
+                    self.file.flush()
+                    return
+        except Exception as e:
+            # read by the caller, which stops recording
+            self.error = e
+            try:
+                self.file.close()
+            except (IOError, OSError):
+                pass
+
+    def write(self):
+        items = self.items
+        chunks = []
+        for _ in range(len(items)):
+            timestamp, packet = items.popleft()
+            payload = encode_packet(packet)
+            source = getattr(packet, 'source', '')
+            if source:
+                if not isinstance(source, bytes):
+                    source = source.encode('latin-1', 'replace')
+                source = source[:255]
+                payload = SOURCE.pack(len(source)) + source + payload
+                kind = SOURCE_KIND
+            else:
+                kind = RECORD_KIND
+            chunks.append(RECORD.pack(kind, int(timestamp), len(payload)))
+            chunks.append(payload)
+            self.offsets.append(self.position)
+            self.position += RECORD.size + len(payload)
+            self.records += 1
+            if len(self.offsets) >= INDEX_INTERVAL:
+                chunks.append(self.index_block())
+        if chunks:
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+
+
+class CaptureFile(object):
+    # Read-only view of a capture file with the reading interface of
+    # CaptureStore, so the GUI can page it into the table directly.
+    evicted = 0
+    first = 0
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            # mmap refuses empty files
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError('{0} is not a capture file'.format(path))
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('{0} is not a capture file'.format(path))
+        self.chunks = []
+        self.starts = []
+        tail = self.read_index()
+        self.tail = array(INDEX_TYPECODE)
+        self.tail_start = self.starts[-1] + self.chunks[-1][1] \
+            if self.chunks else 0
+        size = len(self.map)
+        while tail + RECORD.size <= size:
+            kind, _, length = RECORD.unpack_from(self.map, tail)
+            if kind not in RECORD_KINDS:
+                # index block left behind by an interrupted writer
+                if (self.map[tail:tail + len(INDEX_MARKER)] != INDEX_MARKER or
+                        tail + len(INDEX_MARKER) + INDEX.size > size):
+                    break
+                count = INDEX.unpack_from(self.map,
+                                          tail + len(INDEX_MARKER))[3]
+                tail += len(INDEX_MARKER) + INDEX.size + count * OFFSET.size
+                continue
+            if tail + RECORD.size + length > size:
+                break
+            self.tail.append(tail)
+            tail += RECORD.size + length
+        self.end = self.tail_start + len(self.tail)
+
+    def __getitem__(self, seq):
+        return self.read(self.offset(seq))
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def __len__(self):
+        return self.end
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def content_of(self, seq):
+        offset = self.offset(seq)
+        kind, _, length = RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        end = start + length
+        if kind == SOURCE_KIND:
+            start += SOURCE.size + SOURCE.unpack_from(self.map, start)[0]
+        return self.map[start + CONTENT_OFFSET:end - CRC_SIZE]
+
+    def iter_contents(self, seq, stop=None):
+        stop = self.end if stop is None else min(stop, self.end)
+        for seq in range(max(seq, 0), stop):
+            yield seq, self.content_of(seq)
+
+    def iter_from(self, seq, stop=None):
+        stop = self.end if stop is None else min(stop, self.end)
+        for seq in range(max(seq, 0), stop):
+            timestamp, packet = self.read(self.offset(seq))
+            yield seq, timestamp, packet
+
+    def lines(self, seq):
+        offset = self.offset(seq)
+        kind, _, length = RECORD.unpack_from(self.map, offset)
+        length -= HEADER_SIZE
+        if kind == SOURCE_KIND:
+            length -= SOURCE.size + SOURCE.unpack_from(
+                self.map, offset + RECORD.size
+            )[0]
+        return max(1, (length + CONTENT_LINE - 1) // CONTENT_LINE)
+
+    def offset(self, seq):
+        if not 0 <= seq < self.end:
+            raise IndexError('packet {0} is not stored'.format(seq))
+        if seq >= self.tail_start:
+            return self.tail[seq - self.tail_start]
+        i = bisect_right(self.starts, seq) - 1
+        position, _ = self.chunks[i]
+        return OFFSET.unpack_from(
+            self.map, position + (seq - self.starts[i]) * OFFSET.size
+        )[0]
+
+    def read(self, offset):
+        kind, timestamp, length = RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        end = start + length
+        source = ''
+        if kind == SOURCE_KIND:
+            size = SOURCE.unpack_from(self.map, start)[0]
+            start += SOURCE.size
+            source = native_str(self.map[start:start + size])
+            start += size
+        return timestamp, decode_packet(self.map[start:end], source=source)
+
+    def read_index(self):
+        # Returns the offset right after the last index block (or after the
+        # magic when there is none), filling self.chunks with
+        # (position of the offsets, count) and self.starts with the first
+        # record number of each chunk.
+        position = len(self.map)
+        while True:
+            position = self.map.rfind(INDEX_MARKER, len(MAGIC), position)
+            if position < 0:
+                return len(MAGIC)
+            header = position + len(INDEX_MARKER)
+            if header + INDEX.size <= len(self.map):
+                own, previous, first, count = INDEX.unpack_from(self.map,
+                                                                header)
+                end = header + INDEX.size + count * OFFSET.size
+                if own == position and end <= len(self.map):
+                    break
+        tail = end
+        chunks = []
+        while True:
+            chunks.append((first, header + INDEX.size, count))
+            if not previous:
+                break
+            position = previous
+            header = position + len(INDEX_MARKER)
+            _, previous, first, count = INDEX.unpack_from(self.map, header)
+        chunks.reverse()
+        self.starts = [first for first, _, _ in chunks]
+        self.chunks = [(position, count) for _, position, count in chunks]
+        return tail
+
+
+class Replayer(object):
+    # Feeds the packets of a capture to monitor.receive from a thread of its
+    # own, the way the bus receiver thread does. speed scales the recorded
+    # gaps (1 is real time); with no speed packets are sent as fast as the
+    # consumer takes them: while pending() reports more than backlog queued
+    # packets the replayer waits, so nothing is dropped and the elapsed
+    # time measures the throughput of the consumer.
+    def __init__(self, source, monitor, speed=None, pending=None,
+                 backlog=REPLAY_BACKLOG):
+        self.source = source
+        self.monitor = monitor
+        self.speed = speed
+        self.pending = pending
+        self.backlog = backlog
+        self.sent = 0
+        self.started = None
+        self.finished = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def rate(self, now=None):
+        if self.started is None:
+            return 0.0
+        if now is None:
+            now = self.finished if self.finished is not None \
+                else monotonic_ns()
+        elapsed = float(now - self.started) / NANOSECONDS
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def run(self):
+        self.started = start = monotonic_ns()
+        origin = None
+        try:
+            for _, timestamp, packet in self.source.iter_from(
+                    self.source.first):
+                if self.stopped.is_set():
+                    break
+                if self.speed:
+                    if origin is None:
+                        origin = timestamp
+                    delay = (start + (timestamp - origin) / self.speed -
+                             monotonic_ns()) / float(NANOSECONDS)
+                    if delay > REPLAY_POLL:
+                        self.stopped.wait(delay)
+                elif self.pending is not None:
+                    while self.pending() > self.backlog:
+                        if self.stopped.is_set():
+                            break
+                        sleep(REPLAY_POLL)
+                self.monitor.receive(packet)
+                self.sent += 1
+        finally:
+            self.finished = monotonic_ns()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
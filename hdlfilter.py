@@ -0,0 +1,554 @@
+import re
+from binascii import hexlify, unhexlify
+from operator import attrgetter
+
+from hdlcapture import FIELDS, IPv4, integer_type
+from hdldecode import FIELD_FORMATS, decoded_fields
+
+
+# Fields ordered from the most to the least selective on a typical bus:
+# checks run in this order so that a row is rejected as early as possible.
+SELECTIVITY = (
+    'operation_code',
+    'device_id',
+    'target_device_id',
+    'ipaddress',
+    'device_type',
+    'subnet_id',
+    'target_subnet_id',
+    'head',
+    'source',
+    'decoded',
+)
+
+# the packet fields, then the decoded content fields as one condition
+FILTER_KEYS = FIELDS + ('decoded',)
+
+# Field groups a filter can be indexed on, in order of preference.
+INDEX_KEYS = (
+    ('operation_code',),
+    ('subnet_id', 'device_id'),
+    ('target_subnet_id', 'target_device_id'),
+    ('device_id',),
+    ('target_device_id',),
+    ('ipaddress',),
+)
+
+INDEX_MIN_ROWS = 8
+
+# base, minimum, maximum of the numeric fields, as in the GUI filter row
+LIMITS = {
+    'subnet_id': (10, 0, 255),
+    'device_id': (10, 0, 255),
+    'device_type': (10, 0, 65535),
+    'operation_code': (16, 0, 0xffff),
+    'target_subnet_id': (10, 0, 255),
+    'target_device_id': (10, 0, 255),
+}
+DECODED_LIMITS = (10, 0, 0xffffffff)
+
+BITS = [tuple(bit for bit in range(8) if byte >> bit & 1)
+        for byte in range(256)]
+
+NONZERO = re.compile(b'[^\x00]')
+
+# splits 'subnet_id=1,device_id=1,2,3' before each key, not within a set
+TERMS = re.compile(r',\s*(?=\w+\s*=)')
+
+STRING_KEYS = ('head', 'source')
+
+try:
+    int.from_bytes
+
+    def to_int(data):
+        return int.from_bytes(bytes(data), 'little')
+
+    def from_int(value, size):
+        return value.to_bytes(size, 'little')
+except AttributeError:
+    def to_int(data):
+        return int(hexlify(bytes(data[::-1])) or b'0', 16)
+
+    def from_int(value, size):
+        return unhexlify('{0:0{1}x}'.format(value, size * 2))[::-1]
+
+
+def match_all(_):
+    return True
+
+
+def address(ipaddress):
+    if isinstance(ipaddress, integer_type):
+        return ipaddress
+    return IPv4.parse(str(ipaddress))
+
+
+def constant_namer(constants):
+    # returns a function adding a value to constants under a new name, as
+    # the generated source refers to it
+    def constant(value):
+        name = 'c{0}'.format(len(constants))
+        constants[name] = value
+        return name
+    return constant
+
+
+class Predicate(object):
+    # A condition on one field other than equality: any of a set of values,
+    # ranges (low, high) and masked values (value, mask), possibly negated.
+    # Compiled into the Python source of a test, see compile_row.
+    def __init__(self, text, negate, values, ranges, masks):
+        self.text = text
+        self.negate = negate
+        self.values = frozenset(values)
+        self.ranges = tuple(ranges)
+        self.masks = tuple(masks)
+
+    def __eq__(self, other):
+        return isinstance(other, Predicate) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return self.text
+
+    def key(self):
+        return self.negate, self.values, self.ranges, self.masks
+
+    def source(self, field, constant):
+        terms = []
+        if len(self.values) == 1:
+            terms.append('{0} == {1}'.format(field,
+                                             constant(min(self.values))))
+        elif self.values:
+            terms.append('{0} in {1}'.format(field, constant(self.values)))
+        for low, high in self.ranges:
+            terms.append('{0} <= {1} <= {2}'.format(constant(low), field,
+                                                    constant(high)))
+        for value, mask in self.masks:
+            terms.append('({0} & {1}) == {2}'.format(field, constant(mask),
+                                                     constant(value)))
+        return '{0}({1})'.format('not ' if self.negate else '',
+                                 ' or '.join(terms))
+
+
+class DecodedCondition(object):
+    # Conditions on the decoded content fields of a packet, see hdldecode;
+    # all of them have to hold, so a packet without one of the fields does
+    # not match.
+    def __init__(self, text, conditions):
+        self.text = text
+        self.conditions = tuple(conditions)
+
+    def __eq__(self, other):
+        return (isinstance(other, DecodedCondition) and
+                self.conditions == other.conditions)
+
+    def __hash__(self):
+        return hash(self.conditions)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return self.text
+
+    def compile(self):
+        # a function of the fields dict of a packet
+        constants = {}
+        constant = constant_namer(constants)
+        terms = []
+        for name, value in self.conditions:
+            field = 'fields[{0!r}]'.format(name)
+            if isinstance(value, Predicate):
+                test = value.source(field, constant)
+            else:
+                test = '{0} == {1}'.format(field, constant(value))
+            terms.append('{0!r} in fields and {1}'.format(name, test))
+        return generate('def match(fields):\n    return {0}\n'.format(
+            ' and '.join(terms)
+        ), constants)
+
+
+def parse_number(key, text):
+    if key == 'ipaddress':
+        return IPv4.parse(text)
+    base, minimum, maximum = LIMITS.get(key, DECODED_LIMITS)
+    value = int(text, base)
+    if not minimum <= value <= maximum:
+        raise ValueError('{0} not in range {1}..{2}'.format(key, minimum,
+                                                            maximum))
+    return value
+
+
+def parse_mask(key, text):
+    if key == 'ipaddress':
+        prefix = int(text)
+        if not 0 <= prefix <= 32:
+            raise ValueError('bad prefix length {0}'.format(text))
+        return 0xffffffff << (32 - prefix) & 0xffffffff
+    return parse_number(key, text)
+
+
+def parse_value(key, text):
+    # An exact value, or a Predicate for the other forms a field takes:
+    #   !VALUE         anything but VALUE; ! negates any of the forms below
+    #   A,B,C          any of the values listed
+    #   LOW-HIGH       a range, both ends included
+    #   VALUE/MASK     the bits set in MASK equal those of VALUE; for the IP
+    #                  address, ADDRESS/PREFIX LENGTH (CIDR)
+    # Items of a set can be ranges or masks as well; head and source take
+    # lists of names only. The decoded key takes decoded field conditions,
+    # see parse_decoded.
+    text = text.strip()
+    if key == 'decoded':
+        return parse_decoded(text)
+    negate = text.startswith('!')
+    items = [item.strip() for item in text[negate:].split(',')]
+    if key in STRING_KEYS:
+        if not all(items):
+            raise ValueError('empty {0} in {1!r}'.format(key, text))
+        if negate or len(items) > 1:
+            return Predicate(text, negate, items, (), ())
+        return text
+    if not negate and len(items) == 1 and not re.search('[-/]', text):
+        value = parse_number(key, text)
+        return text if key == 'ipaddress' else value
+    values = []
+    ranges = []
+    masks = []
+    for item in items:
+        low, sep, high = item.partition('-')
+        if sep:
+            low = parse_number(key, low.strip())
+            high = parse_number(key, high.strip())
+            if low > high:
+                raise ValueError('empty range {0!r}'.format(item))
+            ranges.append((low, high))
+            continue
+        value, sep, mask = item.partition('/')
+        if sep:
+            mask = parse_mask(key, mask.strip())
+            masks.append((parse_number(key, value.strip()) & mask, mask))
+        else:
+            values.append(parse_number(key, item))
+    return Predicate(text, negate, values, ranges, masks)
+
+
+def parse_decoded(text):
+    # 'channel=1,level=50-100' -> a DecodedCondition, the fields taking
+    # the values parse_value takes for numbers
+    conditions = []
+    for term in TERMS.split(text):
+        name, sep, value = term.partition('=')
+        name = name.strip()
+        if name not in FIELD_FORMATS or not sep:
+            raise ValueError('bad decoded field term {0!r}'.format(term))
+        conditions.append((name, parse_value(name, value.strip())))
+    return DecodedCondition(text.strip(),
+                            sorted(conditions, key=lambda c: c[0]))
+
+
+def parse_conditions(expression):
+    # 'subnet_id=1,operation_code=0031' -> one filter row in the
+    # (key, value) form Filter.validate produces. Decoded content fields
+    # can be given as keys of their own, 'operation_code=0031,level=0'.
+    values = dict.fromkeys(FILTER_KEYS)
+    decoded = []
+    for term in TERMS.split(expression):
+        key, sep, text = term.partition('=')
+        key = key.strip()
+        if key == 'decoded' and sep:
+            decoded.append(text.strip())
+            continue
+        if key in FIELD_FORMATS and key not in values:
+            decoded.append(term.strip())
+            continue
+        if key not in values or not sep:
+            raise ValueError('bad filter term {0!r}'.format(term))
+        values[key] = parse_value(key, text.strip())
+    if decoded:
+        values['decoded'] = parse_decoded(','.join(decoded))
+    return [(key, values[key]) for key in FILTER_KEYS]
+
+
+def parse_filter(expression):
+    # 'device_id=1-9;operation_code=!e3e7' -> the rows of a whole filter,
+    # one per ';' separated alternative
+    return [parse_conditions(row) for row in expression.split(';')
+            if row.strip()]
+
+
+def normalize(key, value):
+    if key in ('ipaddress', 'head', 'source'):
+        return str(value)
+    return int(value)
+
+
+def row_key(conditions):
+    return tuple(sorted((key, value) for key, value in conditions
+                        if value is not None))
+
+
+def exact(conditions):
+    return dict((key, value) for key, value in conditions
+                if not isinstance(value, (Predicate, DecodedCondition)))
+
+
+def row_source(conditions, constants):
+    # Python source of an expression testing a packet against one filter
+    # row, most selective field first; the values it refers to are added
+    # to constants.
+    constant = constant_namer(constants)
+    terms = []
+    for key, value in sorted(conditions,
+                             key=lambda c: SELECTIVITY.index(c[0])):
+        if key == 'decoded':
+            terms.append('{0}(decoded_fields(packet))'.format(
+                constant(value.compile())
+            ))
+            continue
+        field = 'packet.' + key
+        if key == 'ipaddress':
+            field = 'address({0})'.format(field)
+            if not isinstance(value, Predicate):
+                value = IPv4.parse(value)
+        if isinstance(value, Predicate):
+            terms.append(value.source(field, constant))
+        else:
+            terms.append('{0} == {1}'.format(field, constant(value)))
+    return ' and '.join(terms) or 'True'
+
+
+def generate(source, constants):
+    # Compiles source, the definition of match, into a function; a row
+    # costs one expression instead of a call per field.
+    namespace = dict(constants, address=address,
+                     decoded_fields=decoded_fields)
+    exec(source, namespace)
+    return namespace['match']
+
+
+def compile_row(conditions):
+    if not conditions:
+        return match_all
+    constants = {}
+    return generate('def match(packet):\n    return {0}\n'.format(
+        row_source(conditions, constants)
+    ), constants)
+
+
+def choose_index(rows):
+    if len(rows) < INDEX_MIN_ROWS:
+        return None
+    covered = [
+        sum(all(key in exact(row) for key in keys) for row in rows)
+        for keys in INDEX_KEYS
+    ]
+    best = max(covered)
+    if best > len(rows) // 2:
+        return INDEX_KEYS[covered.index(best)]
+
+
+def split_index(rows, keys):
+    # Returns {key value: [(row number, check)]} for the rows that constrain
+    # every index field and [(row number, check)] for the rest, plus a
+    # function extracting the key value from a packet.
+    index = {}
+    rest = []
+    for i, conditions in enumerate(rows):
+        values = exact(conditions)
+        if all(key in values for key in keys):
+            key = tuple(normalize(k, values[k]) for k in keys)
+            index.setdefault(key, []).append(
+                (i, compile_row([c for c in conditions if c[0] not in keys]))
+            )
+        else:
+            rest.append((i, compile_row(conditions)))
+    getter = attrgetter(*keys)
+
+    def key_of_one(packet):
+        return (normalize(keys[0], getter(packet)),)
+
+    def key_of_many(packet):
+        return tuple(normalize(k, v) for k, v in zip(keys, getter(packet)))
+
+    return index, rest, key_of_one if len(keys) == 1 else key_of_many
+
+
+def active_rows(conditions_list):
+    rows = []
+    for conditions in conditions_list:
+        conditions = [(key, value) for key, value in conditions
+                      if value is not None]
+        if not conditions:
+            return None
+        rows.append(conditions)
+    return rows
+
+
+def compile_filter(conditions_list):
+    rows = active_rows(conditions_list)
+    if not rows:
+        return match_all
+
+    keys = choose_index(rows)
+    if keys:
+        index, rest, key_of = split_index(rows, keys)
+
+        def match(packet):
+            for _, check in index.get(key_of(packet), ()):
+                if check(packet):
+                    return True
+            for _, check in rest:
+                if check(packet):
+                    return True
+            return False
+
+        return match
+
+    constants = {}
+    return generate('def match(packet):\n    return {0}\n'.format(
+        ' or '.join('({0})'.format(row_source(row, constants))
+                    for row in rows)
+    ), constants)
+
+
+def compile_rows(rows):
+    # Like compile_filter, but the matcher returns the numbers of all the
+    # rows a packet matches.
+    keys = choose_index(rows)
+    if keys:
+        index, rest, key_of = split_index(rows, keys)
+
+        def match(packet):
+            matched = [i for i, check in index.get(key_of(packet), ())
+                       if check(packet)]
+            matched.extend(i for i, check in rest if check(packet))
+            return matched
+
+        return match
+
+    constants = {}
+    source = ['def match(packet):', '    matched = []']
+    for i, row in enumerate(rows):
+        source.append('    if {0}:'.format(row_source(row, constants)))
+        source.append('        matched.append({0})'.format(i))
+    source.append('    return matched\n')
+    return generate('\n'.join(source), constants)
+
+
+class Bitmap(object):
+    def __init__(self, conditions, end):
+        self.conditions = conditions
+        self.bits = bytearray()
+        self.end = end
+
+
+class MatchCache(object):
+    # Keeps one match bitmap per filter row over the capture store. All
+    # bitmaps share the sequence number of their first bit, self.base, and
+    # each one knows up to which sequence number it has been computed, so
+    # rows that did not change survive re-applying filters untouched.
+    def __init__(self):
+        self.base = 0
+        self.bitmaps = {}
+        self.keys = []
+        self.matchers = {}
+
+    def clear(self, first):
+        self.base = first
+        for bitmap in self.bitmaps.values():
+            bitmap.bits = bytearray()
+            bitmap.end = first
+
+    def configure(self, conditions_list):
+        rows = active_rows(conditions_list)
+        keys = []
+        bitmaps = {}
+        for conditions in rows or ():
+            key = row_key(conditions)
+            if key not in bitmaps:
+                keys.append(key)
+                bitmaps[key] = self.bitmaps.get(key) or Bitmap(conditions,
+                                                               self.base)
+        self.keys = keys
+        self.bitmaps = bitmaps
+        self.matchers = {}
+
+    def behind(self, stop):
+        return [key for key in self.keys if self.bitmaps[key].end < stop]
+
+    def matcher(self, keys):
+        try:
+            return self.matchers[keys]
+        except KeyError:
+            matcher = self.matchers[keys] = compile_rows(
+                [self.bitmaps[key].conditions for key in keys]
+            )
+            return matcher
+
+    def matches(self, start, stop):
+        if not self.keys:
+            return list(range(start, stop))
+        lo = (start - self.base) >> 3
+        hi = (stop - self.base + 7) >> 3
+        value = 0
+        for key in self.keys:
+            value |= to_int(self.bitmaps[key].bits[lo:hi])
+        if not value:
+            return []
+        data = from_int(value, hi - lo)
+        offset = self.base + (lo << 3)
+        matches = []
+        for m in NONZERO.finditer(data):
+            position = offset + (m.start() << 3)
+            for bit in BITS[ord(m.group())]:
+                seq = position + bit
+                if start <= seq < stop:
+                    matches.append(seq)
+        return matches
+
+    def trim(self, first):
+        dead = (first - self.base) >> 3
+        if not self.keys:
+            self.base = first
+        elif dead > 4096 and dead > len(self.bitmaps[self.keys[0]].bits) // 2:
+            for bitmap in self.bitmaps.values():
+                del bitmap.bits[:dead]
+            self.base += dead << 3
+
+    def update(self, items, stop):
+        # Brings every row up to stop from items, an iterable of
+        # (seq, packet) that has to start at the lowest row end.
+        groups = {}
+        for key in self.behind(stop):
+            groups.setdefault(self.bitmaps[key].end, []).append(key)
+        if not groups:
+            return
+        if len(groups) > 1:
+            items = list(items)
+        size = (stop - self.base + 7) >> 3
+        for end, keys in groups.items():
+            keys = tuple(keys)
+            bitmaps = [self.bitmaps[key] for key in keys]
+            for bitmap in bitmaps:
+                bitmap.bits.extend(bytearray(size - len(bitmap.bits)))
+            match = self.matcher(keys)
+            base = self.base
+            for seq, packet in items:
+                if seq < end:
+                    continue
+                matched = match(packet)
+                if matched:
+                    i = seq - base
+                    byte = i >> 3
+                    bit = 1 << (i & 7)
+                    for row in matched:
+                        bitmaps[row].bits[byte] |= bit
+            for bitmap in bitmaps:
+                bitmap.end = stop
@@ -1,24 +1,96 @@
-from datetime import datetime
-from itertools import cycle
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import chain, islice
 from os import linesep
+from os.path import basename
 
 try:
     import Tkinter as tk
+    import tkFileDialog as filedialog
     import ttk
 except ImportError:
     import tkinter as tk
-    from tkinter import ttk
+    from tkinter import filedialog, ttk
 
 import hdlmiracle
 
+from hdlcapture import (INDEX_TYPECODE, NANOSECONDS, STORE_MAX_PACKETS,
+                        CaptureStore, Clock, PacketQueue, RowCache,
+                        format_delta, format_row, format_time, monotonic_ns,
+                        row_lines)
+from hdlcorrelate import LATENCY_BOUNDS, Correlator
+from hdldecode import decoded_text
+from hdlfile import CaptureFile, CaptureWriter, Replayer
+from hdlfilter import (MatchCache, Predicate, compile_filter, match_all,
+                       parse_decoded, parse_filter, parse_value)
+from hdlsearch import POSTING_SIZE, ContentIndex, Search
+from hdlsource import open_sources
+from hdlstats import STATS_TOP, STATS_WINDOWS, TrafficStats
+
+# hdldiag, hdlexport and hdlpcap are imported when first used, which keeps
+# them and what they import out of the startup time
 
 __version__ = '0.3.2'
 
 TITLE = 'HDL Buspro Monitor ({0})'.format(__version__)
 
+TIME_MODES = ('Absolute', 'Relative', 'Delta')
+
+CAPTURE_FILETYPES = (('HDL capture', '*.hdl'), ('All files', '*'))
+OPEN_FILETYPES = (('Captures', '*.hdl *.pcap *.pcapng *.cap'),
+                  ('HDL capture', '*.hdl'),
+                  ('pcap', '*.pcap *.pcapng *.cap'),
+                  ('All files', '*'))
+PROFILE_FILETYPES = (('Profile report', '*.txt'),
+                     ('pstats', '*.prof'),
+                     ('All files', '*'))
+DUMP_FILETYPES = (('JSON Lines', '*.jsonl'), ('All files', '*'))
+EXPORT_FILETYPES = (('Text', '*.txt'),
+                    ('CSV', '*.csv'),
+                    ('JSON Lines', '*.jsonl'),
+                    ('pcapng', '*.pcapng'),
+                    ('All files', '*'))
+
+REPLAY_SPEEDS = (('1x', 1), ('10x', 10), ('100x', 100), ('Max', None))
+
+DRAIN_INTERVAL = 50
+DRAIN_BUDGET = 2000
+REFILTER_CHUNK = 5000
+IMPORT_CHUNK = 20000
+EXPORT_CHUNK = 5000
+EXPORT_POLL = 100
+STATS_REFRESH = 1000
+STATS_RANKS = (('1 s', 1), ('10 s', 10), ('60 s', 60), ('Total', None))
+LATENCY_ROWS = 16
+DUMP_INTERVAL = 10000
+PROFILE_TIME = 10000
+
+# --NAME=VALUE command line options: NAME -> (keyword argument, type); the
+# max_ ones go to the CaptureStore, the others to MonitorGui
+OPTIONS = {
+    'max-packets': ('max_packets', int),
+    'max-bytes': ('max_bytes', int),
+    'max-age': ('max_age', float),
+    'interval': ('interval', int),
+    'budget': ('budget', int),
+}
+USAGE = '''usage: hdlmonitor [OPTION...] [SOURCE...]
+
+  --max-packets=N      keep at most N packets (default: {0})
+  --max-bytes=N        keep at most N bytes of packets
+  --max-age=SECONDS    keep the packets of the last SECONDS only
+  --interval=MS        drain the receive queue every MS ms (default: {1})
+  --budget=N           take at most N packets per drain (default: {2})
+
+SOURCE is ADDRESS[:PORT][%DEVICE], a capture server at tcp:HOST:PORT or
+unix:PATH, or "bus"; the default is the bus alone.'''.format(
+    STORE_MAX_PACKETS, DRAIN_INTERVAL, DRAIN_BUDGET
+)
+
 
 class Column(ttk.Frame):
-    def __init__(self, top, text, width):
+    def __init__(self, top, text, width, height):
         ttk.Frame.__init__(self, top)
         self.pack(expand=tk.TRUE, fill=tk.Y, side=tk.LEFT)
         self.label = ttk.Label(self, text=text, anchor=tk.CENTER,
@@ -26,7 +98,7 @@ class Column(ttk.Frame):
         self.label.pack(expand=tk.TRUE, fill=tk.BOTH)
         self.listbox = tk.Listbox(self, activestyle=tk.NONE,
                                   exportselection=tk.FALSE,
-                                  font='Courier', height=24,
+                                  font='Courier', height=height,
                                   highlightthickness=0, selectmode=tk.EXTENDED,
                                   width=width)
         self.listbox.pack(fill=tk.X)
@@ -35,64 +107,121 @@ class Column(ttk.Frame):
     def on_enter(self, _):
         self.listbox.focus_set()
 
-    def selection_get(self):
-        selection = []
-        for i in self.listbox.curselection():
-            selection.append(self.listbox.get(int(i)))
-        return selection
-
-    def yscroll(self, lo, _):
-        self.listbox.yview(tk.MOVETO, lo)
-        return 'break'
+    def show(self, values, colors, selection):
+        listbox = self.listbox
+        listbox.delete(0, tk.END)
+        if values:
+            listbox.insert(tk.END, *values)
+            for i, color in enumerate(colors):
+                listbox.itemconfig(i, bg=color)
+            if selection:
+                listbox.selection_set(*selection)
 
 
 class Table(ttk.Frame):
-    def __init__(self, top, columns, select_callback, autoscroll_var,
-                 copy_callback):
+    def __init__(self, top, columns, fetch, select_callback, autoscroll_var,
+                 copy_callback, height=24):
         ttk.Frame.__init__(self, top)
         self.pack(fill=tk.BOTH, expand=tk.TRUE, padx=5, pady=5)
 
-        self.scrollbar = ttk.Scrollbar(self)
+        self.scrollbar = ttk.Scrollbar(self, command=self.on_scrollbar)
         self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.scrollbar.bind('<Button-4>', self.on_button4)
         self.scrollbar.bind('<Button-5>', self.on_button5)
+        self.scrollbar.bind('<MouseWheel>', self.on_mousewheel)
 
         self.columns = []
 
         for text, width in columns:
-            column = Column(self, text=text, width=width)
-            column.listbox.bind('<MouseWheel>', self.on_mousewheel)
-            column.listbox.bind('<Button-4>', self.on_button4)
-            column.listbox.bind('<Button-5>', self.on_button5)
-            column.listbox.bind('<<ListboxSelect>>', self.on_select)
-            column.listbox.bind('<<Copy>>', copy_callback)
+            column = Column(self, text=text, width=width, height=height)
+            listbox = column.listbox
+            listbox.bind('<MouseWheel>', self.on_mousewheel)
+            listbox.bind('<Button-4>', self.on_button4)
+            listbox.bind('<Button-5>', self.on_button5)
+            listbox.bind('<Button-1>', self.on_click)
+            listbox.bind('<Shift-Button-1>', self.on_shift_click)
+            listbox.bind('<Control-Button-1>', self.on_shift_click)
+            listbox.bind('<B1-Motion>', self.on_drag)
+            listbox.bind('<Up>', lambda _: self.yscroll(-1))
+            listbox.bind('<Down>', lambda _: self.yscroll(1))
+            listbox.bind('<Prior>', lambda _: self.yscroll(-self.height))
+            listbox.bind('<Next>', lambda _: self.yscroll(self.height))
+            listbox.bind('<Home>', lambda _: self.yscroll(-self.end))
+            listbox.bind('<End>', lambda _: self.yscroll(self.end))
+            listbox.bind('<<Copy>>', copy_callback)
             self.columns.append(column)
 
-        self.columns[0].listbox.config(yscrollcommand=self.scrollbar.set)
-        for col1, col2 in zip(self.columns[:-1], self.columns[1:]):
-            col2.listbox.config(yscrollcommand=col1.yscroll)
-        self.scrollbar.config(command=column.listbox.yview)
-
+        self.fetch = fetch
         self.select_callback = select_callback
 
         self.colors = ('white', 'white smoke')
-        self.color = cycle(self.colors)
 
         self.autoscroll = autoscroll_var
-
-    def append(self, row):
-        color = next(self.color)
-        for subrow in row:
-            for column, value in zip(self.columns, subrow):
-                column.listbox.insert(tk.END, value)
-                column.listbox.itemconfig(tk.END, bg=color)
-                if self.autoscroll.get():
-                    column.listbox.see(tk.END)
+        self.diagnostics = None
+
+        self.height = height
+        self.end = 0
+        self.clear()
+
+    # Rows are keyed by capture sequence number and only their line counts
+    # are kept; the text is fetched when a row is shown or copied. Line
+    # numbers are absolute: they keep growing as rows are appended and are
+    # not renumbered when rows are trimmed from the front, so only
+    # self.offset and self.start move on eviction.
+    def append(self, key, lines):
+        self.extend([(key, lines)])
+
+    def extend(self, rows):
+        if not rows:
+            return
+        keys = self.keys
+        starts = self.starts
+        end = self.end
+        for key, lines in rows:
+            keys.append(key)
+            starts.append(end)
+            end += lines
+        visible = self.end < self.top + self.height
+        self.end = end
+        if self.autoscroll.get():
+            top = max(self.start, end - self.height)
+            visible = visible or top != self.top
+            self.top = top
+        if visible:
+            self.refresh()
+        else:
+            self.update_scrollbar()
 
     def clear(self):
-        self.color = cycle(self.colors)
-        for column in self.columns:
-            column.listbox.delete(0, tk.END)
+        self.keys = array(INDEX_TYPECODE)
+        self.starts = array(INDEX_TYPECODE)
+        self.offset = 0
+        self.removed = 0
+        self.start = self.end
+        self.top = self.end
+        self.anchor = None
+        self.selection = None
+        self.refresh()
+
+    def find(self, key):
+        # index of the row of key, or None when it is not in the table
+        index = bisect_left(self.keys, key, self.offset)
+        if index < len(self.keys) and self.keys[index] == key:
+            return index
+        return None
+
+    def key_at(self, line):
+        index = self.locate(line)
+        return self.keys[index] if index >= self.offset else None
+
+    def line_at(self, event):
+        if self.start == self.end:
+            return None
+        line = self.top + max(0, event.widget.nearest(event.y))
+        return min(line, self.end - 1)
+
+    def locate(self, line):
+        return bisect_right(self.starts, line, self.offset) - 1
 
     def on_button4(self, _):
         delta = -5
@@ -102,34 +231,166 @@ class Table(ttk.Frame):
         delta = 5
         return self.yscroll(delta)
 
+    def on_click(self, event):
+        event.widget.focus_set()
+        line = self.line_at(event)
+        if line is not None:
+            self.anchor = line
+            self.select(line, line)
+        return 'break'
+
+    def on_drag(self, event):
+        if event.y < 0:
+            self.yscroll(-1)
+        elif event.y >= event.widget.winfo_height():
+            self.yscroll(1)
+        return self.on_shift_click(event)
+
     def on_mousewheel(self, event):
-        delta = event.delta / -30
+        delta = event.delta // -30
         return self.yscroll(delta)
 
-    def on_select(self, event):
-        selection = event.widget.curselection()
-        for column in self.columns:
-            column.listbox.selection_clear(0, tk.END)
-            if selection:
-                column.listbox.selection_set(selection[0], selection[-1])
-        column.listbox.focus_set()
-        self.select_callback(selection)
+    def on_scrollbar(self, *args):
+        if args[0] == tk.MOVETO:
+            lines = self.end - self.start
+            self.scroll_to(self.start + int(float(args[1]) * lines))
+        elif args[0] == tk.SCROLL:
+            delta = int(args[1])
+            if args[2] == tk.PAGES:
+                delta *= self.height
+            self.yscroll(delta)
+
+    def on_shift_click(self, event):
+        if self.anchor is None:
+            return self.on_click(event)
+        line = self.line_at(event)
+        if line is not None:
+            self.select(self.anchor, line)
+        return 'break'
+
+    def previous(self, key):
+        index = bisect_left(self.keys, key, self.offset)
+        if index > self.offset:
+            return self.keys[index - 1]
+
+    def refresh(self):
+        diagnostics = self.diagnostics
+        if diagnostics is not None:
+            mark = monotonic_ns()
+        top = self.top
+        stop = min(top + self.height, self.end)
+        subrows = []
+        colors = []
+        if top < stop:
+            index = self.locate(top)
+            line = top
+            while line < stop:
+                row = self.fetch(self.keys[index])
+                start = self.starts[index]
+                color = self.colors[(self.removed + index) % 2]
+                for subrow in row[line - start:stop - start]:
+                    subrows.append(subrow)
+                    colors.append(color)
+                line = start + len(row)
+                index += 1
+        if diagnostics is not None:
+            mark = diagnostics.add('format', mark, len(subrows))
+        selection = None
+        if self.selection:
+            lo = max(self.selection[0], top)
+            hi = min(self.selection[1], stop - 1)
+            if lo <= hi:
+                selection = (lo - top, hi - top)
+        for i, column in enumerate(self.columns):
+            column.show([subrow[i] for subrow in subrows], colors, selection)
+        self.update_scrollbar()
+        if diagnostics is not None:
+            diagnostics.add('widgets', mark, len(subrows))
+
+    def reveal(self, index):
+        # Selects the row at index and scrolls it into view, which stops
+        # autoscrolling so that new rows do not move it out again.
+        self.autoscroll.set(tk.FALSE)
+        first = self.starts[index]
+        last = (self.starts[index + 1] if index + 1 < len(self.starts)
+                else self.end) - 1
+        if not self.top <= first <= last < self.top + self.height:
+            self.top = max(self.start, min(first - self.height // 2,
+                                           self.end - self.height))
+        self.anchor = first
+        self.select(first, last)
+
+    def scroll_to(self, top):
+        top = max(self.start, min(top, self.end - self.height))
+        if top != self.top:
+            self.top = top
+            self.refresh()
+
+    def select(self, first, last):
+        self.selection = (min(first, last), max(first, last))
+        self.refresh()
+        self.select_callback(self.selection)
 
     def selection_get(self):
+        if not self.selection:
+            return []
+        first, last = self.selection
+        index = self.locate(first)
         selection = []
-        for column in self.columns:
-            selection.append(column.selection_get())
-        return zip(*selection)
+        line = first
+        while line <= last:
+            row = self.fetch(self.keys[index])
+            start = self.starts[index]
+            selection.extend(row[line - start:last + 1 - start])
+            line = start + len(row)
+            index += 1
+        return selection
+
+    def trim(self, key):
+        offset = bisect_left(self.keys, key, self.offset)
+        if offset == self.offset:
+            return
+        self.offset = offset
+        self.start = (self.starts[offset] if offset < len(self.keys)
+                      else self.end)
+        if offset > len(self.keys) // 2:
+            del self.keys[:offset]
+            del self.starts[:offset]
+            self.removed += offset
+            self.offset = 0
+        if self.anchor is not None and self.anchor < self.start:
+            self.anchor = self.start
+        if self.selection:
+            if self.selection[1] < self.start:
+                self.selection = None
+                self.select_callback(())
+            else:
+                self.selection = (max(self.selection[0], self.start),
+                                  self.selection[1])
+        if self.top < self.start:
+            self.top = self.start
+            self.refresh()
+        else:
+            self.update_scrollbar()
+
+    def update_scrollbar(self):
+        lines = self.end - self.start
+        if lines <= self.height:
+            self.scrollbar.set(0, 1)
+        else:
+            lines = float(lines)
+            self.scrollbar.set((self.top - self.start) / lines,
+                               (self.top + self.height - self.start) / lines)
 
     def yscroll(self, delta):
-        for column in self.columns:
-            column.listbox.yview(tk.SCROLL, delta, tk.UNITS)
+        self.scroll_to(self.top + delta)
         return 'break'
 
 
 class Filter(ttk.Frame):
     list = []
     conditions_list = []
+    match = staticmethod(match_all)
 
     def __init__(self, top, filter_entries, indent):
         ttk.Frame.__init__(self, top)
@@ -149,6 +410,9 @@ class Filter(ttk.Frame):
             frame = tk.Frame(self, width=width)
             frame.pack_propagate(tk.FALSE)
             frame.pack(side=tk.LEFT, fill=tk.Y)
+            if key is None:
+                # a column without a condition
+                continue
             if base is str and isinstance(validator, (list, tuple)):
                 widget = ttk.Combobox(frame)
                 widget['values'] = validator
@@ -175,12 +439,7 @@ class Filter(ttk.Frame):
 
     @classmethod
     def filter(cls, packet):
-        if cls.conditions_list:
-            for conditions in cls.conditions_list:
-                if cls.check(packet, conditions):
-                    return True
-            return False
-        return True
+        return cls.match(packet)
 
     @classmethod
     def validate(cls):
@@ -193,15 +452,9 @@ class Filter(ttk.Frame):
             else:
                 f_conditions = []
                 for condition in f.conditions:
-                    key, (entry, base, _, _) = condition
-                    _value = entry.get()
-                    if base is str:
-                        value = _value if _value else None
-                    else:
-                        try:
-                            value = int(_value, base)
-                        except ValueError:
-                            value = None
+                    key, (entry, _, _, _) = condition
+                    _value = entry.get().strip()
+                    value = parse_value(key, _value) if _value else None
                     f_conditions.append((key, value))
                 conditions_list.append(f_conditions)
         if not_valid_list:
@@ -209,19 +462,11 @@ class Filter(ttk.Frame):
             not_valid_list[0][0].focus()
         else:
             cls.conditions_list = conditions_list
+            cls.match = staticmethod(compile_filter(conditions_list))
         if not cls.list and hasattr(cls, 'empty_callback'):
             cls.empty_callback()
         return not_valid_list
 
-    @staticmethod
-    def check(packet, conditions):
-        for key, value in conditions:
-            packet_value = getattr(packet, key)
-            if value is None or value == packet_value:
-                continue
-            return False
-        return True
-
     def delete(self):
         self.pack_forget()
         self.remove(self)
@@ -230,27 +475,25 @@ class Filter(ttk.Frame):
         not_valid = []
         filled = 0
         first = None
-        for _, value in self.conditions:
+        for key, value in self.conditions:
             entry, base, validator, fmt = value
             if not first and base is not str:
                 first = entry
             try:
                 value = entry.get().strip()
                 if value:
-                    if base is str:
-                        if callable(validator):
-                            try:
-                                validator(value)
-                            except:
-                                raise ValueError
-                        else:
-                            value = format(value[:10], fmt)
+                    # exact values are checked and formatted as before,
+                    # ranges, sets, masks and negations kept as typed
+                    parsed = parse_value(key, value)
+                    if isinstance(parsed, Predicate):
+                        value = str(parsed)
+                    elif callable(validator):
+                        try:
+                            validator(value)
+                        except:
+                            raise ValueError
                     else:
-                        minimum, maximum = validator
-                        i_value = int(value, base)
-                        if not minimum <= i_value <= maximum:
-                            raise ValueError('not in range')
-                        value = format(i_value, fmt)
+                        value = format(parsed, fmt)
                     filled += 1
                 entry.delete(0, tk.END)
                 entry.insert(0, value)
@@ -266,20 +509,342 @@ class Filter(ttk.Frame):
             self.error.set('')
 
 
+def latency_bound(bound):
+    return '<{0}'.format(bound * 1000 // NANOSECONDS)
+
+
+def latency_ms(latency):
+    return '{0:.1f}'.format(latency * 1000.0 / NANOSECONDS)
+
+
+def latency_us(latency):
+    return '{0:.0f}'.format(latency * 1000000.0 / NANOSECONDS)
+
+
+def stats_key(name, key):
+    if name == 'Device':
+        return '{0}.{1}'.format(*key)
+    if name == 'Operation code':
+        return '{0:04x}'.format(int(key))
+    return str(key)
+
+
+class ReportWindow(tk.Toplevel):
+    # A window showing a report that is refreshed every STATS_REFRESH ms
+    # while it is open.
+    def __init__(self, top, title):
+        tk.Toplevel.__init__(self, top)
+        self.title('{0} - {1}'.format(TITLE, title))
+        self.resizable(tk.FALSE, tk.FALSE)
+        self.protocol('WM_DELETE_WINDOW', self.hide)
+        self.job = None
+
+    def hide(self):
+        if self.job is not None:
+            self.after_cancel(self.job)
+            self.job = None
+        self.withdraw()
+
+    def refresh(self):
+        if self.job is not None:
+            self.after_cancel(self.job)
+        self.update_report(monotonic_ns())
+        self.job = self.after(STATS_REFRESH, self.refresh)
+
+    def show(self):
+        self.deiconify()
+        self.refresh()
+
+
+class StatsWindow(ReportWindow):
+    def __init__(self, top, stats):
+        ReportWindow.__init__(self, top, 'Statistics')
+        self.stats = stats
+
+        bar = ttk.Frame(self)
+        bar.pack(fill=tk.X, padx=5, pady=5)
+        self.totals = tk.StringVar()
+        ttk.Label(bar, textvariable=self.totals).pack(side=tk.LEFT)
+        self.rank = tk.StringVar()
+        self.rank.set(STATS_RANKS[1][0])
+        cb_rank = ttk.Combobox(bar, state='readonly', width=6,
+                               textvariable=self.rank,
+                               values=[text for text, _ in STATS_RANKS])
+        cb_rank.pack(side=tk.RIGHT)
+        cb_rank.bind('<<ComboboxSelected>>', lambda _: self.refresh())
+        ttk.Label(bar, text='Top by').pack(padx=5, side=tk.RIGHT)
+
+        header = '{0:<16s}{1:>12s}'.format('', 'Total') + ''.join(
+            '{0:>10s}'.format('{0}s pkt/s'.format(window))
+            for window in STATS_WINDOWS
+        )
+        self.listboxes = []
+        for name, _, _ in stats.counters:
+            frame = ttk.LabelFrame(self, text=name)
+            frame.pack(fill=tk.X, padx=5, pady=5)
+            ttk.Label(frame, text=header, font='Courier').pack(anchor=tk.W)
+            listbox = tk.Listbox(frame, activestyle=tk.NONE, font='Courier',
+                                 height=STATS_TOP, highlightthickness=0,
+                                 width=len(header))
+            listbox.pack(fill=tk.X)
+            self.listboxes.append(listbox)
+
+    def update_report(self, now):
+        rates, total = self.stats.totals(now)
+        self.totals.set('Packets: {0}  '.format(total) + '  '.join(
+            '{0} s: {1:.0f}/s'.format(window, rates[window])
+            for window in STATS_WINDOWS
+        ))
+        report = self.stats.report(now, dict(STATS_RANKS)[self.rank.get()])
+        for listbox, (name, rows) in zip(self.listboxes, report):
+            listbox.delete(0, tk.END)
+            for key, total, rates in rows:
+                listbox.insert(tk.END, '{0:<16s}{1:>12d}'.format(
+                    stats_key(name, key), total
+                ) + ''.join('{0:>10.1f}'.format(rates[window])
+                            for window in STATS_WINDOWS))
+
+
+class LatencyWindow(ReportWindow):
+    def __init__(self, top, correlator, clock):
+        ReportWindow.__init__(self, top, 'Latency')
+        self.correlator = correlator
+        self.clock = clock
+
+        self.totals = tk.StringVar()
+        ttk.Label(self, textvariable=self.totals).pack(anchor=tk.W, padx=5,
+                                                       pady=5)
+        header = '{0:<8s}{1:>8s}{2:>8s}{3:>8s}{4:>8s}{5:>8s}{6:>8s}' \
+            '{7:>11s}  '.format('Device', 'Replies', 'Mean', 'p50', 'p95',
+                                'Max', 'Retries', 'Unanswered') + \
+            ''.join('{0:>6s}'.format(latency_bound(bound))
+                    for bound in LATENCY_BOUNDS) + '{0:>6s}'.format('more')
+        frame = ttk.LabelFrame(self, text='Response time (ms) per device')
+        frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(frame, text=header, font='Courier').pack(anchor=tk.W)
+        self.devices = tk.Listbox(frame, activestyle=tk.NONE, font='Courier',
+                                  height=LATENCY_ROWS, highlightthickness=0,
+                                  width=len(header))
+        self.devices.pack(fill=tk.X)
+        frame = ttk.LabelFrame(self, text='Unanswered requests')
+        frame.pack(fill=tk.X, padx=5, pady=5)
+        self.unanswered = tk.Listbox(frame, activestyle=tk.NONE,
+                                     font='Courier', height=LATENCY_ROWS // 2,
+                                     highlightthickness=0, width=len(header))
+        self.unanswered.pack(fill=tk.X)
+
+    def update_report(self, now):
+        correlator = self.correlator
+        self.totals.set(
+            'Requests: {0}  Replies: {1}  Retries: {2}  Unanswered: {3}  '
+            'Waiting: {4}'.format(correlator.requests, correlator.replies,
+                                  correlator.retries, correlator.timeouts,
+                                  len(correlator.pending))
+        )
+        self.devices.delete(0, tk.END)
+        for address, device in correlator.report():
+            histogram = device.histogram
+            self.devices.insert(tk.END, (
+                '{0:<8s}{1:>8d}{2:>8s}{3:>8s}{4:>8s}{5:>8s}{6:>8d}{7:>11d}  '
+                .format('{0}.{1}'.format(*address), histogram.count,
+                        latency_ms(histogram.mean()),
+                        latency_ms(histogram.percentile(50)),
+                        latency_ms(histogram.percentile(95)),
+                        latency_ms(histogram.max), device.retries,
+                        device.unanswered) +
+                ''.join('{0:>6d}'.format(count) for count in histogram.counts)
+            ))
+        self.unanswered.delete(0, tk.END)
+        offset = self.clock.offset
+        for sent, key in reversed(correlator.unanswered):
+            self.unanswered.insert(
+                tk.END, '{0}  {1}.{2} -> {3}.{4}  {5:04x}'.format(
+                    format_time(sent + offset), *key
+                )
+            )
+
+
+class DiagnosticsWindow(ReportWindow):
+    # Opening the window turns the diagnostics on; they stay on, and keep
+    # being dumped if asked to, while the window is hidden.
+    def __init__(self, top, diagnostics, queue, clock):
+        ReportWindow.__init__(self, top, 'Diagnostics')
+        self.diagnostics = diagnostics
+        self.queue = queue
+        self.clock = clock
+        self.dump_path = None
+        self.dump_job = None
+        self.profiler = None
+        self.profile_job = None
+
+        bar = ttk.Frame(self)
+        bar.pack(fill=tk.X, padx=5, pady=5)
+        self.totals = tk.StringVar()
+        ttk.Label(bar, textvariable=self.totals).pack(side=tk.LEFT)
+        self.btn_profile = ttk.Button(bar, text='Profile...',
+                                      command=self.profile)
+        self.btn_profile.pack(side=tk.RIGHT)
+        self.btn_dump = ttk.Button(bar, text='Dump...', command=self.dump)
+        self.btn_dump.pack(side=tk.RIGHT)
+        ttk.Button(bar, text='Reset',
+                   command=self.reset).pack(side=tk.RIGHT)
+
+        header = '{0:<40s}{1:>9s}{2:>10s}{3:>9s}{4:>9s}{5:>9s}{6:>9s}' \
+            '{7:>9s}{8:>10s}'.format('Stage', 'Calls', 'Items', 'Mean',
+                                     'p50', 'p95', 'p99', 'Max', 'Total ms')
+        frame = ttk.LabelFrame(self, text='Time per call (us)')
+        frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(frame, text=header, font='Courier').pack(anchor=tk.W)
+        self.stages = tk.Listbox(frame, activestyle=tk.NONE, font='Courier',
+                                 height=len(diagnostics.stages),
+                                 highlightthickness=0, width=len(header))
+        self.stages.pack(fill=tk.X)
+        self.lag = tk.StringVar()
+        ttk.Label(self, textvariable=self.lag).pack(anchor=tk.W, padx=5,
+                                                    pady=5)
+        self.note = tk.StringVar()
+        ttk.Label(self, textvariable=self.note).pack(anchor=tk.W, padx=5,
+                                                     pady=5)
+
+    def close(self):
+        if self.profiler is not None:
+            self.stop_profile()
+        if self.dump_path is not None:
+            self.close_dump()
+
+    def dump(self):
+        if self.dump_path is not None:
+            self.close_dump()
+            return
+        path = filedialog.asksaveasfilename(defaultextension='.jsonl',
+                                            filetypes=DUMP_FILETYPES)
+        if not path:
+            return
+        self.dump_path = path
+        self.btn_dump.config(text='Stop dump')
+        self.write_dump()
+
+    def close_dump(self):
+        if self.dump_job is not None:
+            self.after_cancel(self.dump_job)
+            self.dump_job = None
+        self.dump_path = None
+        self.btn_dump.config(text='Dump...')
+        self.note.set('')
+
+    def write_dump(self):
+        self.dump_job = None
+        try:
+            self.diagnostics.dump(self.dump_path, monotonic_ns(),
+                                  self.clock())
+        except (IOError, OSError) as e:
+            self.close_dump()
+            self.note.set('Dump failed: {0}'.format(e))
+            return
+        self.note.set('Dumping to {0} every {1} s'.format(
+            self.dump_path, DUMP_INTERVAL // 1000
+        ))
+        self.dump_job = self.after(DUMP_INTERVAL, self.write_dump)
+
+    def profile(self):
+        # cProfile for PROFILE_TIME ms, or until stopped
+        if self.profiler is not None:
+            self.stop_profile()
+            return
+        from hdldiag import Profiler
+        path = filedialog.asksaveasfilename(defaultextension='.txt',
+                                            filetypes=PROFILE_FILETYPES)
+        if not path:
+            return
+        try:
+            self.profiler = Profiler(path)
+        except ImportError as e:
+            self.note.set('Profiling not available: {0}'.format(e))
+            return
+        self.note.set('Profiling for {0} s'.format(PROFILE_TIME // 1000))
+        self.btn_profile.config(text='Stop profile')
+        self.profile_job = self.after(PROFILE_TIME, self.stop_profile)
+
+    def stop_profile(self):
+        if self.profile_job is not None:
+            self.after_cancel(self.profile_job)
+            self.profile_job = None
+        profiler = self.profiler
+        self.profiler = None
+        self.btn_profile.config(text='Profile...')
+        try:
+            profiler.stop()
+        except (IOError, OSError) as e:
+            self.note.set('Profile failed: {0}'.format(e))
+            return
+        self.note.set('Profile written to {0}'.format(profiler.path))
+
+    def reset(self):
+        self.diagnostics.clear()
+        self.refresh()
+
+    def update_report(self, now):
+        diagnostics = self.diagnostics
+        queue = self.queue
+        depth = diagnostics.depth
+        self.totals.set(
+            'Elapsed: {0:.0f} s  Queue: {1} (peak {2}, p95 {3})  '
+            'Dropped: {4}'.format(
+                float(now - diagnostics.started) / NANOSECONDS, len(queue),
+                queue.peak, depth.percentile(95), queue.dropped
+            )
+        )
+        self.stages.delete(0, tk.END)
+        for stage in diagnostics.stages.values():
+            histogram = stage.histogram
+            self.stages.insert(tk.END, (
+                '{0:<40s}{1:>9d}{2:>10d}{3:>9s}{4:>9s}{5:>9s}{6:>9s}{7:>9s}'
+                '{8:>10s}'.format(
+                    stage.text, histogram.count, stage.items,
+                    latency_us(histogram.mean()),
+                    latency_us(histogram.percentile(50)),
+                    latency_us(histogram.percentile(95)),
+                    latency_us(histogram.percentile(99)),
+                    latency_us(histogram.max), latency_ms(histogram.total)
+                )
+            ))
+        lag = diagnostics.lag
+        self.lag.set(
+            'Receive to display lag (ms): mean {0}  p50 {1}  p95 {2}  '
+            'p99 {3}  max {4}'.format(
+                latency_ms(lag.mean()), latency_ms(lag.percentile(50)),
+                latency_ms(lag.percentile(95)),
+                latency_ms(lag.percentile(99)), latency_ms(lag.max)
+            )
+        )
+
+
 class MonitorGui(ttk.Frame):
-    def __init__(self):
+    def __init__(self, interval=DRAIN_INTERVAL, budget=DRAIN_BUDGET,
+                 store=None, sources=None):
+        # The sources are bound and attached before Tk starts, so packets
+        # received while the window is being built wait in the queue.
+        self.queue = PacketQueue(ordered=len(sources or ()) > 1)
+        self.clock = Clock()
+        self.sources = open_sources(sources, self.queue.put)
+        for source in self.sources:
+            source.attach()
+        self.capturing = True
+
         ttk.Frame.__init__(self)
-        style = ttk.Style()
-        if style.theme_use() == 'default':
-            style.theme_use('alt')
         self.master.resizable(tk.FALSE, tk.FALSE)
         self.master.title(TITLE)
+        # the theme is switched once at most, which restyles every widget
+        style = ttk.Style()
         try:
             self.master.iconbitmap('hdlmonitor.ico')
+            theme = 'alt' if style.theme_use() == 'default' else None
         except tk.TclError:
-            ttk.Style().theme_use('alt')
+            theme = 'alt'
             icon = tk.PhotoImage(file='hdlmonitor.gif')
             self.master.tk.call('wm', 'iconphoto', self.master._w, icon)
+        if theme is not None and style.theme_use() != theme:
+            style.theme_use(theme)
 
         self.pack(fill=tk.BOTH, expand=tk.TRUE, padx=5, pady=5)
 
@@ -302,6 +867,18 @@ class MonitorGui(ttk.Frame):
                                         var=autoscroll_var)
         autoscroll_cb.pack(padx=5, side=tk.LEFT)
 
+        self.time_mode = tk.StringVar()
+        self.time_mode.set(TIME_MODES[0])
+        cb_time_mode = ttk.Combobox(buttongroup, state='readonly', width=9,
+                                    textvariable=self.time_mode,
+                                    values=TIME_MODES)
+        cb_time_mode.pack(padx=5, side=tk.LEFT)
+        cb_time_mode.bind('<<ComboboxSelected>>', self.on_time_mode)
+
+        self.status = tk.StringVar()
+        lbl_status = ttk.Label(buttongroup, textvariable=self.status)
+        lbl_status.pack(padx=5, side=tk.LEFT)
+
         self.btn_copy = ttk.Button(buttongroup,
                                    text='Copy to clipboard', command=self.copy,
                                    state=tk.DISABLED)
@@ -311,21 +888,64 @@ class MonitorGui(ttk.Frame):
                                     command=self.clear, state=tk.DISABLED)
         self.btn_clear.pack(side=tk.RIGHT)
 
+        self.btn_record = ttk.Button(buttongroup, text='Record...',
+                                     command=self.record)
+        self.btn_record.pack(side=tk.RIGHT)
+
+        btn_open = ttk.Button(buttongroup, text='Open...',
+                              command=self.open)
+        btn_open.pack(side=tk.RIGHT)
+
+        btn_export = ttk.Button(buttongroup, text='Export...',
+                                command=self.export)
+        btn_export.pack(side=tk.RIGHT)
+
+        btn_stats = ttk.Button(buttongroup, text='Statistics',
+                               command=self.show_stats)
+        btn_stats.pack(side=tk.RIGHT)
+
+        btn_latency = ttk.Button(buttongroup, text='Latency',
+                                 command=self.show_latency)
+        btn_latency.pack(side=tk.RIGHT)
+
+        btn_diagnostics = ttk.Button(buttongroup, text='Diagnostics',
+                                     command=self.show_diagnostics)
+        btn_diagnostics.pack(side=tk.RIGHT)
+
+        self.replay_speed = tk.StringVar()
+        self.replay_speed.set(REPLAY_SPEEDS[-1][0])
+        cb_replay_speed = ttk.Combobox(buttongroup, state='readonly', width=5,
+                                       textvariable=self.replay_speed,
+                                       values=[text for text, _
+                                               in REPLAY_SPEEDS])
+        cb_replay_speed.pack(side=tk.RIGHT)
+
+        self.btn_replay = ttk.Button(buttongroup, text='Replay...',
+                                     command=self.replay)
+        self.btn_replay.pack(side=tk.RIGHT)
+
+        # with several sources (or a named one) the source gets a column
+        self.show_source = bool(sources)
+        columns = [
+            ('Timestamp', 17),
+            ('IP Address', 17),
+            ('Head', 12),
+            ('Subnet ID', 5),
+            ('Device ID', 5),
+            ('Device Type', 7),
+            ('Operation\nCode (hex)', 6),
+            ('Target\nSubnet ID', 5),
+            ('Target\nDevice ID', 5),
+            ('Content (hex)', 25),
+            ('Content (ASCII)', 10),
+            ('Decoded', 36),
+        ]
+        if self.show_source:
+            columns.insert(1, ('Source', 17))
         self.table = Table(
             self,
-            (
-                ('Timestamp', 14),
-                ('IP Address', 17),
-                ('Head', 12),
-                ('Subnet ID', 5),
-                ('Device ID', 5),
-                ('Device Type', 7),
-                ('Operation\nCode (hex)', 6),
-                ('Target\nSubnet ID', 5),
-                ('Target\nDevice ID', 5),
-                ('Content (hex)', 25),
-                ('Content (ASCII)', 10),
-            ),
+            columns,
+            self.row,
             self.select_callback,
             autoscroll_var,
             self.copy
@@ -348,36 +968,121 @@ class MonitorGui(ttk.Frame):
                                           state=tk.DISABLED)
         self.btn_applyfilter.pack(side=tk.LEFT)
 
+        self.progress = ttk.Progressbar(filterbuttons, length=200)
+
+        btn_find_next = ttk.Button(filterbuttons, text='Next', width=8,
+                                   command=lambda: self.find_next(1))
+        btn_find_next.pack(side=tk.RIGHT)
+
+        btn_find_previous = ttk.Button(filterbuttons, text='Previous',
+                                       width=8,
+                                       command=lambda: self.find_next(-1))
+        btn_find_previous.pack(side=tk.RIGHT)
+
+        self.search_text = tk.StringVar()
+        ent_search = ttk.Entry(filterbuttons, width=30,
+                               textvariable=self.search_text)
+        ent_search.pack(padx=5, side=tk.RIGHT)
+        ent_search.bind('<Return>', lambda _: self.find_next(1))
+
+        lbl_search = ttk.Label(filterbuttons, text='Find content:')
+        lbl_search.pack(side=tk.RIGHT)
+
+        # the capture filter decides what is stored at all, see PacketQueue
+        lbl_capture = ttk.Label(filterbuttons, text='Capture filter:')
+        lbl_capture.pack(padx=5, side=tk.LEFT)
+
+        self.capture_text = tk.StringVar()
+        ent_capture = ttk.Entry(filterbuttons, width=30,
+                                textvariable=self.capture_text)
+        ent_capture.pack(side=tk.LEFT)
+        ent_capture.bind('<Return>', self.set_capture_filter)
+
+        btn_capture = ttk.Button(filterbuttons, text='Set', width=5,
+                                 command=self.set_capture_filter)
+        btn_capture.pack(padx=5, side=tk.LEFT)
+
+        self.origin = None
+        self.interval = interval
+        self.budget = budget
+
         self.monitor = hdlmiracle.Monitor()
         self.monitor.receive = self.receive
 
-        self.bus = hdlmiracle.IPBus(strict=False)
-        self.bus.start()
-
-        self.packets = []
+        self.live = store if store is not None else CaptureStore()
+        self.packets = self.live
+        self.writer = None
+        self.replayer = None
+        self.importer = None
+        self.import_job = None
+        self.exporter = None
+        self.export_keys = None
+        self.export_cursor = 0
+        self.export_job = None
+        self.note = ''
+        self.stats = TrafficStats()
+        self.stats_window = None
+        self.correlator = Correlator()
+        self.latency_window = None
+        self.diagnostics = None
+        self.diagnostics_window = None
+        self.drain_due = monotonic_ns()
+        self.matches = MatchCache()
+        self.matches.clear(self.packets.first)
+        self.index = None
+        self.search = None
+        self.found = []
+        self.found_end = 0
+        self.rows = RowCache()
         self.processing = True
 
+        self.refilter_chunk = REFILTER_CHUNK
+        self.refilter_cursor = None
+        self.refilter_job = None
+
         self.append = self.append_1
 
-        self.start()
+        self.btn_stop.pack(side=tk.LEFT)
+        self.drain()
         self.mainloop()
 
+        if self.replayer is not None:
+            self.replayer.stop()
+        for source in self.sources:
+            source.close()
+        if self.writer is not None:
+            self.writer.close()
+        if self.exporter is not None:
+            self.exporter.close()
+            self.exporter.thread.join()
+        if self.diagnostics_window is not None:
+            self.diagnostics_window.close()
+
     def add_filter(self):
         columns = [column.label.winfo_width() for column in self.table.columns]
         combo_values = ['']
         combo_values.extend(hdlmiracle.HEADS)
+        entries = [
+            ('ipaddress', str, hdlmiracle.IPAddress, '15s'),
+            ('head', str, combo_values, '10.10s'),
+            ('subnet_id', 10, (0, 255), 'd'),
+            ('device_id', 10, (0, 255), 'd'),
+            ('device_type', 10, (0, 65535), 'd'),
+            ('operation_code', 16, (0, 0xffff), '04x'),
+            ('target_subnet_id', 10, (0, 255), 'd'),
+            ('target_device_id', 10, (0, 255), 'd'),
+            (None, None, None, None),
+            (None, None, None, None),
+            ('decoded', str, parse_decoded, 's'),
+        ]
+        if self.show_source:
+            entries.insert(0, ('source', str,
+                               [''] + [s.name for s in self.sources], 's'))
         Filter(
             self.filters,
-            (
-                ('ipaddress', columns[1], str, hdlmiracle.IPAddress, '15s'),
-                ('head', columns[2], str, combo_values, '10s'),
-                ('subnet_id', columns[3], 10, (0, 255), 'd'),
-                ('device_id', columns[4], 10, (0, 255), 'd'),
-                ('device_type', columns[5], 10, (0, 65535), 'd'),
-                ('operation_code', columns[6], 16, (0, 0xffff), '04x'),
-                ('target_subnet_id', columns[7], 10, (0, 255), 'd'),
-                ('target_device_id', columns[8], 10, (0, 255), 'd'),
-            ),
+            [(key, width, base, validator, fmt) for width, (
+                key, base, validator, fmt
+            ) in zip(columns[1:], entries)],
             columns[0],
         )
         self.btn_applyfilter.config(state=tk.NORMAL)
@@ -388,88 +1093,397 @@ class MonitorGui(ttk.Frame):
     def apply_filters(self):
         nv = Filter.validate()
         if not nv:
-            self.table.clear()
-            for now, packet in self.packets:
-                if Filter.filter(packet):
-                    self.append_n(now, packet)
+            self.cancel_refilter()
+            self.matches.configure(Filter.conditions_list)
+            self.show()
+
+    def cancel_refilter(self):
+        if self.refilter_job is not None:
+            self.after_cancel(self.refilter_job)
+            self.refilter_job = None
+        self.refilter_cursor = None
+        self.progress.pack_forget()
+
+    def refilter(self):
+        # Re-filter the store a chunk at a time. Until the cursor catches up
+        # with the end of the store, drain() leaves rendering to this loop,
+        # so packets received meanwhile are shown in order. Only filter rows
+        # without a cached bitmap are evaluated; the rest is a bitmap OR.
+        self.refilter_job = None
+        if self.diagnostics is not None:
+            mark = monotonic_ns()
+        first = self.packets.first
+        end = self.packets.end
+        cursor = max(self.refilter_cursor, first)
+        stop = min(cursor + self.refilter_chunk, end)
+        if self.matches.behind(stop):
+            self.matches.update(
+                ((seq, packet) for seq, _, packet
+                 in self.packets.iter_from(cursor, stop)),
+                stop
+            )
+        if self.index is not None and self.index.end < stop:
+            self.index.update(
+                self.packets.iter_contents(self.index.end, stop), stop
+            )
+        lines = self.packets.lines
+        self.table.extend([(seq, lines(seq))
+                           for seq in self.matches.matches(cursor, stop)])
+        if self.diagnostics is not None:
+            self.diagnostics.add('refilter', mark, stop - cursor)
+        self.refilter_cursor = stop
+        if stop >= end:
+            self.cancel_refilter()
+        else:
+            self.progress.config(
+                value=100.0 * (self.refilter_cursor - first) / (end - first)
+            )
+            self.refilter_job = self.after(1, self.refilter)
 
-    def append_1(self, now, packet):
+    def append_1(self, rows):
         self.btn_clear.config(state=tk.NORMAL)
         self.append = self.append_n
-        self.append(now, packet)
-
-    def append_n(self, now, packet):
-        data = [(str(line), line.ascii()) for line in packet.content.step()]
-
-        if data:
-            row = [[
-                ' {0:12s}'.format(str(now)),
-                ' {0:15s}'.format(str(packet.ipaddress)),
-                ' {0:10s}'.format(packet.head),
-                '{0:>4d}'.format(packet.subnet_id),
-                '{0:>4d}'.format(packet.device_id),
-                '{0:>6d}'.format(packet.device_type),
-                '{0:>5s}'.format(str(packet.operation_code)),
-                '{0:>4d}'.format(packet.target_subnet_id),
-                '{0:>4d}'.format(packet.target_device_id),
-                ' {0:23s}'.format(data[0][0]),
-                ' {0:8s}'.format(data[0][1]),
-            ]]
-            for _hex, ascii in data[1:]:
-                row.append([
-                    ' ' * 13,
-                    ' ' * 16,
-                    ' ' * 11,
-                    ' ' * 4,
-                    ' ' * 4,
-                    ' ' * 6,
-                    ' ' * 5,
-                    ' ' * 4,
-                    ' ' * 4,
-                    ' {0:23s}'.format(_hex),
-                    ' {0:8s}'.format(ascii),
-                ])
-        else:
-            row = [[
-                ' {0:12s}'.format(str(now)),
-                ' {0:15s}'.format(str(packet.ipaddress)),
-                ' {0:10s}'.format(packet.head),
-                '{0:>4d}'.format(packet.subnet_id),
-                '{0:>4d}'.format(packet.device_id),
-                '{0:>6d}'.format(packet.device_type),
-                '{0:>5s}'.format(str(packet.operation_code)),
-                '{0:>4d}'.format(packet.target_subnet_id),
-                '{0:>4d}'.format(packet.target_device_id),
-                '',
-                '',
-            ]]
-
-        self.table.append(row)
+        self.append(rows)
+
+    def append_n(self, rows):
+        self.table.extend(rows)
+
+    def drain(self):
+        # rescheduled whatever happens, so that one bad packet cannot stop
+        # the display for good
+        try:
+            self.update_live()
+        finally:
+            self.drain_due = monotonic_ns() + self.interval * 1000000
+            self.after(self.interval, self.drain)
+
+    def update_live(self):
+        diagnostics = self.diagnostics
+        if diagnostics is not None:
+            mark = diagnostics.add('timer', self.drain_due)
+            diagnostics.depth.add(len(self.queue))
+        batch = self.queue.drain(self.budget)
+        if diagnostics is not None:
+            mark = diagnostics.add('queue', mark, len(batch))
+        self.stats.update(batch)
+        self.correlator.update(batch)
+        if not batch:
+            # The queue is empty, so any reply still to come is stamped
+            # after now: requests time out on a quiet bus too.
+            self.correlator.expire(monotonic_ns())
+        if diagnostics is not None:
+            mark = diagnostics.add('stats', mark, len(batch))
+        live = self.live
+        evicted = live.evicted
+        start = live.end
+        offset = self.clock.offset
+        for timestamp, packet in batch:
+            live.append(timestamp + offset, packet)
+        if self.writer is not None:
+            for timestamp, packet in batch:
+                self.writer.put(timestamp + offset, packet)
+        if diagnostics is not None:
+            diagnostics.add('store', mark, len(batch))
+        if self.packets is live:
+            self.stored(start, [packet for _, packet in batch], evicted)
+            if diagnostics is not None and batch:
+                # from the receipt of the oldest packet of the batch
+                diagnostics.lag.add(monotonic_ns() - batch[0][0])
+        status = (
+            'Queue: {0} (peak {1})  Dropped: {2}  Delayed: {3}  '
+            'Stored: {4}  Evicted: {5}'.format(
+                len(self.queue), self.queue.peak, self.queue.dropped,
+                self.queue.delayed, len(live), live.evicted
+            )
+        )
+        if self.queue.accept is not None:
+            status += '  Filtered: {0}'.format(self.queue.filtered)
+        if self.writer is not None and self.writer.error is not None:
+            self.note = 'Recording failed: {0}'.format(self.writer.error)
+            self.stop_recording()
+        if self.writer is not None:
+            status += '  Recorded: {0}'.format(len(self.writer))
+        if self.replayer is not None:
+            self.note = 'Replayed: {0} ({1:.0f} packets/s)'.format(
+                self.replayer.sent, self.replayer.rate(monotonic_ns())
+            )
+            if self.replayer.finished is not None and not self.queue:
+                self.end_replay()
+        if self.note:
+            status += '  ' + self.note
+        for source in self.sources:
+            if source.error is not None:
+                status += '  {0}: {1}'.format(source.name, source.error)
+        self.status.set(status)
 
     def clear(self):
-        self.packets = []
-        self.table.clear()
+        self.live.clear()
+        self.show(self.live)
         self.btn_clear.config(state=tk.DISABLED)
         self.btn_copy.config(state=tk.DISABLED)
         self.append = self.append_1
 
     def copy(self, *_):
-        rows = []
-        for row in self.table.selection_get():
-            rows.append(' '.join(row)[1:].rstrip())
-        text = linesep.join(rows) + linesep
+        text = linesep.join(row_lines(self.table.selection_get())) + linesep
         self.clipboard_clear()
         self.clipboard_append(text)
 
+    def cancel_import(self):
+        if self.import_job is not None:
+            self.after_cancel(self.import_job)
+            self.import_job = None
+        if self.importer is not None:
+            self.importer.close()
+            self.importer = None
+
+    def export(self):
+        # Exports the selected rows, or all the rows shown, in the format of
+        # the file extension. The packets are read here, a chunk per Tk
+        # timer tick, and formatted and written by the Exporter thread.
+        if self.exporter is not None:
+            return
+        from hdlexport import Exporter
+        path = filedialog.asksaveasfilename(defaultextension='.txt',
+                                            filetypes=EXPORT_FILETYPES)
+        if not path:
+            return
+        table = self.table
+        if table.selection:
+            first, last = table.selection
+            keys = table.keys[table.locate(first):table.locate(last) + 1]
+        else:
+            keys = table.keys[table.offset:]
+        try:
+            self.exporter = Exporter(path, len(keys), self.show_source,
+                                     decoded_text)
+        except (IOError, OSError) as e:
+            self.status.set(str(e))
+            return
+        self.export_keys = keys
+        self.export_cursor = 0
+        self.export_packets()
+
+    def export_packets(self):
+        self.export_job = None
+        exporter = self.exporter
+        keys = self.export_keys
+        # keep at most two chunks queued, so memory stays bounded when the
+        # writer is slower than reading
+        if len(exporter) < 2 and self.export_cursor < len(keys):
+            source = self.packets
+            first = source.first
+            chunk = keys[self.export_cursor:
+                         self.export_cursor + EXPORT_CHUNK]
+            batch = [source[seq] for seq in chunk if seq >= first]
+            exporter.evicted += len(chunk) - len(batch)
+            exporter.put(batch)
+            self.export_cursor += len(chunk)
+        if self.export_cursor >= len(keys):
+            # also when there was nothing to export
+            exporter.close()
+        if exporter.done:
+            self.end_export()
+        else:
+            self.note = 'Exporting: {0:.0f}%'.format(
+                100.0 * (exporter.written + exporter.evicted) /
+                max(1, exporter.total)
+            )
+            self.export_job = self.after(
+                1 if self.export_cursor < len(keys) else EXPORT_POLL,
+                self.export_packets
+            )
+
+    def end_export(self):
+        # also cuts an export short, keeping what has been read so far
+        if self.export_job is not None:
+            self.after_cancel(self.export_job)
+            self.export_job = None
+        exporter = self.exporter
+        exporter.close()
+        exporter.thread.join()
+        if exporter.error is not None:
+            self.note = 'Export failed: {0}'.format(exporter.error)
+        else:
+            self.note = 'Exported: {0}'.format(exporter.written)
+        if exporter.evicted:
+            self.note += ' ({0} evicted before export)'.format(
+                exporter.evicted
+            )
+        self.exporter = None
+        self.export_keys = None
+
+    def import_packets(self):
+        # Pulls the next chunk of packets from the pcap reader into the
+        # store being shown, the way drain() does for the live store.
+        self.import_job = None
+        source = self.packets
+        evicted = source.evicted
+        start = source.end
+        batch = list(islice(self.importer, IMPORT_CHUNK))
+        for timestamp, packet in batch:
+            source.append(timestamp, packet)
+        self.stored(start, [packet for _, packet in batch], evicted)
+        self.note = 'Imported: {0}'.format(source.end)
+        if len(batch) < IMPORT_CHUNK:
+            self.cancel_import()
+        else:
+            self.import_job = self.after(1, self.import_packets)
+
+    def open(self):
+        path = filedialog.askopenfilename(filetypes=OPEN_FILETYPES)
+        if not path:
+            return
+        try:
+            try:
+                source = CaptureFile(path)
+                importer = None
+            except ValueError:
+                from hdlpcap import read_pcap
+                source = CaptureStore()
+                importer = read_pcap(path)
+        except (IOError, OSError, ValueError) as e:
+            self.status.set(str(e))
+            return
+        self.stop()
+        self.show(source)
+        self.master.title('{0} - {1}'.format(TITLE, basename(path)))
+        if importer is not None:
+            self.importer = importer
+            self.import_packets()
+
+    def drop_index(self):
+        if self.index is not None:
+            if self.packets is self.live:
+                self.live.charge(0)
+            self.index = None
+
+    def find_next(self, step):
+        # Jumps to the next (step 1) or previous (step -1) row shown whose
+        # content matches the search text, searching again when the text
+        # changed and adding packets stored since the last search.
+        text = self.search_text.get().strip()
+        if not text:
+            return
+        source = self.packets
+        if self.search is None or self.search.expression != text:
+            try:
+                self.search = Search(text)
+            except ValueError as e:
+                self.note = str(e)
+                return
+            self.found = []
+            self.found_end = source.first
+        if self.index is None:
+            # built on the first search, and charged against the limits of
+            # the live store for as long as it is kept
+            self.index = ContentIndex()
+            self.index.clear(source.first)
+            if source is self.live:
+                source.charge(POSTING_SIZE)
+        if self.found_end < source.end:
+            self.found.extend(self.index.search(source, self.search,
+                                                self.found_end, source.end))
+            self.found_end = source.end
+        table = self.table
+        found = self.found
+        selection = table.selection
+        line = selection[0] if selection else table.top
+        key = table.key_at(line) if line < table.end else None
+        if key is None:
+            i = 0 if step > 0 else len(found) - 1
+        elif step > 0:
+            i = (bisect_right if selection else bisect_left)(found, key)
+        else:
+            i = bisect_left(found, key) - 1
+        # wrap around at either end
+        if step > 0:
+            order = chain(range(i, len(found)), range(0, i))
+        else:
+            order = chain(range(i, -1, -1), range(len(found) - 1, i, -1))
+        for i in order:
+            index = table.find(found[i])
+            if index is not None:
+                table.reveal(index)
+                self.note = 'Match: {0} of {1}'.format(i + 1, len(found))
+                return
+        self.note = 'Match: none of {0}'.format(len(found))
+
+    def on_time_mode(self, _):
+        self.rows.clear()
+        self.table.refresh()
+
+    def row(self, seq):
+        row = self.rows.get(seq)
+        if row is None:
+            timestamp, packet = self.packets[seq]
+            mode = self.time_mode.get()
+            if mode == 'Relative':
+                now = format_delta(timestamp - self.origin)
+            elif mode == 'Delta':
+                previous = self.table.previous(seq)
+                if previous is None or previous < self.packets.first:
+                    now = ''
+                else:
+                    now = format_delta(timestamp - self.packets[previous][0])
+            else:
+                now = format_time(timestamp)
+            row = self.rows[seq] = format_row(now, packet,
+                                              self.show_source, decoded_text)
+        return row
+
     def receive(self, packet):
-        _now = datetime.now().time()
-        now = '{0.hour:02d}:{0.minute:02d}:{0.second:02d}.{1:03d}'.format(
-            _now, _now.microsecond // 1000
+        self.queue.put((monotonic_ns(), packet))
+
+    def replay(self):
+        if self.replayer is not None:
+            self.replayer.stop()
+            self.end_replay()
+            return
+        path = filedialog.askopenfilename(filetypes=CAPTURE_FILETYPES)
+        if not path:
+            return
+        try:
+            source = CaptureFile(path)
+        except (IOError, OSError, ValueError) as e:
+            self.status.set(str(e))
+            return
+        if self.packets is not self.live:
+            self.show(self.live)
+        speed = dict(REPLAY_SPEEDS)[self.replay_speed.get()]
+        self.replayer = Replayer(source, self.monitor, speed,
+                                 pending=self.queue.__len__)
+        self.replayer.start()
+        self.btn_replay.config(text='Stop replay')
+
+    def end_replay(self):
+        # The rate counts until the last replayed packet has been drained,
+        # so in Max mode it is the throughput the GUI sustains.
+        self.note = 'Replayed: {0} ({1:.0f} packets/s)'.format(
+            self.replayer.sent, self.replayer.rate(monotonic_ns())
         )
-        self.packets.append((now, packet))
+        self.replayer.source.close()
+        self.replayer = None
+        self.btn_replay.config(text='Replay...')
+
+    def record(self):
+        if self.writer is not None:
+            self.stop_recording()
+            return
+        path = filedialog.asksaveasfilename(defaultextension='.hdl',
+                                            filetypes=CAPTURE_FILETYPES)
+        if not path:
+            return
+        try:
+            self.writer = CaptureWriter(path)
+        except (IOError, OSError) as e:
+            self.status.set(str(e))
+            return
+        self.btn_record.config(text='Stop recording')
 
-        if self.processing and Filter.filter(packet):
-            self.append(now, packet)
+    def stop_recording(self):
+        self.writer.close()
+        self.writer = None
+        self.btn_record.config(text='Record...')
 
     def select_callback(self, selection):
         if selection:
@@ -477,16 +1491,153 @@ class MonitorGui(ttk.Frame):
         else:
             self.btn_copy.config(state=tk.DISABLED)
 
+    def show(self, source=None):
+        # Re-filters the current source from the start, after switching to
+        # source (the live store or an opened capture file) if one is given.
+        self.cancel_refilter()
+        switched = source is not None and source is not self.packets
+        if source is not None:
+            self.drop_index()
+            if switched:
+                self.cancel_import()
+                if self.exporter is not None:
+                    self.end_export()
+                if self.packets is not self.live:
+                    self.packets.close()
+                self.packets = source
+                self.master.title(TITLE)
+            self.matches.clear(source.first)
+            self.search = None
+        source = self.packets
+        origin = source[source.first][0] if len(source) else None
+        # Rows are cached by seq, so they are kept across re-filtering
+        # unless they may have changed: Delta rows depend on the previous
+        # row shown, Relative ones on the origin.
+        if (switched or origin != self.origin or
+                self.time_mode.get() == 'Delta'):
+            self.rows.clear()
+        self.origin = origin
+        self.table.clear()
+        self.refilter_cursor = source.first
+        self.progress.config(value=0)
+        self.progress.pack(padx=5, side=tk.LEFT)
+        self.refilter()
+
+    def stored(self, start, packets, evicted):
+        # Filters and shows packets just appended to the current source from
+        # seq start on; evicted is the eviction count before appending.
+        source = self.packets
+        stop = source.end
+        if self.origin is None and len(source):
+            self.origin = source[source.first][0]
+        diagnostics = self.diagnostics
+        if diagnostics is not None:
+            mark = monotonic_ns()
+        if self.refilter_cursor is None:
+            self.matches.update(zip(range(start, stop), packets), stop)
+            if diagnostics is not None:
+                mark = diagnostics.add('filter', mark, len(packets))
+            if self.index is not None:
+                self.index.update(source.iter_contents(start, stop), stop)
+                if diagnostics is not None:
+                    mark = diagnostics.add('index', mark, len(packets))
+        if source.evicted != evicted:
+            self.matches.trim(source.first)
+            if self.index is not None:
+                self.index.trim(source.first)
+            self.table.trim(source.first)
+        if self.processing and self.refilter_cursor is None:
+            first = source.first
+            lines = source.lines
+            rows = [(seq, lines(seq)) for seq
+                    in self.matches.matches(max(start, first), stop)]
+            if diagnostics is not None:
+                diagnostics.add('rows', mark, len(rows))
+            if rows:
+                self.append(rows)
+
+    def set_capture_filter(self, *_):
+        # ';' separates alternatives, ',' the fields of one, as in the -f
+        # option of hdlcapture; an empty filter captures everything again
+        try:
+            match = compile_filter(parse_filter(self.capture_text.get()))
+        except ValueError as e:
+            self.note = 'Capture filter: {0}'.format(e)
+            return
+        self.queue.accept = None if match is match_all else match
+        if self.note.startswith('Capture filter'):
+            self.note = ''
+
+    def show_diagnostics(self):
+        if self.diagnostics_window is None:
+            from hdldiag import Diagnostics
+            self.diagnostics = Diagnostics()
+            self.table.diagnostics = self.diagnostics
+            for source in self.sources:
+                source.diagnostics = self.diagnostics
+            self.diagnostics_window = DiagnosticsWindow(
+                self.master, self.diagnostics, self.queue, self.clock
+            )
+        self.diagnostics_window.show()
+
+    def show_latency(self):
+        if self.latency_window is None:
+            self.latency_window = LatencyWindow(self.master, self.correlator,
+                                                self.clock)
+        self.latency_window.show()
+
+    def show_stats(self):
+        if self.stats_window is None:
+            self.stats_window = StatsWindow(self.master, self.stats)
+        self.stats_window.show()
+
     def start(self):
+        if self.packets is not self.live:
+            self.show(self.live)
         self.btn_start.pack_forget()
         self.btn_stop.pack(side=tk.LEFT)
-        self.bus.attach(self.monitor)
+        for source in self.sources:
+            source.attach()
+        self.capturing = True
 
     def stop(self):
+        if not self.capturing:
+            return
         self.btn_stop.pack_forget()
         self.btn_start.pack(side=tk.LEFT)
-        self.bus.detach(self.monitor)
+        for source in self.sources:
+            source.detach()
+        self.capturing = False
+
+
+def parse_args(argv):
+    # -> (CaptureStore keyword arguments, MonitorGui keyword arguments,
+    # sources); raises ValueError. argparse is left out of the frozen
+    # build to keep startup fast.
+    store = {}
+    options = {}
+    sources = []
+    for arg in argv:
+        if not arg.startswith('--'):
+            sources.append(arg)
+            continue
+        name, _, value = arg[2:].partition('=')
+        if name not in OPTIONS:
+            raise ValueError('unknown option {0!r}'.format(arg))
+        key, kind = OPTIONS[name]
+        try:
+            value = kind(value)
+        except ValueError:
+            value = 0
+        if value <= 0:
+            raise ValueError('bad value in {0!r}'.format(arg))
+        (store if key.startswith('max_') else options)[key] = value
+    return store, options, sources
 
 
 if __name__ == '__main__':
-    MonitorGui()
+    try:
+        store, options, sources = parse_args(sys.argv[1:])
+    except ValueError as e:
+        sys.exit('{0}\n\n{1}'.format(e, USAGE))
+    MonitorGui(store=CaptureStore(**store), sources=sources, **options)
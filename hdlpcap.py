@@ -0,0 +1,263 @@
+from socket import inet_aton
+from struct import Struct, error as StructError
+
+from hdlcapture import HDL_PORT, NANOSECONDS, decode_packet, encode_packet
+
+
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1),
+    b'\xa1\xb2\x3c\x4d': ('>', 1),
+}
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+BLOCK_SHB = 0x0a0d0d0a
+BLOCK_IDB = 1
+BLOCK_PB = 2
+BLOCK_EPB = 6
+OPTION_TSRESOL = 9
+OPTION_TSOFFSET = 14
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101, 228)
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+IPPROTO_UDP = 17
+
+ETHERNET = Struct('>6s6sH')
+IPV4 = Struct('>BBHHHBBH4s4s')
+UDP = Struct('>HHHH')
+SHORT = Struct('>H')
+
+BROADCAST_MAC = b'\xff' * 6
+BROADCAST_IP = inet_aton('255.255.255.255')
+EXPORT_MAC = b'\x00' * 6
+EXPORT_TTL = 64
+EXPORT_SNAPLEN = 65535
+WRITE_BUFFER = 1 << 20
+
+
+def ipv4_payload(linktype, frame):
+    # Returns the IPv4 datagram carried by a link layer frame, or None.
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = SHORT.unpack_from(frame, offset)[0]
+        while ethertype in ETHERTYPE_VLAN:
+            offset += 4
+            ethertype = SHORT.unpack_from(frame, offset)[0]
+        offset += 2
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        # address family in either byte order; AF_INET is 2 everywhere
+        offset = 4
+        ethertype = ETHERTYPE_IPV4 if frame[:4] in (
+            b'\x02\x00\x00\x00', b'\x00\x00\x00\x02') else None
+    elif linktype in LINKTYPE_RAW:
+        offset = 0
+        ethertype = ETHERTYPE_IPV4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        offset = 16
+        ethertype = SHORT.unpack_from(frame, 14)[0]
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        offset = 20
+        ethertype = SHORT.unpack_from(frame, 0)[0]
+    else:
+        return None
+    if ethertype != ETHERTYPE_IPV4:
+        return None
+    return frame[offset:]
+
+
+def udp_payload(datagram, port):
+    # Returns the payload of an unfragmented IPv4 UDP datagram from or to
+    # port, or None.
+    if len(datagram) < IPV4.size:
+        return None
+    (version, _, length, _, fragment, _, protocol,
+     _, _, _) = IPV4.unpack_from(datagram)
+    if version >> 4 != 4 or protocol != IPPROTO_UDP or fragment & 0x3fff:
+        return None
+    offset = (version & 0xf) * 4
+    if len(datagram) < offset + UDP.size:
+        return None
+    source_port, destination_port, udp_length, _ = UDP.unpack_from(datagram,
+                                                                   offset)
+    if port not in (source_port, destination_port):
+        return None
+    end = min(offset + udp_length, length, len(datagram))
+    return datagram[offset + UDP.size:end]
+
+
+def decode_frame(linktype, frame, port):
+    try:
+        datagram = ipv4_payload(linktype, frame)
+        payload = datagram and udp_payload(datagram, port)
+        return payload and decode_packet(payload)
+    except (StructError, ValueError):
+        return None
+
+
+def read_pcap(path, port=HDL_PORT):
+    # Returns a generator of (timestamp in ns, packet) for the HDL Buspro
+    # datagrams in a pcap or pcapng file. The file is checked here and then
+    # read one record at a time as the generator is consumed.
+    f = open(path, 'rb')
+    magic = f.read(4)
+    if magic == PCAPNG_MAGIC:
+        return read_pcapng_blocks(f, port)
+    if magic in PCAP_MAGIC:
+        return read_pcap_records(f, magic, port)
+    f.close()
+    raise ValueError('{0} is not a pcap file'.format(path))
+
+
+def read_pcap_records(f, magic, port):
+    try:
+        order, scale = PCAP_MAGIC[magic]
+        header = f.read(20)
+        if len(header) < 20:
+            return
+        linktype = Struct(order + 'HHiIII').unpack(header)[5] & 0xffff
+        record = Struct(order + 'IIII')
+        while True:
+            data = f.read(record.size)
+            if len(data) < record.size:
+                return
+            seconds, fraction, length, _ = record.unpack(data)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            packet = decode_frame(linktype, frame, port)
+            if packet is not None:
+                yield seconds * NANOSECONDS + fraction * scale, packet
+    finally:
+        f.close()
+
+
+def read_pcapng_blocks(f, port):
+    try:
+        f.seek(0)
+        order = '<'
+        interfaces = []
+        while True:
+            header = f.read(12)
+            if len(header) < 12:
+                return
+            if header[:4] == PCAPNG_MAGIC:
+                # every section header sets the byte order of its section
+                order = '<' if Struct('<I').unpack(header[8:])[0] == \
+                    BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+                epb = Struct(order + 'IIIII')
+                pb = Struct(order + 'HHIIII')
+            kind, length = Struct(order + 'II').unpack(header[:8])
+            if length < 12:
+                return
+            data = header[8:] + f.read(length - 12)
+            if len(data) < length - 8:
+                return
+            if kind == BLOCK_IDB:
+                interfaces.append(read_interface(order, data[:-4]))
+                continue
+            if kind == BLOCK_EPB:
+                interface, high, low, captured, _ = epb.unpack_from(data)
+            elif kind == BLOCK_PB:
+                interface, _, high, low, captured, _ = pb.unpack_from(data)
+            else:
+                continue
+            if interface >= len(interfaces):
+                continue
+            linktype, resolution, offset = interfaces[interface]
+            packet = decode_frame(linktype, data[20:20 + captured], port)
+            if packet is not None:
+                yield (offset * NANOSECONDS +
+                       (high << 32 | low) * NANOSECONDS // resolution), packet
+    finally:
+        f.close()
+
+
+def read_interface(order, body):
+    # (link type, timestamp ticks per second, timestamp offset in seconds)
+    linktype = Struct(order + 'H').unpack_from(body)[0]
+    resolution = 1000000
+    offset = 0
+    position = 8
+    while position + 4 <= len(body):
+        code, length = Struct(order + 'HH').unpack_from(body, position)
+        value = body[position + 4:position + 4 + length]
+        if code == 0:
+            break
+        if code == OPTION_TSRESOL and value:
+            exponent = ord(value[:1])
+            resolution = 2 ** (exponent & 0x7f) if exponent & 0x80 \
+                else 10 ** exponent
+        elif code == OPTION_TSOFFSET and length == 8:
+            offset = Struct(order + 'q').unpack(value)[0]
+        position += 4 + (length + 3) // 4 * 4
+    return linktype, resolution, offset
+
+
+def ip_checksum(header):
+    total = sum(SHORT.unpack_from(header, i)[0]
+                for i in range(0, len(header), 2))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def block(kind, body):
+    body += b'\x00' * (-len(body) % 4)
+    length = Struct('<I').pack(len(body) + 12)
+    return Struct('<I').pack(kind) + length + body + length
+
+
+class PcapngWriter(object):
+    # Writes packets as Ethernet broadcast UDP datagrams on the HDL port,
+    # the way they appear on the wire, with nanosecond timestamps.
+    def __init__(self, path, port=HDL_PORT):
+        self.port = port
+        self.file = open(path, 'wb', WRITE_BUFFER)
+        self.file.write(
+            block(BLOCK_SHB, Struct('<IHHq').pack(BYTE_ORDER_MAGIC, 1, 0, -1))
+        )
+        self.file.write(block(BLOCK_IDB, Struct('<HHIHHBxxxHH').pack(
+            LINKTYPE_ETHERNET, 0, EXPORT_SNAPLEN,
+            OPTION_TSRESOL, 1, 9, 0, 0
+        )))
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.file.close()
+
+    def frame(self, packet):
+        payload = encode_packet(packet)
+        udp = UDP.pack(self.port, self.port, UDP.size + len(payload), 0)
+        ip = bytearray(IPV4.pack(
+            0x45, 0, IPV4.size + len(udp) + len(payload), 0, 0, EXPORT_TTL,
+            IPPROTO_UDP, 0, payload[:4], BROADCAST_IP
+        ))
+        ip[10:12] = SHORT.pack(ip_checksum(ip))
+        return (ETHERNET.pack(BROADCAST_MAC, EXPORT_MAC, ETHERTYPE_IPV4) +
+                bytes(ip) + udp + payload)
+
+    def write(self, items):
+        chunks = []
+        epb = Struct('<IIIII')
+        for timestamp, packet in items:
+            frame = self.frame(packet)
+            timestamp = int(timestamp)
+            chunks.append(block(BLOCK_EPB, epb.pack(
+                0, timestamp >> 32, timestamp & 0xffffffff,
+                len(frame), len(frame)
+            ) + frame))
+            self.count += 1
+        self.file.write(b''.join(chunks))
@@ -0,0 +1,191 @@
+import re
+from array import array
+from bisect import bisect_left
+
+
+GRAM_SIZE = 2
+# postings are offsets from ContentIndex.base, rebased past REBASE_AFTER
+POSTING_TYPECODE = 'I'
+POSTING_SIZE = array(POSTING_TYPECODE).itemsize
+REBASE_AFTER = 1 << 31
+# postings lists intersected before the candidates are checked one by one
+INTERSECT_LISTS = 3
+
+TERM = re.compile(r'"[^"]*"|\'[^\']*\'|[^,]+')
+HEX_TERM = re.compile(r'^(?:[0-9a-fA-F]{2}|\?\?)+$')
+RANGE_TERM = re.compile(
+    r'^\[(\d+)\]=([0-9a-fA-F]{1,2})(?:-([0-9a-fA-F]{1,2}))?$'
+)
+
+EMPTY = array(POSTING_TYPECODE)
+
+
+def byte(value):
+    return re.escape(bytes(bytearray([value])))
+
+
+def grams(data):
+    # the grams of data, each read as a big-endian 16 bit number
+    data = bytearray(data)
+    return set([data[i] << 8 | data[i + 1] for i in range(len(data) - 1)])
+
+
+def contains(postings, seq):
+    i = bisect_left(postings, seq)
+    return i < len(postings) and postings[i] == seq
+
+
+class Search(object):
+    # Content search, as typed into the search bar: comma separated terms
+    # that all have to match.
+    #   01 ?? ff     hex bytes anywhere in the content, ?? matching any byte
+    #   "on"         ASCII text anywhere in the content
+    #   [2]=10-1f    byte at offset 2 (from 0) in a hex range, or [2]=10
+    # Every term becomes a regular expression over the content bytes. The
+    # literal runs of the hex and ASCII terms give the grams looked up in
+    # the ContentIndex.
+    def __init__(self, expression):
+        self.expression = expression
+        self.patterns = []
+        self.runs = []
+        for term in TERM.findall(expression):
+            term = term.strip()
+            if not term:
+                continue
+            if term[0] in '"\'' and len(term) > 2 and term[-1] == term[0]:
+                text = term[1:-1]
+                if not isinstance(text, bytes):
+                    text = text.encode('latin-1')
+                self.patterns.append(re.escape(text))
+                self.runs.append(text)
+                continue
+            match = RANGE_TERM.match(term)
+            if match:
+                offset, lo, hi = match.groups()
+                lo = int(lo, 16)
+                hi = int(hi, 16) if hi is not None else lo
+                if lo > hi:
+                    raise ValueError('bad byte range {0!r}'.format(term))
+                self.patterns.append(
+                    b'\\A.{' + str(offset).encode('ascii') + b'}[' +
+                    byte(lo) + b'-' + byte(hi) + b']'
+                )
+                continue
+            term = ''.join(term.split())
+            if not HEX_TERM.match(term):
+                raise ValueError('bad search term {0!r}'.format(term))
+            pattern = []
+            run = bytearray()
+            for i in range(0, len(term), 2):
+                if term[i] == '?':
+                    pattern.append(b'.')
+                    self.runs.append(bytes(run))
+                    run = bytearray()
+                else:
+                    value = int(term[i:i + 2], 16)
+                    pattern.append(byte(value))
+                    run.append(value)
+            self.runs.append(bytes(run))
+            self.patterns.append(b''.join(pattern))
+        if not self.patterns:
+            raise ValueError('empty search')
+        self.patterns = [re.compile(pattern, re.DOTALL).search
+                         for pattern in self.patterns]
+
+    def __call__(self, content):
+        for search in self.patterns:
+            if search(content) is None:
+                return False
+        return True
+
+    def keys(self):
+        keys = set()
+        for run in self.runs:
+            keys.update(grams(run))
+        return keys
+
+
+class ContentIndex(object):
+    # Gram index over the content of a capture source: for every GRAM_SIZE
+    # byte gram, the sorted sequence numbers of the packets with it, kept
+    # as POSTING_SIZE byte offsets from base. There are at most 65536
+    # grams, and a packet adds at most one posting per content byte. A
+    # gram hit only makes a packet a candidate; candidates are checked with
+    # the search itself, reading just their content.
+    def __init__(self):
+        self.clear(0)
+
+    def clear(self, first):
+        self.postings = {}
+        self.base = first
+        self.first = first
+        self.end = first
+        self.trimmed = first
+
+    def candidates(self, search, start, stop):
+        # Sorted sequence numbers in start..stop that may match, or None
+        # when the search has no grams to narrow them down.
+        keys = search.keys()
+        if not keys:
+            return None
+        postings = self.postings
+        base = self.base
+        lists = sorted((postings.get(key, EMPTY) for key in keys), key=len)
+        shortest = lists[0]
+        candidates = shortest[bisect_left(shortest, start - base):
+                              bisect_left(shortest, stop - base)]
+        for other in lists[1:INTERSECT_LISTS]:
+            candidates = [seq for seq in candidates if contains(other, seq)]
+        return [base + seq for seq in candidates]
+
+    def search(self, source, search, start, stop):
+        # Sequence numbers of the packets of source in start..stop whose
+        # content matches, indexing the packets up to stop first.
+        if self.end < stop:
+            self.update(source.iter_contents(self.end, stop), stop)
+        start = max(start, self.first)
+        if start >= stop:
+            return []
+        candidates = self.candidates(search, start, stop)
+        if candidates is None:
+            return [seq for seq, content in source.iter_contents(start, stop)
+                    if search(content)]
+        content_of = source.content_of
+        return [seq for seq in candidates if search(content_of(seq))]
+
+    def trim(self, first):
+        # Postings before first are dropped lazily, once they make up half
+        # of the index, which keeps trimming amortized O(1).
+        self.first = max(self.first, first)
+        if self.first - self.trimmed > self.end - self.first:
+            shift = 0
+            if self.first - self.base > REBASE_AFTER:
+                shift = self.first - self.base
+            for key, postings in list(self.postings.items()):
+                dead = bisect_left(postings, self.first - self.base)
+                if dead == len(postings):
+                    del self.postings[key]
+                elif shift:
+                    self.postings[key] = array(
+                        POSTING_TYPECODE,
+                        [seq - shift for seq in postings[dead:]]
+                    )
+                elif dead:
+                    del postings[:dead]
+            self.base += shift
+            self.trimmed = self.first
+
+    def update(self, items, stop):
+        # Adds items, (seq, content bytes) from self.end on, up to stop.
+        postings = self.postings
+        base = self.base
+        for seq, content in items:
+            if len(content) < GRAM_SIZE:
+                continue
+            seq -= base
+            for key in grams(content):
+                try:
+                    postings[key].append(seq)
+                except KeyError:
+                    postings[key] = array(POSTING_TYPECODE, [seq])
+        self.end = stop
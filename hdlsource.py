@@ -0,0 +1,173 @@
+import socket
+import sys
+import threading
+
+import hdlmiracle
+
+from hdlcapture import (FIELDS, HDL_PORT, Telegram, decode_packet,
+                        monotonic_ns)
+
+
+RECEIVE_BUFFER = 1 << 20
+DATAGRAM_SIZE = 2048
+SOURCE_POLL = 0.5
+
+# Linux only; lets several sockets share the HDL port, one per interface.
+# Older Pythons lack the constant, so it is spelled out there.
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE',
+                          25 if sys.platform.startswith('linux') else None)
+
+BUS_SOURCE = 'bus'
+# prefixes of the addresses of a StreamServer, see hdlstream
+STREAM_SOURCES = ('tcp:', 'unix:')
+
+
+def parse_source(spec):
+    # 'ADDRESS[:PORT][%DEVICE]' -> (address, port, device or None)
+    address, _, device = spec.partition('%')
+    host, sep, port = address.rpartition(':')
+    if not sep:
+        host, port = address, HDL_PORT
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError('bad port in source {0!r}'.format(spec))
+    return host, port, device or None
+
+
+def tag(packet, source):
+    # Sets the source of an hdlmiracle packet, copying it into a Telegram
+    # if the packet takes no new attributes.
+    try:
+        packet.source = source
+        return packet
+    except AttributeError:
+        values = [getattr(packet, field) for field in FIELDS[:-1]]
+        return Telegram(*values + [packet.content, source])
+
+
+class BusSource(object):
+    # The hdlmiracle bus, as MonitorGui has always used it.
+    def __init__(self, put, name=''):
+        self.name = name
+        self.put = put
+        self.received = 0
+        self.errors = 0
+        # why the source stopped, if it did
+        self.error = None
+        self.attached = False
+        # hdlmiracle decodes bus packets before receive() is called, out of
+        # reach of the diagnostics
+        self.diagnostics = None
+        self.monitor = hdlmiracle.Monitor()
+        self.monitor.receive = self.receive
+        self.bus = hdlmiracle.IPBus(strict=False)
+        self.bus.start()
+
+    def attach(self):
+        self.bus.attach(self.monitor)
+        self.attached = True
+
+    def close(self):
+        self.detach()
+
+    def detach(self):
+        if self.attached:
+            self.bus.detach(self.monitor)
+            self.attached = False
+
+    def receive(self, packet):
+        timestamp = monotonic_ns()
+        self.received += 1
+        self.put((timestamp, tag(packet, self.name)))
+
+
+class UDPSource(object):
+    # One socket bound to an address (and on Linux, optionally to a network
+    # device), read by a thread of its own that stamps, decodes and tags
+    # the datagrams before putting them into the shared queue. Decoding
+    # happens on the receiver threads, so the consumer only drains.
+    def __init__(self, spec, put):
+        self.name = spec
+        self.put = put
+        self.received = 0
+        self.errors = 0
+        # why the source stopped, if it did
+        self.error = None
+        self.attached = False
+        self.closed = False
+        self.diagnostics = None
+        host, port, device = parse_source(spec)
+        if device is not None and SO_BINDTODEVICE is None:
+            raise ValueError('device binding is Linux only: {0!r}'.format(
+                spec
+            ))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               RECEIVE_BUFFER)
+        if device is not None:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE,
+                                   device.encode('ascii') + b'\0')
+        self.socket.bind((host, port))
+        self.socket.settimeout(SOURCE_POLL)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def attach(self):
+        self.attached = True
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        self.socket.close()
+
+    def detach(self):
+        self.attached = False
+
+    def run(self):
+        recv = self.socket.recv
+        name = self.name
+        while not self.closed:
+            try:
+                data = recv(DATAGRAM_SIZE)
+            except socket.timeout:
+                continue
+            except socket.error:
+                if self.closed:
+                    return
+                self.errors += 1
+                continue
+            timestamp = monotonic_ns()
+            if not self.attached:
+                continue
+            try:
+                packet = decode_packet(data, source=name)
+            except ValueError:
+                self.errors += 1
+                continue
+            diagnostics = self.diagnostics
+            if diagnostics is not None:
+                diagnostics.add('decode', timestamp)
+            self.received += 1
+            self.put((timestamp, packet))
+
+
+def open_source(spec, put):
+    if spec == BUS_SOURCE:
+        return BusSource(put, spec)
+    if spec.startswith(STREAM_SOURCES):
+        from hdlstream import StreamSource
+        return StreamSource(spec, put)
+    return UDPSource(spec, put)
+
+
+def open_sources(specs, put):
+    # One source per spec: BUS_SOURCE for the hdlmiracle bus, a capture
+    # server address for a StreamSource, anything else for a UDPSource. No
+    # specs means the bus alone, with an empty name.
+    if not specs:
+        return [BusSource(put)]
+    return [open_source(spec, put) for spec in specs]
@@ -0,0 +1,188 @@
+from collections import Counter
+from heapq import heappop, heappush
+from operator import attrgetter
+
+from hdlcapture import NANOSECONDS
+
+
+STATS_CAPACITY = 256
+STATS_SLOTS = 60
+STATS_SLOT = NANOSECONDS
+STATS_WINDOWS = (1, 10, 60)
+STATS_TOP = 10
+
+STATS_KEYS = (
+    ('Device', attrgetter('subnet_id', 'device_id')),
+    ('Operation code', attrgetter('operation_code')),
+    ('IP address', attrgetter('ipaddress')),
+    ('Head', attrgetter('head')),
+    ('Source', lambda packet: getattr(packet, 'source', '')),
+)
+
+
+class SpaceSaving(object):
+    # Heavy hitters in fixed memory (Metwally et al.): at most capacity
+    # keys are counted; a new key takes the place of the smallest one and
+    # inherits its count, which becomes the error bound of the new key.
+    # Known keys cost a dict update; the heap of (count, key) is only
+    # brought up to date when a key has to be evicted.
+    def __init__(self, capacity=STATS_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+        self.total = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, count=1):
+        self.total += count
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+            return
+        error = 0
+        if len(counts) >= self.capacity:
+            heap = self.heap
+            while True:
+                old, victim = heappop(heap)
+                current = counts[victim]
+                if current == old:
+                    break
+                heappush(heap, (current, victim))
+            del counts[victim]
+            del self.errors[victim]
+            error = old
+        counts[key] = error + count
+        self.errors[key] = error
+        heappush(self.heap, (error + count, key))
+
+    def clear(self):
+        self.counts.clear()
+        self.errors.clear()
+        del self.heap[:]
+        self.total = 0
+
+    def top(self, n=STATS_TOP):
+        # [(key, count, error)], largest count first
+        counts = Counter(self.counts).most_common(n)
+        return [(key, count, self.errors[key]) for key, count in counts]
+
+    def update(self, counts):
+        for key, count in counts.items():
+            self.add(key, count)
+
+
+class SlidingCounter(object):
+    # Counts per key over the last slots time slots, as a ring of
+    # SpaceSaving summaries, plus a SpaceSaving over the whole uptime.
+    def __init__(self, capacity=STATS_CAPACITY, slots=STATS_SLOTS,
+                 slot=STATS_SLOT):
+        self.slot = slot
+        self.ring = [SpaceSaving(capacity) for _ in range(slots)]
+        self.ids = [None] * slots
+        self.overall = SpaceSaving(capacity)
+
+    def clear(self):
+        for summary in self.ring:
+            summary.clear()
+        self.ids = [None] * len(self.ring)
+        self.overall.clear()
+
+    def rates(self, window, now, elapsed, n=STATS_TOP):
+        # [(key, packets/s)] of the n busiest keys of the last window
+        # seconds, elapsed being the time counted so far in ns.
+        counts = Counter()
+        for summary in self.window(window, now):
+            counts.update(summary.counts)
+        seconds = self.seconds(window, now, elapsed)
+        return [(key, count / seconds)
+                for key, count in counts.most_common(n)]
+
+    def seconds(self, window, now, elapsed):
+        slots = max(1, window * NANOSECONDS // self.slot)
+        span = (slots - 1) * self.slot + now % self.slot
+        return float(max(min(span, elapsed), 1)) / NANOSECONDS
+
+    def total(self, window, now, elapsed):
+        packets = sum(summary.total for summary in self.window(window, now))
+        return packets / self.seconds(window, now, elapsed)
+
+    def update(self, timestamp, counts):
+        slot_id = timestamp // self.slot
+        i = slot_id % len(self.ring)
+        summary = self.ring[i]
+        if self.ids[i] != slot_id:
+            summary.clear()
+            self.ids[i] = slot_id
+        summary.update(counts)
+        self.overall.update(counts)
+
+    def window(self, window, now):
+        last = now // self.slot
+        slots = min(len(self.ring), max(1, window * NANOSECONDS // self.slot))
+        ids = set(range(last - slots + 1, last + 1))
+        return [summary for summary, slot_id in zip(self.ring, self.ids)
+                if slot_id in ids]
+
+
+class TrafficStats(object):
+    # Traffic per device, operation code, IP and head, fed with the batches
+    # drained from the receive queue. A batch is counted at the time of its
+    # last packet; a batch spans one drain interval, much less than a slot.
+    def __init__(self, capacity=STATS_CAPACITY, slots=STATS_SLOTS,
+                 slot=STATS_SLOT):
+        self.counters = [(name, getter, SlidingCounter(capacity, slots, slot))
+                         for name, getter in STATS_KEYS]
+        self.started = None
+
+    def clear(self):
+        for _, _, counter in self.counters:
+            counter.clear()
+        self.started = None
+
+    def update(self, batch):
+        if not batch:
+            return
+        timestamp = batch[-1][0]
+        if self.started is None:
+            self.started = batch[0][0]
+        packets = [packet for _, packet in batch]
+        for _, getter, counter in self.counters:
+            counter.update(timestamp, Counter(map(getter, packets)))
+
+    def elapsed(self, now):
+        return now - self.started if self.started is not None else 0
+
+    def report(self, now, rank=None, windows=STATS_WINDOWS, n=STATS_TOP):
+        # [(name, [(key, total, {window: packets/s})])] for the n keys with
+        # the most packets/s over the last rank seconds, or with the most
+        # packets since the start when rank is None.
+        elapsed = self.elapsed(now)
+        report = []
+        for name, _, counter in self.counters:
+            capacity = counter.overall.capacity
+            rates = dict((window, dict(counter.rates(window, now, elapsed,
+                                                     capacity)))
+                         for window in windows)
+            if rank is None:
+                keys = [key for key, _, _ in counter.overall.top(n)]
+            else:
+                ranked = rates[rank]
+                keys = sorted(ranked, key=ranked.get, reverse=True)[:n]
+            report.append((name, [
+                (key, counter.overall.counts.get(key, 0),
+                 dict((window, rates[window].get(key, 0.0))
+                      for window in windows))
+                for key in keys
+            ]))
+        return report
+
+    def totals(self, now, windows=STATS_WINDOWS):
+        # ({window: packets/s}, packets since the start) of all traffic
+        counter = self.counters[0][2]
+        elapsed = self.elapsed(now)
+        return (dict((window, counter.total(window, now, elapsed))
+                     for window in windows),
+                counter.overall.total)
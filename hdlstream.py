@@ -0,0 +1,345 @@
+import json
+import os
+import socket
+import threading
+from collections import deque
+from struct import Struct
+from time import time
+
+from hdlcapture import (NANOSECONDS, decode_packet, encode_packet,
+                        monotonic_ns)
+from hdlfilter import compile_filter, match_all, parse_filter
+
+
+# Frames from the server: kind, body length, and for a packet its
+# wall-clock timestamp in ns, for a drop notice the number of packets
+# dropped for the client so far. Packet bodies are the UDP payload of the
+# packet, as on the wire; error bodies are UTF-8 text.
+FRAME = Struct('>BIq')
+KIND_PACKET = 1
+KIND_DROPPED = 2
+KIND_ERROR = 3
+
+# what a client does with packets when its queue is full
+POLICIES = ('oldest', 'newest', 'disconnect')
+
+CLIENT_QUEUE = 10000
+SEND_BATCH = 256
+SERVER_POLL = 0.5
+SUBSCRIBE_TIMEOUT = 5.0
+MAX_SUBSCRIBE = 65536
+RECV_SIZE = 65536
+RECONNECT = 1.0
+
+
+def parse_address(spec):
+    # 'tcp:HOST:PORT' or 'unix:PATH' -> (socket family, address)
+    kind, sep, address = spec.partition(':')
+    if kind == 'tcp' and sep:
+        host, sep, port = address.rpartition(':')
+        if sep and port.isdigit():
+            return socket.AF_INET, (host, int(port))
+    elif kind == 'unix' and sep and address:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError('Unix sockets are not supported here')
+        return socket.AF_UNIX, address
+    raise ValueError('bad stream address {0!r}'.format(spec))
+
+
+def encode_frame(kind, value, body=b''):
+    return FRAME.pack(kind, len(body), value) + body
+
+
+def subscription(expression='', policy=POLICIES[0]):
+    # the line a client starts with
+    return json.dumps({'filter': expression,
+                       'policy': policy}).encode('utf-8') + b'\n'
+
+
+class FrameReader(object):
+    # Splits the bytes received from a server into frames.
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        # [(kind, value, body)] of the frames completed by data
+        buffer = self.buffer + data
+        frames = []
+        position = 0
+        while len(buffer) - position >= FRAME.size:
+            kind, length, value = FRAME.unpack_from(buffer, position)
+            end = position + FRAME.size + length
+            if end > len(buffer):
+                break
+            frames.append((kind, value, buffer[position + FRAME.size:end]))
+            position = end
+        self.buffer = buffer[position:]
+        return frames
+
+
+class Client(object):
+    # One subscriber. Its thread reads the subscription, then sends the
+    # frames publish() queues, so a slow client only holds up itself;
+    # when its queue is full the policy decides what is lost.
+    def __init__(self, server, connection, size):
+        self.server = server
+        self.socket = connection
+        self.items = deque()
+        self.size = size
+        self.subscribed = False
+        self.match = None
+        self.policy = server.policy
+        self.dropped = 0
+        self.reported = 0
+        self.sent = 0
+        self.wakeup = threading.Event()
+        self.closed = False
+        # started by the server once the client is in its list
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def put(self, frame):
+        # with the oldest policy, items has a maxlen and append() drops
+        items = self.items
+        if len(items) >= self.size:
+            self.dropped += 1
+            if self.policy == 'newest':
+                return
+            if self.policy == 'disconnect':
+                self.close()
+                return
+        items.append(frame)
+        self.wakeup.set()
+
+    def run(self):
+        try:
+            if self.subscribe():
+                self.send()
+        except (socket.error, ValueError):
+            pass
+        finally:
+            self.closed = True
+            self.server.remove(self)
+            self.socket.close()
+
+    def send(self):
+        items = self.items
+        sendall = self.socket.sendall
+        while not self.closed:
+            self.wakeup.wait(SERVER_POLL)
+            self.wakeup.clear()
+            while items and not self.closed:
+                if self.dropped != self.reported:
+                    self.reported = self.dropped
+                    sendall(encode_frame(KIND_DROPPED, self.reported))
+                frames = []
+                while items and len(frames) < SEND_BATCH:
+                    frames.append(items.popleft())
+                sendall(b''.join(frames))
+                self.sent += len(frames)
+
+    def subscribe(self):
+        # Reads the subscription line; an invalid one is answered with an
+        # error frame.
+        self.socket.settimeout(SUBSCRIBE_TIMEOUT)
+        line = b''
+        while not line.endswith(b'\n'):
+            data = self.socket.recv(RECV_SIZE)
+            if not data:
+                return False
+            line += data
+            if len(line) > MAX_SUBSCRIBE:
+                raise ValueError('subscription too long')
+        self.socket.settimeout(None)
+        try:
+            request = json.loads(line.decode('utf-8'))
+            policy = request.get('policy') or self.policy
+            if policy not in POLICIES:
+                raise ValueError('unknown policy {0!r}'.format(policy))
+            match = compile_filter(parse_filter(request.get('filter') or
+                                                ''))
+        except (ValueError, AttributeError) as e:
+            self.socket.sendall(encode_frame(KIND_ERROR, 0,
+                                             str(e).encode('utf-8')))
+            return False
+        self.policy = policy
+        if policy == 'oldest':
+            self.items = deque(maxlen=self.size)
+        self.match = None if match is match_all else match
+        self.subscribed = True
+        return True
+
+
+class StreamServer(object):
+    # Fans the packets of one capture out to subscribers over TCP or a
+    # Unix socket. A client sends a subscription line, the JSON object
+    # {"filter": EXPR, "policy": POLICY}, EXPR in the -f syntax and
+    # POLICY one of POLICIES, and then receives FRAMEs. publish() filters
+    # each batch once per client and encodes each packet once, on the
+    # caller's thread; clients are sent to by threads of their own.
+    def __init__(self, spec, size=CLIENT_QUEUE, policy=POLICIES[0]):
+        self.family, address = parse_address(spec)
+        self.size = size
+        self.policy = policy
+        self.clients = []
+        self.lock = threading.Lock()
+        self.closed = False
+        self.socket = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                                   1)
+        self.socket.bind(address)
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.settimeout(SERVER_POLL)
+        # the bound address, with the actual port if port 0 was asked for
+        self.address = self.socket.getsockname()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.clients)
+
+    def add(self, client):
+        with self.lock:
+            self.clients = self.clients + [client]
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        self.socket.close()
+        if self.family != socket.AF_INET:
+            os.remove(self.address)
+        for client in self.clients:
+            client.close()
+            client.thread.join()
+
+    def publish(self, items):
+        # items: [(wall-clock timestamp in ns, packet)]
+        clients = self.clients
+        if not clients or not items:
+            return
+        frames = [None] * len(items)
+        for client in clients:
+            if not client.subscribed or client.closed:
+                continue
+            match = client.match
+            for i, (timestamp, packet) in enumerate(items):
+                if match is not None and not match(packet):
+                    continue
+                frame = frames[i]
+                if frame is None:
+                    frame = frames[i] = encode_frame(
+                        KIND_PACKET, timestamp, encode_packet(packet)
+                    )
+                client.put(frame)
+
+    def remove(self, client):
+        with self.lock:
+            self.clients = [c for c in self.clients if c is not client]
+
+    def run(self):
+        while not self.closed:
+            try:
+                connection, _ = self.socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                if self.closed:
+                    return
+                continue
+            connection.settimeout(None)
+            client = Client(self, connection, self.size)
+            self.add(client)
+            client.thread.start()
+
+
+class StreamSource(object):
+    # A StreamServer as a capture source, read by a thread of its own like
+    # UDPSource. spec is the server address, optionally followed by '#'
+    # and a filter for the server to apply. Server timestamps are taken
+    # over, as local monotonic time; a lost connection is retried every
+    # RECONNECT s, an error from the server ends the source.
+    def __init__(self, spec, put, policy=POLICIES[0]):
+        self.name = spec
+        address, _, self.expression = spec.partition('#')
+        self.family, self.address = parse_address(address)
+        self.policy = policy
+        self.put = put
+        self.received = 0
+        self.errors = 0
+        self.dropped = 0
+        self.error = None
+        self.attached = False
+        self.closed = False
+        self.diagnostics = None
+        self.stopped = threading.Event()
+        self.offset = int(time() * NANOSECONDS) - monotonic_ns()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def attach(self):
+        self.attached = True
+
+    def close(self):
+        self.closed = True
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def detach(self):
+        self.attached = False
+
+    def receive(self, connection):
+        connection.settimeout(SERVER_POLL)
+        connection.connect(self.address)
+        connection.sendall(subscription(self.expression, self.policy))
+        reader = FrameReader()
+        name = self.name
+        while not self.closed:
+            try:
+                data = connection.recv(RECV_SIZE)
+            except socket.timeout:
+                continue
+            if not data:
+                return
+            for kind, value, body in reader.feed(data):
+                if kind == KIND_PACKET:
+                    if not self.attached:
+                        continue
+                    try:
+                        packet = decode_packet(body, source=name)
+                    except ValueError:
+                        self.errors += 1
+                        continue
+                    self.received += 1
+                    self.put((value - self.offset, packet))
+                elif kind == KIND_DROPPED:
+                    self.dropped = value
+                elif kind == KIND_ERROR:
+                    raise ValueError(body.decode('utf-8', 'replace'))
+
+    def run(self):
+        while not self.closed:
+            connection = socket.socket(self.family, socket.SOCK_STREAM)
+            try:
+                self.receive(connection)
+            except socket.error:
+                self.errors += 1
+            except ValueError as e:
+                self.error = str(e)
+                return
+            finally:
+                connection.close()
+            self.stopped.wait(RECONNECT)
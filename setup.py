@@ -37,6 +37,7 @@ build_exe_options = {
         '_hashlib',
         '_ssl',
         '_threading_local',
+        'argparse',
         'atexit',
         'bdb',
         'bz2',
@@ -58,10 +59,13 @@ build_exe_options = {
         'opcode',
         'optparse',
         'pdb',
+        'pickle',
         'pprint',
         'random',
+        'readline',
         'shlex',
         'ssl',
+        'subprocess',
         'tempfile',
         'textwrap',
         'token',
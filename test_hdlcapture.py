@@ -0,0 +1,244 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from hdlcapture import (HEADER_SIZE, INTERN_FALLBACK, NANOSECONDS,
+                        REORDER_WINDOW, STORE_CAPACITY, STORE_INTERN,
+                        CaptureStore, Content, IPv4, OperationCode,
+                        PacketQueue, Telegram, main, monotonic_ns)
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import hdlmiracle
+except ImportError:
+    hdlmiracle = None
+
+
+def telegram(i, head='HDLMIRACLE', source='', size=4):
+    return Telegram(IPv4(0x7f000001 + i % 7), head, 1, i % 256, 0x0123,
+                    OperationCode(0x0031 + i % 3), 2, 3,
+                    Content(bytearray((i + j) % 256 for j in range(size))),
+                    source)
+
+
+def fields(packet):
+    return (int(packet.ipaddress), packet.head, packet.subnet_id,
+            packet.device_id, packet.device_type, int(packet.operation_code),
+            packet.target_subnet_id, packet.target_device_id,
+            bytes(packet.content), packet.source)
+
+
+class QueueTest(unittest.TestCase):
+    def test_counts_per_receiver(self):
+        queue = PacketQueue(maxlen=1000,
+                            accept=lambda packet: packet.device_id % 2)
+
+        def receive():
+            for i in range(1000):
+                queue.put((i, telegram(i)))
+
+        threads = [threading.Thread(target=receive) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        count = len(queue.drain())
+        self.assertTrue(1000 <= count < 1004, count)
+        self.assertEqual((queue.received, queue.filtered, queue.dropped),
+                         (count, 2000, 2000 - count))
+
+    def test_budget(self):
+        queue = PacketQueue()
+        for i in range(10):
+            queue.put((i, telegram(i)))
+        self.assertEqual([t for t, _ in queue.drain(4)], [0, 1, 2, 3])
+        self.assertEqual(queue.delayed, 6)
+        self.assertEqual([t for t, _ in queue.drain(4)], [4, 5, 6, 7])
+        self.assertEqual(queue.delayed, 6)
+        self.assertEqual(len(queue), 2)
+
+    def test_ordered_across_batches(self):
+        queue = PacketQueue(ordered=True)
+        # stamped ahead, so they are held back however slow the test runs
+        now = monotonic_ns() + 5 * REORDER_WINDOW
+        queue.put((now, 'new'))
+        queue.put((now - 10 * REORDER_WINDOW, 'old'))
+        self.assertEqual([packet for _, packet in queue.drain()], ['old'])
+        # a receiver queues a packet stamped before the one held back
+        queue.put((now - 1, 'late'))
+        self.assertEqual(queue.drain(), [])
+        self.assertEqual(len(queue), 2)
+        time.sleep(7.0 * REORDER_WINDOW / NANOSECONDS)
+        self.assertEqual([packet for _, packet in queue.drain()],
+                         ['late', 'new'])
+        self.assertEqual(queue.received, 3)
+
+
+class StoreTest(unittest.TestCase):
+    def test_round_trip(self):
+        store = CaptureStore()
+        packets = [telegram(i, source='bus', size=i % 20) for i in range(50)]
+        for i, packet in enumerate(packets):
+            self.assertEqual(store.append(1000 + i, packet), i)
+        self.assertEqual(len(store), 50)
+        self.assertEqual([fields(packet) for _, _, packet in store],
+                         [fields(packet) for packet in packets])
+        timestamp, packet = store[7]
+        self.assertEqual(timestamp, 1007)
+        self.assertEqual(fields(packet), fields(packets[7]))
+        self.assertEqual(store.content_of(7), bytes(packets[7].content))
+        self.assertEqual(store.bytes,
+                         sum(HEADER_SIZE + len(packet.content)
+                             for packet in packets))
+
+    def test_grow_after_wrap(self):
+        store = CaptureStore(max_packets=STORE_CAPACITY * 3)
+        for i in range(STORE_CAPACITY * 4):
+            store.append(i, telegram(i))
+        self.assertEqual(store.capacity, STORE_CAPACITY * 3)
+        self.assertEqual(store.first, STORE_CAPACITY)
+        self.assertEqual([timestamp for _, timestamp, _ in store],
+                         list(range(STORE_CAPACITY, STORE_CAPACITY * 4)))
+
+    def test_max_packets(self):
+        store = CaptureStore(max_packets=10)
+        for i in range(25):
+            store.append(i, telegram(i))
+        self.assertEqual((store.first, store.end, len(store)), (15, 25, 10))
+        self.assertEqual(store.evicted, 15)
+        self.assertRaises(IndexError, store.__getitem__, 14)
+        self.assertRaises(IndexError, store.__getitem__, 25)
+        self.assertEqual(store[15][0], 15)
+        # readers holding an evicted position carry on from the first
+        self.assertEqual([seq for seq, _, _ in store.iter_from(3)],
+                         list(range(15, 25)))
+
+    def test_max_bytes(self):
+        size = HEADER_SIZE + 10
+        store = CaptureStore(max_bytes=size * 5)
+        for i in range(20):
+            store.append(i, telegram(i, size=10))
+        self.assertEqual(len(store), 5)
+        self.assertEqual(store.bytes, size * 5)
+        # a packet larger than the limit on its own is still kept
+        large = telegram(20, size=size * 5)
+        store.append(20, large)
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.content_of(20), bytes(large.content))
+
+    def test_max_age(self):
+        store = CaptureStore(max_age=2)
+        for i in range(10):
+            store.append(i * NANOSECONDS, telegram(i))
+        self.assertEqual(store.first, 7)
+        self.assertEqual(store[store.first][0], 7 * NANOSECONDS)
+
+    def test_content_buffer_shrinks(self):
+        store = CaptureStore(max_packets=100)
+        for i in range(10000):
+            store.append(i, telegram(i, size=8))
+        self.assertTrue(len(store.content) <= 2 * 100 * 8)
+        self.assertEqual([store.content_of(seq) for seq in range(9990, 10000)],
+                         [bytes(telegram(i, size=8).content)
+                          for i in range(9990, 10000)])
+
+    def test_clear(self):
+        store = CaptureStore()
+        for i in range(10):
+            store.append(i, telegram(i, head='H{0}'.format(i)))
+        store.clear()
+        self.assertEqual((len(store), store.first, store.end), (0, 10, 10))
+        self.assertEqual(len(store.heads), 1)
+        self.assertEqual(list(store), [])
+
+
+class InternTest(unittest.TestCase):
+    def test_heads_past_the_limit_in_a_full_store(self):
+        store = CaptureStore(max_packets=1000)
+        count = STORE_INTERN + 5000
+        for i in range(count):
+            store.append(i, telegram(i, head='{0:010d}'.format(i)))
+        # the ids of evicted heads are reused, none falls back
+        self.assertEqual([packet.head for _, _, packet in store],
+                         ['{0:010d}'.format(i)
+                          for i in range(count - 1000, count)])
+        self.assertEqual(len(store.heads), 1001)
+        self.assertTrue(len(store.heads.values) <= 1002)
+
+    def test_fallback_while_all_are_stored(self):
+        store = CaptureStore(max_packets=None)
+        count = STORE_INTERN + 10
+        for i in range(count):
+            store.append(i, telegram(i, head='{0:010d}'.format(i)))
+        heads = [packet.head for _, _, packet in store]
+        self.assertEqual(heads[STORE_INTERN - 2], '{0:010d}'.format(
+            STORE_INTERN - 2))
+        self.assertEqual(heads[STORE_INTERN - 1:],
+                         [INTERN_FALLBACK] * 11)
+        # a head already known keeps its id
+        store.append(count, telegram(count, head='0000000005'))
+        self.assertEqual(store[count][1].head, '0000000005')
+
+    def test_shared_values_are_kept_while_used(self):
+        store = CaptureStore(max_packets=3)
+        for i, (head, source) in enumerate([('A', 'x'), ('B', 'y'),
+                                            ('A', 'x'), ('C', 'x')]):
+            store.append(i, telegram(i, head=head, source=source))
+        self.assertEqual([(packet.head, packet.source)
+                          for _, _, packet in store],
+                         [('B', 'y'), ('A', 'x'), ('C', 'x')])
+        store.append(4, telegram(4, head='D', source='z'))
+        store.append(5, telegram(5, head='E', source='z'))
+        self.assertEqual(sorted(store.heads.index),
+                         sorted([INTERN_FALLBACK, 'C', 'D', 'E']))
+        self.assertEqual(sorted(store.sources.index),
+                         sorted([INTERN_FALLBACK, 'x', 'z']))
+
+
+@unittest.skipIf(hdlmiracle is None, 'no hdlmiracle')
+class MainTest(unittest.TestCase):
+    def check_error(self, argv, message):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            with self.assertRaises(SystemExit) as raised:
+                main(argv)
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(raised.exception.code, 2)
+        self.assertTrue(output.startswith('hdlcapture: '), output)
+        self.assertTrue(message in output, output)
+        self.assertFalse('Traceback' in output)
+
+    def test_bad_output(self):
+        path = os.path.join(tempfile.mkdtemp(), 'missing', 'out.txt')
+        self.addCleanup(os.rmdir, os.path.dirname(os.path.dirname(path)))
+        self.check_error(['-o', path], 'out.txt')
+
+    def test_missing_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'missing.cap')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.check_error(['-r', path], 'missing.cap')
+
+    def test_not_a_capture_file(self):
+        for data in (b'', b'not a capture file'):
+            handle, path = tempfile.mkstemp()
+            os.write(handle, data)
+            os.close(handle)
+            self.addCleanup(os.remove, path)
+            self.check_error(['-r', path], 'is not a capture file')
+
+    def test_bad_source(self):
+        self.check_error(['-i', '127.0.0.1:port'], "'127.0.0.1:port'")
+
+
+if __name__ == '__main__':
+    unittest.main()
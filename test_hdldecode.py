@@ -0,0 +1,94 @@
+import unittest
+
+import hdldecode
+from hdlcapture import Content, IPv4, OperationCode, Telegram
+from hdldecode import (CACHE, DECODERS, FIELD_FORMATS, RESULT_SUCCESS,
+                       decoded_fields, decoded_text, decoder)
+
+
+def telegram(operation_code, content, device_type=0x0100):
+    return Telegram(IPv4(0x0a000001), 'HDLMIRACLE', 1, 2, device_type,
+                    OperationCode(operation_code), 3, 4,
+                    Content(bytearray(content)))
+
+
+class DecodeTest(unittest.TestCase):
+    def check(self, operation_code, content, fields, text):
+        packet = telegram(operation_code, content)
+        self.assertEqual(decoded_fields(packet), fields)
+        self.assertEqual(decoded_text(packet), text)
+
+    def test_decoders(self):
+        self.check(0x0002, [1, 5], {'area': 1, 'scene': 5},
+                   'Scene: area=1 scene=5')
+        self.check(0x001b, [2, 3], {'area': 2, 'sequence': 3},
+                   'Sequence: area=2 sequence=3')
+        self.check(0x0031, [4, 50, 0, 3],
+                   {'channel': 4, 'level': 50, 'time': 3},
+                   'Channel control: channel=4 level=50% time=3s')
+        self.check(0x0032, [4, RESULT_SUCCESS, 100],
+                   {'channel': 4, 'result': RESULT_SUCCESS, 'level': 100},
+                   'Channel control reply: channel=4 result=ok level=100%')
+        self.check(0x0032, [4, 0xf5, 0],
+                   {'channel': 4, 'result': 0xf5, 'level': 0},
+                   'Channel control reply: channel=4 result=failed '
+                   'level=0%')
+        self.check(0x0034, [3, 0, 50, 100], {'channels': 3},
+                   'Channel status: channels=3 levels=0,50,100')
+        self.check(0xe01d, [7, 1], {'switch': 7, 'status': 1},
+                   'Universal switch: switch=7 status=on')
+
+    def test_longer_content(self):
+        # trailing bytes are ignored
+        self.check(0x0002, [1, 5, 9, 9], {'area': 1, 'scene': 5},
+                   'Scene: area=1 scene=5')
+
+    def test_malformed(self):
+        self.check(0x0031, [4, 50], {}, 'Channel control: malformed')
+        self.check(0x0034, [3, 0], {}, 'Channel status: malformed')
+        self.check(0x0002, [], {}, 'Scene: malformed')
+
+    def test_unknown(self):
+        self.check(0x1234, [1, 2, 3], {}, '')
+
+    def test_cached(self):
+        packet = telegram(0x0002, [1, 5])
+        self.assertTrue(decoded_fields(packet) is
+                        decoded_fields(telegram(0x0002, bytearray([1, 5]))))
+        self.assertTrue((0x0002, 0x0100, b'\x01\x05') in CACHE)
+
+    def test_cache_is_bounded(self):
+        size = hdldecode.DECODE_CACHE_SIZE
+        hdldecode.DECODE_CACHE_SIZE = 10
+        try:
+            for i in range(25):
+                decoded_text(telegram(0x0002, [1, i]))
+                self.assertTrue(len(CACHE) <= 10)
+        finally:
+            hdldecode.DECODE_CACHE_SIZE = size
+
+
+class RegistryTest(unittest.TestCase):
+    def tearDown(self):
+        DECODERS.pop((0x0002, 0x0999), None)
+        FIELD_FORMATS.pop('dimmer', None)
+        CACHE.clear()
+
+    def test_device_type_first(self):
+        @decoder((0x0002,), 'Dimmer scene', (('dimmer', '{0:02x}'),),
+                 device_type=0x0999)
+        def dimmer_scene(data):
+            return [('dimmer', bytearray(data)[0]), ('raw', (1, 2))]
+
+        packet = telegram(0x0002, [10, 5], device_type=0x0999)
+        self.assertEqual(decoded_fields(packet), {'dimmer': 10})
+        self.assertEqual(decoded_text(packet),
+                         'Dimmer scene: dimmer=0a raw=1,2')
+        # other device types keep the generic decoder
+        self.assertEqual(decoded_text(telegram(0x0002, [10, 5])),
+                         'Scene: area=10 scene=5')
+        self.assertTrue('dimmer' in FIELD_FORMATS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from hdlcapture import Content, IPv4, OperationCode, Telegram
+from hdlfile import (INDEX_INTERVAL, INDEX_MARKER, MAGIC, CaptureFile,
+                     CaptureWriter, Replayer)
+
+
+def telegram(i, source=''):
+    return Telegram(IPv4(0x0a000001 + i % 5), 'HDLMIRACLE', i % 4, i % 256,
+                    0x0100 + i % 3, OperationCode(0x0031 + i % 4), 1, i % 7,
+                    Content(bytearray((i + j) % 256 for j in range(i % 40))),
+                    source)
+
+
+def fields(packet):
+    return (int(packet.ipaddress), packet.head, packet.subnet_id,
+            packet.device_id, packet.device_type, int(packet.operation_code),
+            packet.target_subnet_id, packet.target_device_id,
+            bytes(packet.content), packet.source)
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'test.cap')
+
+    def write(self, items):
+        writer = CaptureWriter(self.path)
+        for timestamp, packet in items:
+            writer.put(timestamp, packet)
+        writer.close()
+        self.assertEqual(writer.error, None)
+        self.assertEqual(len(writer), len(items))
+
+    def open(self):
+        capture = CaptureFile(self.path)
+        self.addCleanup(capture.close)
+        return capture
+
+    def check(self, capture, items):
+        self.assertEqual(len(capture), len(items))
+        self.assertEqual([(timestamp, fields(packet))
+                          for _, timestamp, packet in capture],
+                         [(timestamp, fields(packet))
+                          for timestamp, packet in items])
+
+
+class FileTest(CaptureTest):
+    def test_round_trip(self):
+        items = [(1000000 * i, telegram(i))
+                 for i in range(INDEX_INTERVAL * 2 + 100)]
+        self.write(items)
+        capture = self.open()
+        self.assertEqual(len(capture.chunks), 3)
+        self.check(capture, items)
+        timestamp, packet = capture[INDEX_INTERVAL + 5]
+        self.assertEqual(fields(packet), fields(items[INDEX_INTERVAL + 5][1]))
+        self.assertEqual(capture.lines(39), 5)
+        self.assertEqual(capture.lines(0), 1)
+        self.assertEqual([seq for seq, _, _ in capture.iter_from(-5, 3)],
+                         [0, 1, 2])
+        self.assertRaises(IndexError, capture.__getitem__, len(items))
+
+    def test_empty(self):
+        self.write([])
+        self.check(self.open(), [])
+
+    def test_head(self):
+        # heads are any 10 bytes, kept as latin-1 text
+        items = [(0, telegram(0)), (1, telegram(1))]
+        items[1][1].head = 'HD\xe9\xffMIRACL'
+        self.write(items)
+        self.check(self.open(), items)
+
+    def test_truncated(self):
+        items = [(i, telegram(i)) for i in range(INDEX_INTERVAL + 50)]
+        self.write(items)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        first_index = data.index(INDEX_MARKER)
+        last_index = data.rindex(INDEX_MARKER)
+        for size, count in ((len(MAGIC), 0),
+                            (first_index, INDEX_INTERVAL),
+                            (first_index + 10, INDEX_INTERVAL),
+                            (last_index - 1, len(items) - 1),
+                            (last_index + 20, len(items)),
+                            (len(data) - 1, len(items))):
+            with open(self.path, 'wb') as f:
+                f.write(data[:size])
+            capture = CaptureFile(self.path)
+            try:
+                self.check(capture, items[:count])
+            finally:
+                capture.close()
+
+    def test_not_a_capture(self):
+        for data in (b'', b'HDLCA', b'not a capture file at all'):
+            with open(self.path, 'wb') as f:
+                f.write(data)
+            self.assertRaises(ValueError, CaptureFile, self.path)
+
+    def test_write_error(self):
+        writer = CaptureWriter(self.path)
+        writer.file.close()
+        writer.put(0, telegram(0))
+        writer.close()
+        self.assertTrue(writer.error is not None)
+
+    def test_sources(self):
+        items = [(i, telegram(i, ['', 'bus', '10.0.0.1:6000%eth0',
+                                  'tcp:caf\xe9:1'][i % 4]))
+                 for i in range(100)]
+        self.write(items)
+        capture = self.open()
+        self.check(capture, items)
+        self.assertEqual(capture.lines(39), 5)
+
+    def test_contents(self):
+        items = [(i, telegram(i, 'bus' if i % 2 else ''))
+                 for i in range(100)]
+        self.write(items)
+        capture = self.open()
+        self.assertEqual(capture.content_of(7), bytes(items[7][1].content))
+        self.assertEqual([(seq, bytes(content)) for seq, content
+                          in capture.iter_contents(95, 200)],
+                         [(i, bytes(items[i][1].content))
+                          for i in range(95, 100)])
+
+
+class Monitor(object):
+    def __init__(self):
+        self.packets = []
+
+    def receive(self, packet):
+        self.packets.append(packet)
+
+
+class ReplayTest(CaptureTest):
+    def test_replay(self):
+        items = [(i, telegram(i)) for i in range(500)]
+        self.write(items)
+        monitor = Monitor()
+        replayer = Replayer(self.open(), monitor, pending=lambda: 0)
+        replayer.start()
+        replayer.thread.join(10)
+        self.assertTrue(replayer.finished is not None)
+        self.assertEqual(replayer.sent, 500)
+        self.assertEqual([fields(packet) for packet in monitor.packets],
+                         [fields(packet) for _, packet in items])
+        self.assertTrue(replayer.rate() > 0)
+
+    def test_speed(self):
+        # 100 ms of traffic, replayed ten times as fast
+        items = [(i * 10000000, telegram(i)) for i in range(11)]
+        self.write(items)
+        monitor = Monitor()
+        replayer = Replayer(self.open(), monitor, speed=10)
+        replayer.start()
+        replayer.thread.join(10)
+        self.assertEqual(len(monitor.packets), 11)
+        elapsed = (replayer.finished - replayer.started) / 1e9
+        self.assertTrue(0.005 < elapsed < 1.0, elapsed)
+
+    def test_stop(self):
+        items = [(i * 1000000000, telegram(i)) for i in range(10)]
+        self.write(items)
+        monitor = Monitor()
+        replayer = Replayer(self.open(), monitor, speed=1)
+        replayer.start()
+        replayer.stop()
+        self.assertFalse(replayer.thread.is_alive())
+        self.assertTrue(replayer.sent < 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+import unittest
+
+from hdlcapture import Content, IPv4, OperationCode, Telegram
+from hdlfilter import (INDEX_MIN_ROWS, MatchCache, Predicate, compile_filter,
+                       compile_rows, match_all, parse_conditions,
+                       parse_filter, parse_value)
+
+
+def telegram(i):
+    return Telegram(IPv4(0x0a000001 + i % 5), 'HDLMIRACLE', i % 4, i % 256,
+                    0x0100 + i % 3, OperationCode(0x0031 + i % 4), 1, i % 7,
+                    Content(bytearray([i % 8, 100 - i % 101, 0, 0])))
+
+
+PACKETS = [telegram(i) for i in range(1000)]
+
+
+def row(**values):
+    return sorted(values.items())
+
+
+def expected(rows, packets=PACKETS):
+    return [i for i, packet in enumerate(packets)
+            if any(all(getattr(packet, key) == value for key, value in r)
+                   for r in rows)]
+
+
+def matched(match, packets=PACKETS):
+    return [i for i, packet in enumerate(packets) if match(packet)]
+
+
+class CompileTest(unittest.TestCase):
+    def test_no_rows(self):
+        self.assertTrue(compile_filter([]) is match_all)
+        # a row without conditions matches everything
+        self.assertTrue(compile_filter([row(device_id=1), row()])
+                        is match_all)
+
+    def test_rows(self):
+        rows = [row(device_id=3), row(subnet_id=1, operation_code=0x0032)]
+        self.assertEqual(matched(compile_filter(rows)), expected(rows))
+        self.assertEqual(matched(compile_filter(rows[:1])),
+                         expected(rows[:1]))
+
+    def test_indexed(self):
+        rows = [row(operation_code=0x0031 + i % 4, device_id=i)
+                for i in range(INDEX_MIN_ROWS * 2)]
+        rows.append(row(target_device_id=6))
+        self.assertEqual(matched(compile_filter(rows)), expected(rows))
+        match = compile_rows(rows)
+        for i, packet in enumerate(PACKETS[:300]):
+            self.assertEqual(match(packet),
+                             [n for n, r in enumerate(rows)
+                              if i in expected([r], PACKETS[:300])])
+
+    def test_compile_rows(self):
+        rows = [row(device_id=1), row(subnet_id=1), row(device_id=2)]
+        match = compile_rows(rows)
+        self.assertEqual(match(PACKETS[1]), [0, 1])
+        self.assertEqual(match(PACKETS[2]), [2])
+        self.assertEqual(match(PACKETS[3]), [])
+
+
+class MatchCacheTest(unittest.TestCase):
+    def update(self, cache, start, stop, chunk=64):
+        for cursor in range(start, stop, chunk):
+            end = min(cursor + chunk, stop)
+            cache.update(((seq, PACKETS[seq]) for seq in range(cursor, end)),
+                         end)
+
+    def test_matches(self):
+        rows = [row(device_id=5), row(operation_code=0x0033, subnet_id=2)]
+        cache = MatchCache()
+        cache.clear(0)
+        cache.configure(rows)
+        self.assertEqual(cache.behind(100), [tuple(r) for r in rows])
+        self.update(cache, 0, 1000)
+        self.assertEqual(cache.behind(1000), [])
+        self.assertEqual(cache.matches(0, 1000), expected(rows))
+        self.assertEqual(cache.matches(13, 501),
+                         [i for i in expected(rows) if 13 <= i < 501])
+
+    def test_reconfigure_keeps_rows(self):
+        cache = MatchCache()
+        cache.clear(0)
+        kept = row(device_id=5)
+        cache.configure([kept, row(subnet_id=3)])
+        self.update(cache, 0, 1000)
+        bitmap = cache.bitmaps[tuple(kept)]
+        added = row(target_device_id=4)
+        cache.configure([kept, added, kept])
+        self.assertTrue(cache.bitmaps[tuple(kept)] is bitmap)
+        self.assertEqual(cache.behind(1000), [tuple(added)])
+        self.update(cache, 0, 1000)
+        self.assertEqual(cache.matches(0, 1000), expected([kept, added]))
+
+    def test_no_rows_match_everything(self):
+        cache = MatchCache()
+        cache.clear(10)
+        cache.configure([])
+        self.assertEqual(cache.matches(10, 20), list(range(10, 20)))
+        cache.configure([row(device_id=1), row()])
+        self.assertEqual(cache.matches(10, 12), [10, 11])
+
+    def test_trim(self):
+        rows = [row(device_id=7)]
+        cache = MatchCache()
+        cache.clear(0)
+        cache.configure(rows)
+        packets = PACKETS * 60
+        for cursor in range(0, len(packets), 1000):
+            cache.update(((seq, packets[seq])
+                          for seq in range(cursor, cursor + 1000)),
+                         cursor + 1000)
+            cache.trim(max(0, cursor - 2000))
+        self.assertTrue(cache.base > 0)
+        self.assertEqual(cache.matches(57000, 60000),
+                         [block + i for block in (57000, 58000, 59000)
+                          for i in expected(rows)])
+
+    def test_clear(self):
+        cache = MatchCache()
+        cache.clear(0)
+        cache.configure([row(device_id=1)])
+        self.update(cache, 0, 100)
+        cache.clear(500)
+        self.assertEqual(cache.behind(501), [(('device_id', 1),)])
+        cache.update(((seq, PACKETS[seq - 500]) for seq in range(500, 600)),
+                     600)
+        self.assertEqual(cache.matches(500, 600), [501])
+
+
+class SyntaxTest(unittest.TestCase):
+    def check(self, expression, accepted):
+        rows = [parse_conditions(expression)]
+        self.assertEqual(matched(compile_filter(rows)),
+                         [i for i, packet in enumerate(PACKETS)
+                          if accepted(packet)])
+
+    def test_exact(self):
+        self.assertEqual(parse_value('device_id', '12'), 12)
+        self.assertEqual(parse_value('operation_code', '0031'), 0x0031)
+        self.assertEqual(parse_value('ipaddress', '10.0.0.1'), '10.0.0.1')
+        self.assertEqual(parse_value('head', 'HDLMIRACLE'), 'HDLMIRACLE')
+        self.check('device_id=12', lambda p: p.device_id == 12)
+
+    def test_range_list_mask(self):
+        self.assertTrue(isinstance(parse_value('device_id', '1-5'),
+                                   Predicate))
+        self.check('device_id=1-5', lambda p: 1 <= p.device_id <= 5)
+        self.check('device_id=1,2,7', lambda p: p.device_id in (1, 2, 7))
+        self.check('device_id=1,10-12', lambda p: p.device_id in
+                   (1, 10, 11, 12))
+        self.check('operation_code=0030/fffe',
+                   lambda p: p.operation_code in (0x0030, 0x0031))
+        self.check('ipaddress=10.0.0.0/30',
+                   lambda p: int(p.ipaddress) < 0x0a000004)
+        self.check('ipaddress=10.0.0.2', lambda p: p.ipaddress == 0x0a000002)
+
+    def test_negation(self):
+        self.check('device_id=!1-254',
+                   lambda p: p.device_id in (0, 255))
+        self.check('operation_code=!0031,subnet_id=1',
+                   lambda p: p.operation_code != 0x0031 and
+                   p.subnet_id == 1)
+        self.check('head=!HDLMIRACLE', lambda p: False)
+        self.check('head=X,HDLMIRACLE', lambda p: True)
+
+    def test_alternatives(self):
+        rows = parse_filter('device_id=1;subnet_id=3,device_type=258')
+        self.assertEqual(matched(compile_filter(rows)),
+                         [i for i, p in enumerate(PACKETS)
+                          if p.device_id == 1 or
+                          p.subnet_id == 3 and p.device_type == 0x0102])
+        self.assertEqual(parse_filter(' ; '), [])
+        self.assertRaises(ValueError, parse_filter, 'device_id=1;bar')
+
+    def test_errors(self):
+        for expression in ('foo=1', 'device_id', 'device_id=256',
+                           'device_id=5-1', 'device_id=x',
+                           'operation_code=10000', 'ipaddress=10.0.0.0/33',
+                           'head=A,,B'):
+            self.assertRaises(ValueError, parse_conditions, expression)
+
+    def test_rows_are_keys(self):
+        # equal expressions give equal rows, so MatchCache keeps their
+        # bitmaps
+        self.assertEqual(parse_conditions('device_id=1-5,subnet_id=!2'),
+                         parse_conditions('subnet_id=!2, device_id=1-5'))
+
+
+class DecodedTest(unittest.TestCase):
+    def check(self, expression, accepted):
+        match = compile_filter([parse_conditions(expression)])
+        self.assertEqual(matched(match),
+                         [i for i, packet in enumerate(PACKETS)
+                          if accepted(packet)])
+
+    def test_fields_as_keys(self):
+        # content is channel, level, time for 0031 and channel, result,
+        # level for 0032
+        self.check('operation_code=0031,channel=3',
+                   lambda p: p.operation_code == 0x0031 and
+                   p.content[0] == 3)
+        self.check('level=50-100',
+                   lambda p: p.operation_code == 0x0031 and
+                   50 <= p.content[1] <= 100 or
+                   p.operation_code == 0x0032 and p.content[2] >= 50)
+        self.check('decoded=channel=!0-6', lambda p: p.operation_code in
+                   (0x0031, 0x0032) and p.content[0] == 7)
+
+    def test_missing_field(self):
+        # packets without a decoder do not have the field
+        self.check('channel=0-255', lambda p: p.operation_code in
+                   (0x0031, 0x0032))
+        self.check('scene=0-255', lambda p: False)
+
+    def test_errors(self):
+        for expression in ('decoded=foo=1', 'decoded=channel', 'level=x'):
+            self.assertRaises(ValueError, parse_conditions, expression)
+
+
+if __name__ == '__main__':
+    unittest.main()
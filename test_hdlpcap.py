@@ -0,0 +1,178 @@
+import os
+import shutil
+import tempfile
+import unittest
+from struct import Struct
+
+from hdlcapture import Content, IPv4, OperationCode, Telegram, encode_packet
+from hdlpcap import (BLOCK_EPB, BLOCK_IDB, BLOCK_PB, BLOCK_SHB,
+                     BYTE_ORDER_MAGIC, ETHERNET, ETHERTYPE_IPV4, HDL_PORT,
+                     IPPROTO_UDP, IPV4, LINKTYPE_ETHERNET, LINKTYPE_LINUX_SLL,
+                     LINKTYPE_LINUX_SLL2, LINKTYPE_NULL, LINKTYPE_RAW,
+                     OPTION_TSOFFSET, OPTION_TSRESOL, UDP, PcapngWriter, block,
+                     read_pcap)
+
+
+def telegram(i):
+    return Telegram(IPv4(0x0a000001 + i % 5), 'HDLMIRACLE', i % 4, i % 256,
+                    0x0100 + i % 3, OperationCode(0x0031 + i % 4), 1, i % 7,
+                    Content(bytearray((i + j) % 256 for j in range(i % 40))))
+
+
+def fields(packet):
+    return (int(packet.ipaddress), packet.head, packet.subnet_id,
+            packet.device_id, packet.device_type, int(packet.operation_code),
+            packet.target_subnet_id, packet.target_device_id,
+            bytes(packet.content))
+
+
+def datagram(payload, port=HDL_PORT, protocol=IPPROTO_UDP, fragment=0):
+    udp = UDP.pack(port, port, UDP.size + len(payload), 0)
+    return IPV4.pack(0x45, 0, IPV4.size + len(udp) + len(payload), 0,
+                     fragment, 64, protocol, 0, payload[:4],
+                     b'\xff' * 4) + udp + payload
+
+
+def ethernet(data, vlan=False):
+    header = ETHERNET.pack(b'\xff' * 6, b'\x00' * 6,
+                           0x8100 if vlan else ETHERTYPE_IPV4)
+    if vlan:
+        header += Struct('>HH').pack(7, ETHERTYPE_IPV4)
+    return header + data
+
+
+def pcap(linktype, records, order='<', magic=0xa1b2c3d4, scale=1000):
+    # a classic pcap file of (timestamp in ns, frame)
+    data = Struct(order + 'IHHiIII').pack(magic, 2, 4, 0, 0, 65535,
+                                          linktype)
+    record = Struct(order + 'IIII')
+    for timestamp, frame in records:
+        seconds, fraction = divmod(timestamp, 1000000000)
+        data += record.pack(seconds, fraction // scale, len(frame),
+                            len(frame)) + frame
+    return data
+
+
+class PcapTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'test.pcap')
+
+    def read(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        return [(timestamp, fields(packet))
+                for timestamp, packet in read_pcap(self.path)]
+
+    def test_pcapng_round_trip(self):
+        items = [(1500000000123456789 + i * 1000, telegram(i))
+                 for i in range(100)]
+        writer = PcapngWriter(self.path)
+        writer.write(items[:50])
+        writer.write(items[50:])
+        writer.close()
+        self.assertEqual(len(writer), 100)
+        self.assertEqual([(timestamp, fields(packet))
+                          for timestamp, packet in read_pcap(self.path)],
+                         [(timestamp, fields(packet))
+                          for timestamp, packet in items])
+
+    def test_pcap(self):
+        payload = encode_packet(telegram(1))
+        expected = [(1000000000, fields(telegram(1)))]
+        for order, magic, scale in (('<', 0xa1b2c3d4, 1000),
+                                    ('>', 0xa1b2c3d4, 1000),
+                                    ('<', 0xa1b23c4d, 1)):
+            self.assertEqual(self.read(pcap(
+                LINKTYPE_ETHERNET, [(1000000000, ethernet(datagram(payload)))],
+                order, magic, scale
+            )), expected)
+        self.assertEqual(self.read(pcap(
+            LINKTYPE_NULL, [(1000000000, b'\x02\x00\x00\x00' +
+                             datagram(payload))]
+        )), expected)
+        self.assertEqual(self.read(pcap(
+            LINKTYPE_LINUX_SLL, [(1000000000, b'\x00' * 14 +
+                                  Struct('>H').pack(ETHERTYPE_IPV4) +
+                                  datagram(payload))]
+        )), expected)
+        self.assertEqual(self.read(pcap(
+            LINKTYPE_LINUX_SLL2, [(1000000000, Struct('>H').pack(
+                ETHERTYPE_IPV4) + b'\x00' * 18 + datagram(payload))]
+        )), expected)
+        for linktype in LINKTYPE_RAW:
+            self.assertEqual(self.read(pcap(
+                linktype, [(1000000000, datagram(payload))]
+            )), expected)
+
+    def test_other_traffic_is_skipped(self):
+        payload = encode_packet(telegram(2))
+        not_hdl = payload[:14] + b'\x00\x00' + payload[16:]
+        frames = [
+            ethernet(datagram(payload, port=53)),
+            ethernet(datagram(payload, protocol=6)),
+            ethernet(datagram(payload, fragment=0x2000)),
+            ethernet(datagram(not_hdl)),
+            ethernet(datagram(payload[:20])),
+            ethernet(datagram(payload))[:30],
+            ethernet(datagram(payload), vlan=True),
+        ]
+        self.assertEqual(
+            self.read(pcap(LINKTYPE_ETHERNET, [(i * 1000, frame) for i, frame
+                                               in enumerate(frames)])),
+            [(6000, fields(telegram(2)))]
+        )
+
+    def test_truncated(self):
+        payload = encode_packet(telegram(3))
+        data = pcap(LINKTYPE_ETHERNET, [(i, ethernet(datagram(payload)))
+                                        for i in range(3)])
+        for size, count in ((24, 0), (30, 0), (len(data) - 1, 2),
+                            (len(data), 3)):
+            self.assertEqual(len(self.read(data[:size])), count)
+
+    def test_pcapng_options(self):
+        # big-endian section, microsecond resolution, an offset of 10 s,
+        # and a simple packet block on an interface without an offset
+        payload = encode_packet(telegram(4))
+        frame = ethernet(datagram(payload))
+
+        def big(kind, body):
+            body += b'\x00' * (-len(body) % 4)
+            length = Struct('>I').pack(len(body) + 12)
+            return Struct('>I').pack(kind) + length + body + length
+
+        data = (big(BLOCK_SHB,
+                    Struct('>IHHq').pack(BYTE_ORDER_MAGIC, 1, 0, -1)) +
+                big(BLOCK_IDB, Struct('>HHI').pack(LINKTYPE_ETHERNET, 0,
+                                                   65535) +
+                    Struct('>HHBxxx').pack(OPTION_TSRESOL, 1, 6) +
+                    Struct('>HHq').pack(OPTION_TSOFFSET, 8, 10) +
+                    Struct('>HH').pack(0, 0)) +
+                big(BLOCK_EPB, Struct('>IIIII').pack(0, 0, 2000000,
+                                                     len(frame), len(frame)) +
+                    frame) +
+                big(BLOCK_EPB, Struct('>IIIII').pack(5, 0, 0, len(frame),
+                                                     len(frame)) + frame))
+        # a second, little-endian section
+        data += (block(BLOCK_SHB, Struct('<IHHq').pack(BYTE_ORDER_MAGIC, 1,
+                                                       0, -1)) +
+                 block(BLOCK_IDB, Struct('<HHI').pack(LINKTYPE_ETHERNET, 0,
+                                                      65535)) +
+                 block(BLOCK_PB, Struct('<HHIIII').pack(0, 0, 0, 7,
+                                                        len(frame),
+                                                        len(frame)) + frame))
+        self.assertEqual(self.read(data),
+                         [(12000000000, fields(telegram(4))),
+                          (7000, fields(telegram(4)))])
+
+    def test_not_a_pcap(self):
+        for data in (b'', b'HDLCAP\x00\x01', b'\x0a\x0d'):
+            with open(self.path, 'wb') as f:
+                f.write(data)
+            self.assertRaises(ValueError, read_pcap, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import unittest
+
+import hdlsearch
+from hdlcapture import (HEADER_SIZE, CaptureStore, Content, IPv4,
+                        OperationCode, Telegram)
+from hdlsearch import POSTING_SIZE, ContentIndex, Search, grams
+
+
+def telegram(content):
+    return Telegram(IPv4(0x7f000001), 'HDLMIRACLE', 1, 2, 3,
+                    OperationCode(0x0031), 4, 5, Content(bytearray(content)))
+
+
+def contents(count):
+    return [bytearray([i % 7, 0xab, i % 256, 0x10])[:i % 5]
+            for i in range(count)]
+
+
+class SearchTest(unittest.TestCase):
+    def test_grams(self):
+        self.assertEqual(grams(b'\x01\x02\x03'), set([0x0102, 0x0203]))
+        self.assertEqual(grams(b'\xff\xff\xff'), set([0xffff]))
+        self.assertEqual(grams(b'\x01'), set())
+
+    def test_hex(self):
+        search = Search('ab ?? 10')
+        self.assertTrue(search(b'\x00\xab\x05\x10'))
+        self.assertFalse(search(b'\xab\x10'))
+        self.assertEqual(search.keys(), set())
+        self.assertEqual(Search('01ab').keys(), set([0x01ab]))
+
+    def test_text_and_range(self):
+        search = Search('"on", [1]=6e-6f')
+        self.assertTrue(search(b'on'))
+        self.assertFalse(search(b'xxon'))
+        self.assertTrue(Search("[0]=00")(b'\x00\n'))
+        self.assertTrue(Search("'a,b'")(b'xa,by'))
+
+    def test_all_terms_must_match(self):
+        search = Search('01, 02')
+        self.assertTrue(search(b'\x02\x01'))
+        self.assertFalse(search(b'\x01'))
+
+    def test_bad_terms(self):
+        for expression in ('', ' , ', '0', 'zz', '[1]=20-10', '[x]=1'):
+            self.assertRaises(ValueError, Search, expression)
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.store = CaptureStore(max_packets=500)
+        self.index = ContentIndex()
+        self.index.clear(self.store.first)
+
+    def append(self, items):
+        start = self.store.end
+        for content in items:
+            self.store.append(0, telegram(content))
+        self.index.trim(self.store.first)
+        return start
+
+    def expected(self, search, start, stop):
+        return [seq for seq, content
+                in self.store.iter_contents(start, stop) if search(content)]
+
+    def check(self, expression, start=0, stop=None):
+        search = Search(expression)
+        stop = self.store.end if stop is None else stop
+        self.assertEqual(self.index.search(self.store, search, start, stop),
+                         self.expected(search, start, stop))
+
+    def test_search_indexes_what_it_scans(self):
+        self.append(contents(300))
+        self.assertEqual(self.index.end, 0)
+        self.check('ab 05', 0, 200)
+        self.assertEqual(self.index.end, 200)
+        for expression in ('ab 05', '06 ab', 'ab', '?? ab', '[2]=10-20',
+                           '"\x10"', 'ab, 10'):
+            self.check(expression)
+            self.check(expression, 123, 250)
+        self.assertEqual(self.index.end, 300)
+
+    def test_incremental_and_evicted(self):
+        for _ in range(6):
+            start = self.append(contents(200))
+            self.index.update(self.store.iter_contents(start),
+                              self.store.end)
+            self.check('ab 05')
+            self.check('04 ab', 0, 700)
+        self.assertEqual(self.store.first, 700)
+        self.assertTrue(self.index.first >= 700)
+        self.assertTrue(all(postings[0] + self.index.base >= 700 - 500
+                            for postings in self.index.postings.values()))
+
+    def test_rebase(self):
+        rebase_after = hdlsearch.REBASE_AFTER
+        hdlsearch.REBASE_AFTER = 100
+        try:
+            for _ in range(10):
+                self.append(contents(300))
+                self.check('ab 05')
+        finally:
+            hdlsearch.REBASE_AFTER = rebase_after
+        self.assertTrue(self.index.base > 0)
+        self.assertEqual(self.index.end, self.store.end)
+
+    def test_charged_to_the_store(self):
+        store = CaptureStore(max_packets=None,
+                             max_bytes=(HEADER_SIZE + 4) * 10)
+        for _ in range(10):
+            store.append(0, telegram(b'abcd'))
+        self.assertEqual(len(store), 10)
+        store.charge(POSTING_SIZE)
+        self.assertEqual(store.bytes, (HEADER_SIZE + 4) * 10 +
+                         POSTING_SIZE * 4 * 10)
+        store.append(0, telegram(b'abcd'))
+        self.assertTrue(store.bytes <= store.max_bytes)
+        self.assertTrue(len(store) < 10)
+        store.charge(0)
+        self.assertEqual(store.bytes, (HEADER_SIZE + 4) * len(store))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from hdlcapture import (Content, IPv4, OperationCode, PacketQueue, Telegram,
+                        main, monotonic_ns)
+from hdlstream import (KIND_DROPPED, KIND_PACKET, FrameReader, StreamServer,
+                       StreamSource, encode_frame, parse_address,
+                       subscription)
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import hdlmiracle
+except ImportError:
+    hdlmiracle = None
+
+
+TIMEOUT = 10.0
+BATCH = 100
+
+
+def telegram(i):
+    return Telegram(IPv4(0x7f000001), 'HDLMIRACLE', 1, i % 256, 1,
+                    OperationCode(0x0031 if i % 2 else 0x0032), 1, 3,
+                    Content(bytearray([1, i % 101, 0, 0])))
+
+
+def batch(start, count=BATCH):
+    now = int(time.time() * 1000000000)
+    return [(now + i, telegram(i)) for i in range(start, start + count)]
+
+
+def wait(condition):
+    end = time.time() + TIMEOUT
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+class FramingTest(unittest.TestCase):
+    def test_frames_split_anywhere(self):
+        data = (encode_frame(KIND_PACKET, 1, b'abc') +
+                encode_frame(KIND_DROPPED, 2) +
+                encode_frame(KIND_PACKET, -3, b'de'))
+        reader = FrameReader()
+        frames = []
+        for i in range(len(data)):
+            frames.extend(reader.feed(data[i:i + 1]))
+        self.assertEqual(frames, [(KIND_PACKET, 1, b'abc'),
+                                  (KIND_DROPPED, 2, b''),
+                                  (KIND_PACKET, -3, b'de')])
+        self.assertEqual(reader.buffer, b'')
+
+    def test_addresses(self):
+        self.assertEqual(parse_address('tcp:127.0.0.1:6001'),
+                         (socket.AF_INET, ('127.0.0.1', 6001)))
+        for spec in ('tcp:6001', 'tcp:host:port', 'udp:127.0.0.1:6001',
+                     'unix:', ''):
+            self.assertRaises(ValueError, parse_address, spec)
+
+
+class StreamTest(unittest.TestCase):
+    spec = 'tcp:127.0.0.1:0'
+
+    def setUp(self):
+        self.server = StreamServer(self.spec, size=1000)
+        self.sources = []
+
+    def tearDown(self):
+        for source in self.sources:
+            source.close()
+        self.server.close()
+
+    def address(self):
+        if self.server.family == socket.AF_INET:
+            return 'tcp:{0}:{1}'.format(*self.server.address)
+        return 'unix:' + self.server.address
+
+    def source(self, expression=''):
+        queue = PacketQueue()
+        spec = self.address()
+        if expression:
+            spec += '#' + expression
+        source = StreamSource(spec, queue.put)
+        source.attach()
+        self.sources.append(source)
+        return source, queue
+
+    def subscribed(self, count):
+        wait(lambda: len(self.server) == count and
+             all(client.subscribed for client in self.server.clients))
+
+    def test_packets(self):
+        source, queue = self.source()
+        self.subscribed(1)
+        items = batch(0)
+        self.server.publish(items)
+        wait(lambda: len(queue) == len(items))
+        received = queue.drain(len(items))
+        self.assertEqual([packet.device_id for _, packet in received],
+                         [packet.device_id for _, packet in items])
+        self.assertEqual(received[0][1].source, source.name)
+        self.assertEqual(bytes(received[0][1].content),
+                         bytes(bytearray([1, 0, 0, 0])))
+        # timestamps come back as local monotonic time
+        self.assertTrue(abs(received[0][0] + source.offset - items[0][0]) <
+                        1000000000)
+        self.assertTrue(abs(received[0][0] - monotonic_ns()) < 1000000000)
+
+    def test_filter(self):
+        _, everything = self.source()
+        _, filtered = self.source('operation_code=0031,device_id=1-9')
+        self.subscribed(2)
+        items = batch(0)
+        self.server.publish(items)
+        expected = [packet.device_id for _, packet in items
+                    if packet.operation_code == 0x0031 and
+                    1 <= packet.device_id <= 9]
+        wait(lambda: len(everything) == len(items) and
+             len(filtered) == len(expected))
+        time.sleep(0.1)
+        self.assertEqual([packet.device_id
+                          for _, packet in filtered.drain(len(items))],
+                         expected)
+
+    def test_bad_filter(self):
+        source, _ = self.source('foo=1')
+        wait(lambda: source.error is not None)
+        self.assertTrue('foo=1' in source.error)
+        source.thread.join(TIMEOUT)
+        self.assertFalse(source.thread.is_alive())
+
+    def capture(self, argv):
+        # runs hdlcapture's main() -> what it wrote to stderr
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            thread = threading.Thread(target=main, args=(argv,))
+            thread.daemon = True
+            thread.start()
+            thread.join(TIMEOUT)
+            self.assertFalse(thread.is_alive())
+            return sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+
+    @unittest.skipIf(hdlmiracle is None, 'no hdlmiracle')
+    def test_capture_drops_failed_sources(self):
+        good = self.address()
+        bad = self.address() + '#foo=1'
+
+        def publish():
+            self.subscribed(1)
+            self.server.publish(batch(0))
+
+        # the bad source is reported and dropped, the good one goes on
+        thread = threading.Thread(target=publish)
+        thread.start()
+        output = self.capture(['-q', '-c', str(BATCH), '-i', good,
+                               '-i', bad])
+        thread.join()
+        self.assertTrue(bad + ': ' in output, output)
+        self.assertTrue('foo=1' in output.split(bad + ': ')[1])
+        self.assertTrue('matched {0},'.format(BATCH) in output, output)
+        # and once none is left, it exits
+        output = self.capture(['-q', '-i', bad, '-i', bad])
+        self.assertEqual(output.count(bad + ': '), 2, output)
+        self.assertTrue('matched 0,' in output, output)
+
+    def slow_client(self, policy):
+        # subscribes and does not read, so its queue fills up
+        connection = socket.socket(self.server.family, socket.SOCK_STREAM)
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        connection.connect(self.server.address)
+        connection.sendall(subscription('', policy))
+        self.addCleanup(connection.close)
+        return connection
+
+    def read_slow(self, connection, count):
+        # -> (timestamps of the packets, last drop count reported) read
+        # until count packets or the end of the connection
+        connection.settimeout(TIMEOUT)
+        reader = FrameReader()
+        timestamps = []
+        dropped = 0
+        while len(timestamps) < count:
+            try:
+                data = connection.recv(65536)
+            except socket.error:
+                # reset, or timed out, which the caller's checks catch
+                break
+            if not data:
+                break
+            for kind, value, _ in reader.feed(data):
+                if kind == KIND_PACKET:
+                    timestamps.append(value)
+                elif kind == KIND_DROPPED:
+                    dropped = value
+        return timestamps, dropped
+
+    def check_policy(self, policy):
+        # -> (slow client, the timestamps it read, the last drop count it
+        # was told, the timestamps published)
+        connection = self.slow_client(policy)
+        self.subscribed(1)
+        slow = self.server.clients[0]
+        source, _ = self.source()
+        self.subscribed(2)
+        published = []
+        end = time.time() + TIMEOUT
+        while slow.dropped == 0:
+            self.assertTrue(time.time() < end)
+            items = batch(len(published))
+            self.server.publish(items)
+            published.extend(timestamp for timestamp, _ in items)
+            time.sleep(0.001)
+        # the fast client gets everything it was not told was dropped
+        wait(lambda: source.received + source.dropped == len(published))
+        self.assertEqual(source.dropped, 0)
+        timestamps, dropped = self.read_slow(connection,
+                                             len(published) - slow.dropped)
+        return slow, timestamps, dropped, published
+
+    def test_drop_oldest(self):
+        slow, timestamps, dropped, published = self.check_policy('oldest')
+        self.assertFalse(slow.closed)
+        self.assertEqual(dropped, slow.dropped)
+        self.assertEqual(len(timestamps), len(published) - dropped)
+        # what is left after the drop is the newest packets
+        self.assertEqual(timestamps[-slow.size:], published[-slow.size:])
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_drop_newest(self):
+        slow, timestamps, dropped, published = self.check_policy('newest')
+        self.assertFalse(slow.closed)
+        self.assertEqual(dropped, slow.dropped)
+        self.assertEqual(len(timestamps), len(published) - dropped)
+        # the packets that came once the queue was full are lost
+        self.assertEqual(timestamps, published[:len(timestamps)])
+        self.assertFalse(published[-1] in timestamps)
+
+    def test_disconnect(self):
+        slow, timestamps, dropped, published = self.check_policy(
+            'disconnect'
+        )
+        wait(lambda: slow not in self.server.clients)
+        self.assertTrue(slow.closed)
+        self.assertEqual(len(self.server), 1)
+        # read up to the end of the connection, without the last packets
+        self.assertTrue(len(timestamps) < len(published))
+        self.assertEqual(timestamps, published[:len(timestamps)])
+        self.assertEqual(dropped, 0)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'no Unix sockets')
+class UnixStreamTest(StreamTest):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spec = 'unix:' + os.path.join(self.directory, 'stream')
+        StreamTest.setUp(self)
+
+    def tearDown(self):
+        StreamTest.tearDown(self)
+        self.assertFalse(os.path.exists(self.server.address))
+        os.rmdir(self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()